@@ -0,0 +1,325 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from urllib.parse import parse_qsl, urlsplit
+
+from .config import Config
+from .exceptions import NotImplementedException
+from .log import logger
+
+MetricsConfig = Config["general"]["metrics"]
+
+Labels_T = Tuple[str, ...]
+Sample_T = Tuple[str, Dict[str, str], float]
+Route_T = Callable[[Dict[str, str]], Awaitable[Tuple[str, bytes]]]
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(16384 * 4 ** i for i in range(8))
+BATCH_BUCKETS = tuple(2 ** i for i in range(11))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _describe(name: str, key: Labels_T) -> str:
+    return f"{name}{{{','.join(key)}}}" if key else name
+
+
+def _format(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        name = f"{name}{{{pairs}}}"
+    return f"{name} {value:.17g}"
+
+
+class Metric:
+    type: str = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelNames: Labels_T = tuple(labels)
+        self._lock = Lock()
+        Metrics.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Labels_T:
+        assert len(labels) == len(self.labelNames), f"Labels of {self.name} missing."
+        return tuple(str(labels[i]) for i in self.labelNames)
+
+    def _labels(self, key: Labels_T) -> Dict[str, str]:
+        return dict(zip(self.labelNames, key))
+
+    def samples(self) -> Iterator[Sample_T]:
+        raise NotImplementedException
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels_T, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Sample_T]:
+        with self._lock:
+            values = [*self._values.items()]
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Counter):
+    """Gauge set directly or computed by tracked functions when collected."""
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._functions: Dict[Labels_T, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def track(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = function
+
+    def samples(self) -> Iterator[Sample_T]:
+        yield from super().samples()
+        for key, function in [*self._functions.items()]:
+            yield self.name, self._labels(key), function()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets: List[float] = sorted(buckets)
+        self._counts: Dict[Labels_T, List[int]] = {}
+        self._sums: Dict[Labels_T, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._counts:
+                self._counts[key] = [0] * (len(self.buckets) + 1)
+                self._sums[key] = 0
+            self._counts[key][bisect_left(self.buckets, value)] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        begin = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - begin, **labels)
+
+    def samples(self) -> Iterator[Sample_T]:
+        with self._lock:
+            values = [(k, [*v], self._sums[k]) for k, v in self._counts.items()]
+        for key, counts, total in values:
+            labels, cumulative = self._labels(key), 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:.17g}"
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._routes: Dict[str, Route_T] = {}
+        self._previous: Dict[Tuple[str, Labels_T], float] = {}
+        self._previousTime = monotonic()
+
+    def register(self, metric: Metric) -> None:
+        assert metric.name not in self._metrics, f"{metric.name} registered twice."
+        self._metrics[metric.name] = metric
+
+    def route(self, path: str, handler: Route_T) -> None:
+        """Serve ``handler`` on ``path`` next to the metrics."""
+        self._routes[path] = handler
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(_format(*sample) for sample in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Current values, per-second rates for counters and histogram means."""
+        now = monotonic()
+        elapsed = max(now - self._previousTime, 1e-9)
+        current: Dict[Tuple[str, Labels_T], float] = {}
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            histogram: Dict[Labels_T, List[float]] = {}
+            for name, labels, value in metric.samples():
+                key = tuple(f"{k}={v}" for k, v in labels.items() if k != "le")
+                if isinstance(metric, Histogram):
+                    if name.endswith(("_sum", "_count")):
+                        histogram.setdefault(key, []).append(value)
+                    continue
+                description = f"{_describe(name, key)} {value:g}"
+                if metric.type == "counter":
+                    current[(name, key)] = value
+                    rate = (value - self._previous.get((name, key), 0)) / elapsed
+                    description += f" ({rate:.4g}/s)"
+                lines.append(description)
+            for key, (total, count) in histogram.items():
+                mean = total / count if count else 0
+                lines.append(
+                    f"{_describe(metric.name, key)} n={count:g} mean={mean:.4g}"
+                )
+        self._previous, self._previousTime = current, now
+        return lines
+
+    async def _dispatch(self, method: str, target: str) -> Tuple[str, str, bytes]:
+        url = urlsplit(target)
+        if method != "GET":
+            return "405 Method Not Allowed", "text/plain", b""
+        if url.path in ("/", "/metrics"):
+            contentType = "text/plain; version=0.0.4; charset=utf-8"
+            return "200 OK", contentType, self.render().encode("utf-8")
+        if url.path not in self._routes:
+            return "404 Not Found", "text/plain", b""
+        try:
+            contentType, body = await self._routes[url.path](dict(parse_qsl(url.query)))
+        except (AssertionError, RuntimeError, ValueError) as e:
+            return "400 Bad Request", "text/plain", str(e).encode("utf-8")
+        return "200 OK", contentType, body
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, target, *_ = request.decode("latin-1").split(" ", 2)
+            status, contentType, body = await self._dispatch(method, target)
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(
+        self, host: Optional[str] = None, port: Optional[int] = None
+    ) -> Optional[asyncio.AbstractServer]:
+        """Expose the metrics endpoint, or ``None`` when it can not be bound."""
+        host = host or MetricsConfig["host"].as_str()
+        port = MetricsConfig["port"].as_number() if port is None else port
+        try:
+            server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            logger.warning(
+                f"Metrics endpoint on {host}:{port} could not be opened, "
+                + f"continuing without it: {e}"
+            )
+            return None
+        logger.info(f"Metrics are exposed on http://{host}:{port}/metrics.")
+        return server
+
+    async def dump(self, interval: Optional[float] = None) -> None:
+        interval = interval or MetricsConfig["log-interval"].as_number()
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("Metrics:\n" + "\n".join(self.summary()))
+
+
+Metrics = MetricsRegistry()
+
+PagesFetched = Counter(
+    "danbooru_list_pages_total", "List pages fetched successfully.", ("spider",)
+)
+ListLatency = Histogram(
+    "danbooru_list_latency_seconds", "Time taken by list requests.", ("spider",)
+)
+QueueDepth = Gauge(
+    "danbooru_queue_depth", "Items waiting in pipeline queues.", ("queue", "spider")
+)
+SchedulerSlots = Gauge(
+    "danbooru_scheduler_slots", "Download scheduler slots by state.", ("state",)
+)
+DownloadsInFlight = Gauge(
+    "danbooru_downloads_in_flight", "Picture downloads in progress.", ("spider",)
+)
+DownloadBytes = Counter(
+    "danbooru_download_bytes_total", "Picture bytes received.", ("host",)
+)
+DownloadLatency = Histogram(
+    "danbooru_download_latency_seconds", "Time taken by picture downloads.", ("spider",)
+)
+DownloadSize = Histogram(
+    "danbooru_download_size_bytes",
+    "Size of downloaded pictures.",
+    ("spider",),
+    buckets=SIZE_BUCKETS,
+)
+Retries = Counter("danbooru_retries_total", "Retried function calls.", ("function",))
+VerifyFailures = Counter(
+    "danbooru_verify_failures_total", "Pictures failing hash verification.", ("spider",)
+)
+NearDuplicatesSkipped = Counter(
+    "danbooru_near_duplicates_skipped_total",
+    "Downloads skipped for a larger near-duplicate stored already.",
+    ("spider",),
+)
+StageLatency = Histogram(
+    "danbooru_stage_seconds", "Time pictures spent per pipeline stage.", ("stage",)
+)
+BudgetUsage = Gauge(
+    "danbooru_budget_usage",
+    "Posts and bytes held against the pipeline budget.",
+    ("kind",),
+)
+JobStates = Gauge("danbooru_jobs", "Jobs in the durable queue by state.", ("state",))
+JobTransitions = Counter(
+    "danbooru_job_transitions_total", "Jobs moved into each state.", ("state",)
+)
+IngestLatency = Histogram(
+    "danbooru_ingest_latency_seconds", "Time taken to commit picture batches."
+)
+IngestBatchSize = Histogram(
+    "danbooru_ingest_batch_size", "Pictures per committed batch.", buckets=BATCH_BUCKETS
+)
@@ -1,2 +1,9 @@
-from .persistence import Persistence
+from .export import DatasetExport
+from .jobs import JobQueue
+from .metadata import MetadataStore
+from .persistence import IMAGE_PATH, Persistence
 from .services import DatabaseServices as Services
+from .similar import HammingIndex, NearDuplicates
+from .space import Space, SpaceManager
+from .storage import ShardStorage, StorageBackend, TreeStorage, getStorage, storageFor
+from .tagindex import Selection, TagIndex
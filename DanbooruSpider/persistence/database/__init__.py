@@ -1,3 +1,6 @@
+from .access import CheckpointsAccess as Checkpoints
+from .access import JobsAccess as Jobs
+from .access import PictureHashesAccess as PictureHashes
 from .access import PicturesAccess as Pictures
 from .access import TagsAccess as Tags
 from .access import TagsRelationAccess as TagsRelation
@@ -1,12 +1,26 @@
+from datetime import datetime, timedelta
 from functools import wraps
 from threading import Lock as threadLock
-from typing import Any, Awaitable, Callable, Dict, List, Optional
-
-from sqlalchemy import Table
-from sqlalchemy.engine import create_engine
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sqlalchemy import Table, and_, event, func, insert, inspect
+from sqlalchemy.dialects.postgresql import insert as postgresqlInsert
+from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import DeclarativeMeta
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from ...config import Config
 from ...exceptions import DatabaseException
@@ -15,7 +29,49 @@ from ...utils import SyncToAsync
 from . import models, tables
 
 DatabaseConfig = Config["persistence"]["database"]
-ThreadLock = threadLock()
+WriteLock = threadLock()
+PARAMETERS_CHUNK_SIZE = 500
+LOAD_BATCH_SIZE = 10000
+
+_engines: Dict[str, Engine] = {}
+_enginesLock = threadLock()
+
+
+def _sqlitePragmas(connection: Any, _: Any) -> None:
+    cursor = connection.cursor()
+    for name, value in DatabaseConfig["pragmas"].get(dict).items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def getEngine(uri: Optional[str] = None) -> Engine:
+    uri = uri or DatabaseConfig["uri"].as_str()
+    with _enginesLock:
+        if uri in _engines:
+            return _engines[uri]
+        url = make_url(uri)
+        options: Dict[str, Any] = {}
+        isSQLite = url.get_backend_name() == "sqlite"
+        if isSQLite and url.database not in (None, "", ":memory:"):
+            options.update(
+                poolclass=QueuePool,
+                pool_size=DatabaseConfig["pool-size"].as_number(),
+                # Reads come from every thread of the executors, which are
+                # not bounded by the pool, so waiting for a connection would
+                # only time out under load
+                max_overflow=-1,
+            )
+        engine = create_engine(
+            uri,
+            connect_args=DatabaseConfig["connect-args"].get(dict),
+            echo=DatabaseConfig["echo-sql-exec"].get(bool),
+            **options,
+        )
+        if isSQLite:
+            event.listen(engine, "connect", _sqlitePragmas)
+        _engines[uri] = engine
+        logger.debug(f"Database engine for {url!r} created.")
+    return engine
 
 
 def processDatabaseAccess(func: Callable) -> Callable[..., Awaitable]:
@@ -33,6 +89,22 @@ def processDatabaseAccess(func: Callable) -> Callable[..., Awaitable]:
     return wrapper
 
 
+def chunks(sequence: Sequence[Any], size: int = PARAMETERS_CHUNK_SIZE) -> Iterator:
+    for i in range(0, len(sequence), size):
+        yield sequence[i : i + size]
+
+
+def insertIgnore(table: Table, dialect: str) -> Any:
+    if dialect == "postgresql":
+        return postgresqlInsert(table).on_conflict_do_nothing()
+    statement = insert(table)
+    if dialect == "sqlite":
+        return statement.prefix_with("OR IGNORE")
+    if dialect == "mysql":
+        return statement.prefix_with("IGNORE")
+    return statement
+
+
 class DatabaseNotFoundException(DatabaseException):
     pass
 
@@ -47,36 +119,45 @@ class DatabaseAccessRoot:
         return dict(table.__dict__)
 
     class Transaction:
-        def __init__(self, session: Session) -> None:
+        def __init__(self, session: Session, write: bool = True) -> None:
             self._session = session
+            self._write = write
 
         def __enter__(self) -> Session:
+            if self._write:
+                WriteLock.acquire()
             self._session.begin()
-            ThreadLock.acquire()
             return self._session
 
         def __exit__(self, *args) -> None:
-            ThreadLock.release()
-            if self._session.transaction is not None:
-                self._session.transaction.__exit__(*args)
+            try:
+                if self._session.transaction is not None:
+                    self._session.transaction.__exit__(*args)
+            finally:
+                self._session.close()
+                if self._write:
+                    WriteLock.release()
             return
 
     def __init__(self, table: DeclarativeMeta, name: Optional[str] = None) -> None:
         self.table = table
-        self._engine = create_engine(
-            DatabaseConfig["uri"].as_str(),
-            connect_args=DatabaseConfig["connect-args"].get(dict),
-            echo=DatabaseConfig["echo-sql-exec"].get(bool),
-        )
+        self._engine = getEngine()
         self._sessionfactory: Callable[[], Session] = sessionmaker(
             bind=self._engine, autocommit=True
         )
         tableMetadata: Table = self.table.__table__
         tableMetadata.name = name or self.table.__tablename__
         tableMetadata.create(bind=self._engine, checkfirst=True)
+        # Tables are never altered, but indexes added later are created
+        existing = {
+            i["name"] for i in inspect(self._engine).get_indexes(tableMetadata.name)
+        }
+        for index in tableMetadata.indexes:
+            if index.name not in existing:
+                index.create(bind=self._engine)
 
-    def connect(self) -> "Transaction":
-        return self.Transaction(self._sessionfactory())
+    def connect(self, write: bool = True) -> "Transaction":
+        return self.Transaction(self._sessionfactory(), write=write)
 
 
 class PicturesAccess(DatabaseAccessRoot):
@@ -95,12 +176,70 @@ class PicturesAccess(DatabaseAccessRoot):
             result = models.PicturesRead(**self.toDict(tableData))
         return result
 
+    @processDatabaseAccess
+    def createMany(
+        self, data: List[models.PicturesIngest], tagsCache: Dict[str, int]
+    ) -> List[models.PicturesRead]:
+        pictures: Dict[str, models.PicturesIngest] = {}
+        for i in data:
+            pictures.setdefault(i.md5, i)
+        dialect = self._engine.dialect.name
+        with self.connect() as session:
+            for chunk in chunks([*pictures]):
+                for (md5,) in session.query(self.table.md5).filter(
+                    self.table.md5.in_(chunk)
+                ):
+                    pictures.pop(md5, None)
+            if not pictures:
+                return []
+            session.execute(
+                insertIgnore(self.table.__table__, dialect),
+                [i.dict(exclude={"tags"}) for i in pictures.values()],
+            )
+            createdRows: List[tables.Pictures] = []
+            for chunk in chunks([*pictures]):
+                createdRows.extend(
+                    session.query(self.table).filter(self.table.md5.in_(chunk))
+                )
+
+            missingTags = [
+                *{tag for i in pictures.values() for tag in i.tags}.difference(
+                    tagsCache
+                )
+            ]
+            # Only known to exist once committed, the cache is updated after
+            createdTags: Dict[str, int] = {}
+            if missingTags:
+                session.execute(
+                    insertIgnore(tables.Tags.__table__, dialect),
+                    [{"name": tag} for tag in missingTags],
+                )
+                for chunk in chunks(missingTags):
+                    createdTags.update(
+                        session.query(tables.Tags.name, tables.Tags.tid).filter(
+                            tables.Tags.name.in_(chunk)
+                        )
+                    )
+
+            relations = [
+                {"tid": createdTags.get(tag) or tagsCache[tag], "pid": row.pid}
+                for row in createdRows
+                for tag in {*pictures[row.md5].tags}
+            ]
+            if relations:
+                session.execute(
+                    insertIgnore(tables.TagRelations.__table__, dialect), relations
+                )
+            results = [models.PicturesRead(**self.toDict(i)) for i in createdRows]
+        tagsCache.update(createdTags)
+        return results
+
     @processDatabaseAccess
     def read(
         self, *, pid: Optional[int] = None, md5: Optional[str] = None
     ) -> models.PicturesRead:
         assert (pid or md5) is not None
-        with self.connect() as session:
+        with self.connect(write=False) as session:
             queryResult = (
                 session.query(self.table)
                 .filter(True if md5 is None else (self.table.md5 == md5))
@@ -112,6 +251,27 @@ class PicturesAccess(DatabaseAccessRoot):
             result = models.PicturesRead(**self.toDict(queryResult))
         return result
 
+    @processDatabaseAccess
+    def readMany(self, pids: List[int]) -> List[models.PicturesRead]:
+        with self.connect(write=False) as session:
+            results = [
+                models.PicturesRead(**self.toDict(i))
+                for chunk in chunks(pids)
+                for i in session.query(self.table).filter(self.table.pid.in_(chunk))
+            ]
+        return results
+
+    @processDatabaseAccess
+    def exists(self, hashes: List[str]) -> List[str]:
+        with self.connect(write=False) as session:
+            return [
+                md5
+                for chunk in chunks(hashes)
+                for (md5,) in session.query(self.table.md5).filter(
+                    self.table.md5.in_(chunk)
+                )
+            ]
+
     @processDatabaseAccess
     def delete(self, *, pid: Optional[int] = None, md5: Optional[str] = None) -> None:
         assert (pid or md5) is not None
@@ -152,7 +312,7 @@ class TagsAccess(DatabaseAccessRoot):
     def read(
         self, *, tid: Optional[int] = None, name: Optional[str] = None
     ) -> models.TagsRead:
-        with self.connect() as session:
+        with self.connect(write=False) as session:
             queryResult = (
                 session.query(self.table)
                 .filter(True if tid is None else (self.table.tid == tid))
@@ -209,7 +369,7 @@ class TagsRelationAccess(DatabaseAccessRoot):
         self, *, tid: Optional[int] = None, pid: Optional[int] = None
     ) -> List[models.TagsRelationRead]:
         assert (pid or tid) is not None
-        with self.connect() as session:
+        with self.connect(write=False) as session:
             queryResult = (
                 session.query(self.table)
                 .filter(True if pid is None else (self.table.pid == pid))
@@ -221,6 +381,21 @@ class TagsRelationAccess(DatabaseAccessRoot):
             ]
         return result
 
+    @processDatabaseAccess
+    def tagsOf(self, pids: List[int]) -> Dict[int, List[str]]:
+        """Names of the tags of every picture in ``pids``."""
+        results: Dict[int, List[str]] = {pid: [] for pid in pids}
+        with self.connect(write=False) as session:
+            for chunk in chunks(pids):
+                for pid, name in (
+                    session.query(self.table.pid, tables.Tags.name)
+                    .join(tables.Tags, tables.Tags.tid == self.table.tid)
+                    .filter(self.table.pid.in_(chunk))
+                    .order_by(self.table.pid, tables.Tags.name)
+                ):
+                    results[pid].append(name)
+        return results
+
     @processDatabaseAccess
     def delete(self, tid: int, pid: int) -> None:
         with self.connect() as session:
@@ -234,3 +409,362 @@ class TagsRelationAccess(DatabaseAccessRoot):
                 raise DatabaseNotFoundException
             session.delete(queryResult)
         return
+
+
+def _signed(value: Optional[int]) -> Optional[int]:
+    return value - (1 << 64) if value is not None and value >= 1 << 63 else value
+
+
+def _unsigned(value: Optional[int]) -> Optional[int]:
+    return value & ((1 << 64) - 1) if value is not None else None
+
+
+class PictureHashesAccess(DatabaseAccessRoot):
+    """Perceptual hashes of stored pictures.
+
+    Hashes are handed in and out as unsigned 64 bit integers and stored
+    signed, as most databases lack an unsigned 64 bit type.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(table=tables.PictureHashes)
+        self.table: tables.PictureHashes
+
+    @processDatabaseAccess
+    def createMany(self, data: List[models.PictureHashesCreate]) -> None:
+        if not data:
+            return
+        with self.connect() as session:
+            session.execute(
+                insertIgnore(self.table.__table__, self._engine.dialect.name),
+                [{**i.dict(), "phash": _signed(i.phash)} for i in data],
+            )
+
+    @processDatabaseAccess
+    def unhashed(self, limit: int) -> List[models.PicturesRead]:
+        """Stored pictures which have not been hashed yet, oldest first."""
+        with self.connect(write=False) as session:
+            results = [
+                models.PicturesRead(**self.toDict(i))
+                for i in session.query(tables.Pictures)
+                .outerjoin(self.table, self.table.pid == tables.Pictures.pid)
+                .filter(self.table.pid.is_(None))
+                .order_by(tables.Pictures.pid)
+                .limit(limit)
+            ]
+        return results
+
+    @processDatabaseAccess
+    def entries(self) -> List[Tuple[int, int, int]]:
+        """``(pid, phash, pixels)`` of hashed pictures not collapsed yet."""
+        with self.connect(write=False) as session:
+            table = self.table
+            results = [
+                (pid, _unsigned(phash), (width or 0) * (height or 0))
+                for pid, phash, width, height in session.query(
+                    table.pid, table.phash, table.width, table.height
+                )
+                .filter(self.table.phash.isnot(None))
+                .filter(self.table.duplicate_of.is_(None))
+                .yield_per(LOAD_BATCH_SIZE)
+            ]
+        return results
+
+    @processDatabaseAccess
+    def collapse(self, keeper: int, duplicates: List[int]) -> None:
+        """Mark ``duplicates`` as near-copies of ``keeper``, which takes over
+        all their tags."""
+        dialect = self._engine.dialect.name
+        with self.connect() as session:
+            session.query(self.table).filter(self.table.pid.in_(duplicates)).update(
+                {"duplicate_of": keeper}, synchronize_session=False
+            )
+            tids = {
+                tid
+                for (tid,) in session.query(tables.TagRelations.tid).filter(
+                    tables.TagRelations.pid.in_(duplicates)
+                )
+            }
+            if tids:
+                session.execute(
+                    insertIgnore(tables.TagRelations.__table__, dialect),
+                    [{"tid": tid, "pid": keeper} for tid in tids],
+                )
+
+    @processDatabaseAccess
+    def collapsed(self) -> List[int]:
+        """Pictures which have been merged into a near-duplicate."""
+        with self.connect(write=False) as session:
+            results = [
+                pid
+                for (pid,) in session.query(self.table.pid).filter(
+                    self.table.duplicate_of.isnot(None)
+                )
+            ]
+        return results
+
+
+class CheckpointsAccess(DatabaseAccessRoot):
+    def __init__(self) -> None:
+        super().__init__(table=tables.Checkpoints)
+        self.table: tables.Checkpoints
+
+    @processDatabaseAccess
+    def read(self, name: str) -> models.CheckpointsRead:
+        with self.connect(write=False) as session:
+            queryResult = (
+                session.query(self.table).filter(self.table.name == name).first()
+            )
+            if not queryResult:
+                raise DatabaseNotFoundException
+            result = models.CheckpointsRead(**self.toDict(queryResult))
+        return result
+
+    @processDatabaseAccess
+    def update(self, data: models.CheckpointsCreate) -> models.CheckpointsRead:
+        with self.connect() as session:
+            tableData = session.merge(self.table(**data.dict()))
+            session.flush()
+            result = models.CheckpointsRead(**self.toDict(tableData))
+        return result
+
+    @processDatabaseAccess
+    def delete(self, name: str) -> None:
+        with self.connect() as session:
+            queryResult = (
+                session.query(self.table).filter(self.table.name == name).first()
+            )
+            if not queryResult:
+                raise DatabaseNotFoundException
+            session.delete(queryResult)
+        return
+
+
+class JobsAccess(DatabaseAccessRoot):
+    """Leases on jobs of the durable download queue.
+
+    A claim moves jobs from a ready state into its claimed state for
+    ``lease`` seconds, ``visible_time`` holding the end of the lease. Jobs
+    whose lease ran out can be claimed again, as can ready jobs once their
+    ``visible_time`` passed.
+    """
+
+    CLAIMED = {
+        models.JobState.LEASED: models.JobState.PENDING,
+        models.JobState.STORING: models.JobState.DOWNLOADED,
+    }
+
+    def __init__(self) -> None:
+        super().__init__(table=tables.Jobs)
+        self.table: tables.Jobs
+
+    @staticmethod
+    def _counted(claimed: models.JobState) -> int:
+        """Only download leases count as attempts."""
+        return int(claimed == models.JobState.LEASED)
+
+    def _owned(self, owner: str, jids: List[int]) -> Any:
+        return and_(
+            self.table.jid.in_(jids),
+            self.table.owner == owner,
+            self.table.state.in_([*self.CLAIMED]),
+        )
+
+    @processDatabaseAccess
+    def enqueue(self, data: List[models.JobsCreate]) -> None:
+        """Add jobs, those already finished for a digest are queued again."""
+        now = datetime.now()
+        with self.connect() as session:
+            session.execute(
+                insertIgnore(self.table.__table__, self._engine.dialect.name),
+                [
+                    {**i.dict(), "state": models.JobState.PENDING, "visible_time": now}
+                    for i in data
+                ],
+            )
+            for chunk in chunks([i.md5 for i in data]):
+                session.query(self.table).filter(
+                    self.table.md5.in_(chunk),
+                    self.table.state.in_(
+                        [models.JobState.DONE, models.JobState.FAILED]
+                    ),
+                ).update(
+                    {
+                        self.table.state: models.JobState.PENDING,
+                        self.table.attempts: 0,
+                        self.table.owner: None,
+                        self.table.error: None,
+                        self.table.visible_time: now,
+                    },
+                    synchronize_session=False,
+                )
+        return
+
+    @processDatabaseAccess
+    def claim(
+        self,
+        owner: str,
+        count: int,
+        lease: float,
+        claimed: models.JobState = models.JobState.LEASED,
+    ) -> List[models.JobsRead]:
+        now = datetime.now()
+        claimable = and_(
+            self.table.state.in_([self.CLAIMED[claimed], claimed]),
+            self.table.visible_time <= now,
+        )
+        with self.connect() as session:
+            candidates = [
+                jid
+                for (jid,) in session.query(self.table.jid)
+                .filter(claimable)
+                .order_by(self.table.visible_time, self.table.jid)
+                .limit(count)
+            ]
+            if not candidates:
+                return []
+            # Conditions are checked again, another process may have won them
+            session.query(self.table).filter(
+                self.table.jid.in_(candidates), claimable
+            ).update(
+                {
+                    self.table.state: claimed,
+                    self.table.owner: owner,
+                    self.table.attempts: self.table.attempts + self._counted(claimed),
+                    self.table.visible_time: now + timedelta(seconds=lease),
+                },
+                synchronize_session=False,
+            )
+            queryResult = (
+                session.query(self.table)
+                .filter(self._owned(owner, candidates))
+                .order_by(self.table.jid)
+                .all()
+            )
+            result = [models.JobsRead(**self.toDict(i)) for i in queryResult]
+        return result
+
+    @processDatabaseAccess
+    def renew(self, owner: str, jids: List[int], lease: float) -> int:
+        with self.connect() as session:
+            return (
+                session.query(self.table)
+                .filter(self._owned(owner, jids))
+                .update(
+                    {
+                        self.table.visible_time: datetime.now()
+                        + timedelta(seconds=lease)
+                    },
+                    synchronize_session=False,
+                )
+            )
+
+    @processDatabaseAccess
+    def transition(
+        self,
+        owner: str,
+        jids: List[int],
+        state: models.JobState,
+        *,
+        delay: float = 0,
+        error: Optional[str] = None,
+    ) -> int:
+        """Move jobs leased by ``owner`` into ``state``, ending their lease."""
+        with self.connect() as session:
+            return (
+                session.query(self.table)
+                .filter(self._owned(owner, jids))
+                .update(
+                    {
+                        self.table.state: state,
+                        self.table.owner: None,
+                        self.table.error: error,
+                        self.table.visible_time: datetime.now()
+                        + timedelta(seconds=delay),
+                    },
+                    synchronize_session=False,
+                )
+            )
+
+    @processDatabaseAccess
+    def release(self, owner: str) -> int:
+        """Hand back all leases of ``owner`` without counting the attempt."""
+        released = 0
+        with self.connect() as session:
+            for claimed, ready in self.CLAIMED.items():
+                released += (
+                    session.query(self.table)
+                    .filter(self.table.owner == owner, self.table.state == claimed)
+                    .update(
+                        {
+                            self.table.state: ready,
+                            self.table.owner: None,
+                            self.table.attempts: self.table.attempts
+                            - self._counted(claimed),
+                            self.table.visible_time: datetime.now(),
+                        },
+                        synchronize_session=False,
+                    )
+                )
+        return released
+
+    @processDatabaseAccess
+    def retry(self, state: models.JobState = models.JobState.FAILED) -> int:
+        with self.connect() as session:
+            return (
+                session.query(self.table)
+                .filter(self.table.state == state)
+                .update(
+                    {
+                        self.table.state: models.JobState.PENDING,
+                        self.table.attempts: 0,
+                        self.table.visible_time: datetime.now(),
+                    },
+                    synchronize_session=False,
+                )
+            )
+
+    @processDatabaseAccess
+    def prune(self, before: datetime) -> int:
+        with self.connect() as session:
+            return (
+                session.query(self.table)
+                .filter(
+                    self.table.state == models.JobState.DONE,
+                    self.table.update_time < before,
+                )
+                .delete(synchronize_session=False)
+            )
+
+    @processDatabaseAccess
+    def stats(self) -> Dict[str, int]:
+        """Number of jobs by state, and of leases which ran out as ``expired``."""
+        with self.connect(write=False) as session:
+            result: Dict[str, int] = {i.value: 0 for i in models.JobState}
+            result.update(
+                session.query(self.table.state, func.count(self.table.jid))
+                .group_by(self.table.state)
+                .all()
+            )
+            result["expired"] = (
+                session.query(func.count(self.table.jid))
+                .filter(
+                    self.table.state.in_([*self.CLAIMED]),
+                    self.table.visible_time < datetime.now(),
+                )
+                .scalar()
+            )
+        return result
+
+    @processDatabaseAccess
+    def active(self) -> List[str]:
+        """Digests of jobs which may have a staged file in use."""
+        with self.connect(write=False) as session:
+            queryResult = (
+                session.query(self.table.md5)
+                .filter(
+                    self.table.state.in_([*self.CLAIMED, models.JobState.DOWNLOADED])
+                )
+                .all()
+            )
+        return [md5 for (md5,) in queryResult]
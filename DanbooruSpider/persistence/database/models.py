@@ -1,4 +1,6 @@
 from datetime import datetime
+from enum import Enum
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -12,6 +14,12 @@ class PicturesCreate(BaseModel):
     source_url: str
 
 
+class PicturesIngest(PicturesCreate):
+    __slots__ = ("trace",)
+
+    tags: List[str]
+
+
 class PicturesRead(PicturesCreate):
     pid: int
     create_time: datetime
@@ -33,3 +41,57 @@ class TagsRelationCreate(BaseModel):
 
 class TagsRelationRead(TagsRelationCreate):
     create_time: datetime
+
+
+class PictureHashesCreate(BaseModel):
+    pid: int
+    phash: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+
+class PictureHashesRead(PictureHashesCreate):
+    duplicate_of: Optional[int] = None
+    create_time: datetime
+
+
+class CrawlDirection(str, Enum):
+    BACKWARD = "backward"
+    FORWARD = "forward"
+
+
+class CheckpointsCreate(BaseModel):
+    name: str
+    highest_id: int
+    lowest_id: int
+    direction: CrawlDirection
+
+
+class CheckpointsRead(CheckpointsCreate):
+    update_time: datetime
+
+
+class JobState(str, Enum):
+    PENDING = "pending"
+    LEASED = "leased"
+    DOWNLOADED = "downloaded"
+    STORING = "storing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class JobsCreate(BaseModel):
+    md5: str
+    spider: str
+    payload: str
+
+
+class JobsRead(JobsCreate):
+    jid: int
+    state: JobState
+    attempts: int
+    owner: Optional[str] = None
+    visible_time: datetime
+    error: Optional[str] = None
+    create_time: datetime
+    update_time: datetime
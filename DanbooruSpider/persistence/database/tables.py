@@ -1,6 +1,15 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+)
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
 
 Base: DeclarativeMeta = declarative_base()
@@ -27,6 +36,48 @@ class Tags(Base):
 
 class TagRelations(Base):
     __tablename__ = "tag_relations"
+    # The primary key only serves scans by tag, new pictures are found by pid
+    __table_args__ = (Index("ix_tag_relations_pid", "pid"),)
     tid = Column(Integer, ForeignKey("tags.tid"), primary_key=True)
     pid = Column(Integer, ForeignKey("pictures.pid"), primary_key=True)
     create_time = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class PictureHashes(Base):
+    __tablename__ = "picture_hashes"
+    pid = Column(Integer, ForeignKey("pictures.pid"), primary_key=True)
+    # Signed 64 bit dHash, NULL if the picture could not be decoded
+    phash = Column(BigInteger, index=True)
+    width = Column(Integer)
+    height = Column(Integer)
+    duplicate_of = Column(Integer, ForeignKey("pictures.pid"), index=True)
+    create_time = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class Checkpoints(Base):
+    __tablename__ = "checkpoints"
+    name = Column(String(40), primary_key=True)
+    highest_id = Column(Integer, nullable=False)
+    lowest_id = Column(Integer, nullable=False)
+    direction = Column(String(10), nullable=False)
+    update_time = Column(
+        DateTime, nullable=False, default=datetime.now, onupdate=datetime.now
+    )
+
+
+class Jobs(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_state_visible_time", "state", "visible_time"),)
+    jid = Column(Integer, primary_key=True, autoincrement=True)
+    md5 = Column(String(40), index=True, unique=True, nullable=False)
+    spider = Column(String(40), nullable=False)
+    payload = Column(Text, nullable=False)
+    state = Column(String(12), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    owner = Column(String(80), index=True)
+    visible_time = Column(DateTime, nullable=False, default=datetime.now)
+    error = Column(String(300))
+    create_time = Column(DateTime, nullable=False, default=datetime.now)
+    update_time = Column(
+        DateTime, nullable=False, default=datetime.now, onupdate=datetime.now
+    )
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from ..config import Config
+from ..exceptions import DanbooruException
+from ..log import logger
+from ..utils import STREAM_BUFFER_SIZE
+from .database import models
+from .persistence import Persistence
+from .services import DatabaseServices as Services
+from .storage import storageFor
+from .tagindex import Selection
+
+ExportConfig = Config["persistence"]["export"]
+BLOCK_SIZE = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = bytes(BLOCK_SIZE * 2)
+MANIFEST_NAME = "manifest.json"
+LOOKUP_BATCH_SIZE = 1000
+
+Sample_T = Tuple[models.PicturesRead, Optional[bytes], bytes]
+
+
+def _padded(size: int) -> int:
+    return size + -size % BLOCK_SIZE
+
+
+class DatasetExport:
+    """Export of the pictures matching a query into tar shards.
+
+    Shards follow the WebDataset layout, every picture is stored as
+    ``<md5>.<ext>`` followed by ``<md5>.json`` with its record, tags and
+    post metadata. Pictures are read in pid order by ``workers`` threads up
+    to ``read-ahead`` pictures ahead of the single writer, which fills each
+    shard up to ``shard-size`` bytes. A shard is written under a temporary name, synced
+    and renamed before it is recorded in the manifest, so an interrupted
+    export continues after its last recorded shard. Running it again later
+    adds the pictures stored since in new shards.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        expression: str = "",
+        *,
+        prefix: str = "shard",
+        shardSize: Optional[int] = None,
+        workers: Optional[int] = None,
+        readAhead: Optional[int] = None,
+    ) -> None:
+        self.folder = folder
+        self.expression = expression
+        self.prefix = prefix
+        self.shardSize: int = shardSize or ExportConfig["shard-size"].as_number()
+        self._workers: int = workers or ExportConfig["workers"].as_number()
+        self._readAhead: int = readAhead or ExportConfig["read-ahead"].as_number()
+        self.manifest: Dict[str, Any] = {}
+        self._file: Optional[BinaryIO] = None
+        self._shard: Dict[str, Any] = {}
+
+    @property
+    def _manifestPath(self) -> Path:
+        return self.folder / MANIFEST_NAME
+
+    def _resume(self) -> int:
+        """Load the manifest of an earlier run, returning the pid after
+        which the export continues."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for leftover in self.folder.glob("*.part"):
+            leftover.unlink()
+        if not self._manifestPath.exists():
+            self.manifest = {
+                "query": self.expression,
+                "prefix": self.prefix,
+                "shard-size": self.shardSize,
+                "complete": False,
+                "shards": [],
+            }
+            return 0
+        self.manifest = json.loads(self._manifestPath.read_text("utf-8"))
+        if (self.manifest["query"], self.manifest["prefix"]) != (
+            self.expression,
+            self.prefix,
+        ):
+            raise DanbooruException(
+                f"{str(self.folder)!r} holds an export of "
+                + f"{self.manifest['query']!r} with prefix "
+                + f"{self.manifest['prefix']!r} already."
+            )
+        shards = self.manifest["shards"]
+        return shards[-1]["last"] if shards else 0
+
+    def _saveManifest(self) -> None:
+        temporary = self._manifestPath.with_suffix(".tmp")
+        temporary.write_text(json.dumps(self.manifest, indent=2), "utf-8")
+        os.replace(temporary, self._manifestPath)
+
+    def _load(self, picture: models.PicturesRead, tags: List[str]) -> Sample_T:
+        try:
+            data: Optional[bytes] = storageFor(picture.locale_path).read(
+                picture.locale_path
+            )
+        except OSError as e:
+            logger.warning(f"Picture {picture.md5} could not be read: {e}")
+            data = None
+        record = {
+            **picture.dict(exclude={"create_time"}),
+            "create_time": picture.create_time.isoformat(),
+            "tags": tags,
+            "post": Persistence.metadata.get(picture.md5),
+        }
+        return picture, data, json.dumps(record, ensure_ascii=False).encode("utf-8")
+
+    def _open(self) -> BinaryIO:
+        name = f"{self.prefix}-{len(self.manifest['shards']):06d}.tar"
+        self._shard = {
+            "name": name,
+            "first": None,
+            "last": None,
+            "count": 0,
+            "missing": 0,
+            "size": 0,
+        }
+        self._file = (self.folder / f"{name}.part").open("wb", STREAM_BUFFER_SIZE)
+        return self._file
+
+    def _seal(self) -> None:
+        assert self._file is not None
+        file, name = self._file, self._shard["name"]
+        file.write(END_OF_ARCHIVE)
+        self._shard["size"] = file.tell()
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+        self._file = None
+        os.replace(self.folder / f"{name}.part", self.folder / name)
+        self.manifest["shards"].append(self._shard)
+        self._saveManifest()
+        logger.info(
+            f"Shard {name} sealed with {self._shard['count']} pictures "
+            + f"in {self._shard['size']} bytes."
+        )
+
+    def _entry(self, file: BinaryIO, name: str, data: bytes, mtime: float) -> None:
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = len(data), int(mtime), 0o644
+        file.write(info.tobuf(format=tarfile.USTAR_FORMAT))
+        file.write(data)
+        file.write(bytes(-len(data) % BLOCK_SIZE))
+
+    def _write(self, sample: Sample_T) -> None:
+        picture, data, record = sample
+        file = self._file or self._open()
+        if data is not None:
+            size = 2 * BLOCK_SIZE + _padded(len(data)) + _padded(len(record))
+            if self._shard["count"] and file.tell() + size > self.shardSize:
+                self._seal()
+                file = self._open()
+            mtime = picture.create_time.timestamp()
+            ext = picture.locale_path.rsplit(".", 1)[-1].lower()
+            self._entry(file, f"{picture.md5}.{ext}", data, mtime)
+            self._entry(file, f"{picture.md5}.json", record, mtime)
+            self._shard["count"] += 1
+        else:
+            self._shard["missing"] += 1
+        if self._shard["first"] is None:
+            self._shard["first"] = picture.pid
+        self._shard["last"] = picture.pid
+
+    async def _pictures(
+        self, pids: Iterator[int]
+    ) -> AsyncIterator[Tuple[models.PicturesRead, List[str]]]:
+        while True:
+            batch = [*islice(pids, LOOKUP_BATCH_SIZE)]
+            if not batch:
+                return
+            pictures = await Services.pictures.readMany(batch)
+            tags = await Services.tagsrelations.tagsOf(batch)
+            for picture in sorted(pictures, key=lambda i: i.pid):
+                yield picture, tags.get(picture.pid, [])
+
+    async def run(self, selection: Selection) -> Dict[str, Any]:
+        after = self._resume()
+        self.manifest["complete"] = False
+        if after:
+            logger.info(
+                f"Export resumes after {len(self.manifest['shards'])} shards "
+                + f"with pictures following {after}."
+            )
+        loop = asyncio.get_event_loop()
+        beginTime, exported = perf_counter(), 0
+        readers = ThreadPoolExecutor(self._workers)
+        writer = ThreadPoolExecutor(1)
+        window: Deque[asyncio.Future] = deque()
+
+        async def writeNext() -> None:
+            nonlocal exported
+            sample: Sample_T = await window.popleft()
+            await loop.run_in_executor(writer, self._write, sample)
+            exported += len(sample[1] or b"")
+
+        try:
+            pids = (i for i in selection.pids() if i > after)
+            async for picture, tags in self._pictures(pids):
+                window.append(loop.run_in_executor(readers, self._load, picture, tags))
+                if len(window) >= self._readAhead:
+                    await writeNext()
+            while window:
+                await writeNext()
+        finally:
+            for future in window:
+                future.cancel()
+            readers.shutdown()
+            writer.shutdown()
+        if self._file is not None:
+            self._seal()
+        shards = self.manifest["shards"]
+        self.manifest.update(
+            complete=True,
+            count=sum(i["count"] for i in shards),
+            missing=sum(i["missing"] for i in shards),
+            size=sum(i["size"] for i in shards),
+        )
+        self._saveManifest()
+        elapsed = perf_counter() - beginTime
+        logger.info(
+            f"Export of {self.manifest['count']} pictures into {len(shards)} shards "
+            + f"finished, {exported / 2 ** 20 / max(elapsed, 1e-6):.1f} MiB/s."
+        )
+        return self.manifest
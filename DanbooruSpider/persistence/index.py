@@ -0,0 +1,87 @@
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from threading import Lock as threadLock
+from typing import Iterable, Iterator, Set
+
+from ..log import logger
+from .database.access import PicturesAccess, processDatabaseAccess
+
+LOAD_BATCH_SIZE = 10000
+MERGE_THRESHOLD = 65536
+
+
+def _unique(keys: Iterable[int]) -> Iterator[int]:
+    previous = None
+    for key in keys:
+        if key != previous:
+            yield key
+        previous = key
+
+
+class ImageHashIndex:
+    """Process-wide membership index of stored image MD5 digests.
+
+    Each digest is reduced to its leading 64 bits and kept in a sorted
+    ``array`` (8 bytes per image) plus a small set of recent additions which
+    is merged back once it grows past ``MERGE_THRESHOLD``.
+    """
+
+    def __init__(self) -> None:
+        self._sorted: array = array("Q")
+        self._recent: Set[int] = set()
+        self._lock = threadLock()
+        self.loaded = False
+
+    @staticmethod
+    def key(md5: str) -> int:
+        return int(md5[:16], 16)
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def _containsKey(self, key: int) -> bool:
+        if key in self._recent:
+            return True
+        keys = self._sorted
+        position = bisect_left(keys, key)
+        return position < len(keys) and keys[position] == key
+
+    def __contains__(self, md5: str) -> bool:
+        return self._containsKey(self.key(md5))
+
+    def _merge(self) -> None:
+        self._sorted = array("Q", _unique(merge(self._sorted, sorted(self._recent))))
+        self._recent.clear()
+
+    def add(self, md5: str) -> None:
+        with self._lock:
+            key = self.key(md5)
+            if self._containsKey(key):
+                return
+            self._recent.add(key)
+            if len(self._recent) >= MERGE_THRESHOLD:
+                self._merge()
+
+    def update(self, hashes: Iterable[str]) -> None:
+        for md5 in hashes:
+            self.add(md5)
+
+    def exists(self, hashes: Iterable[str]) -> Set[str]:
+        return {md5 for md5 in hashes if self._containsKey(self.key(md5))}
+
+    @processDatabaseAccess
+    def load(self, access: PicturesAccess) -> int:
+        with access.connect(write=False) as session:
+            keys = sorted(
+                self.key(md5)
+                for (md5,) in session.query(access.table.md5).yield_per(
+                    LOAD_BATCH_SIZE
+                )
+            )
+        with self._lock:
+            self._sorted = array("Q", _unique(merge(keys, sorted(self._recent))))
+            self._recent.clear()
+            self.loaded = True
+        logger.info(f"Image hash index loaded with {len(self)} records.")
+        return len(self)
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from ..config import Config
+from ..log import logger
+from ..metrics import JobTransitions
+from ..spider.models import DanbooruImage
+from .database import Jobs, models
+
+JobsConfig = Config["spider"]["jobs"]
+ERROR_LENGTH = 300
+FINISHED_STATES = (models.JobState.DONE, models.JobState.FAILED)
+
+
+class JobQueue:
+    """Durable handoff of pictures from list crawlers to download workers.
+
+    Jobs live in the database, so they survive crashes and can be shared by
+    several processes. A download worker leases ``pending`` jobs and leaves
+    them ``downloaded`` with the verified picture in the staging area, from
+    where the single storing process moves them on to ``done``. Leases of
+    workers which stopped responding run out after ``lease`` seconds, failed
+    jobs are retried with a growing delay up to ``max-attempts`` times.
+    """
+
+    def __init__(
+        self,
+        access: Jobs,
+        *,
+        lease: Optional[float] = None,
+        maxAttempts: Optional[int] = None,
+        retryDelay: Optional[float] = None,
+    ) -> None:
+        self._access = access
+        self.lease: float = lease or JobsConfig["lease"].as_number()
+        self._maxAttempts: int = maxAttempts or JobsConfig["max-attempts"].as_number()
+        self._retryDelay: float = (
+            JobsConfig["retry-delay"].as_number() if retryDelay is None else retryDelay
+        )
+
+    @staticmethod
+    def image(job: models.JobsRead) -> DanbooruImage:
+        return DanbooruImage.parse_raw(job.payload)
+
+    async def put(self, spider: str, images: Iterable[DanbooruImage]) -> int:
+        jobs = [
+            models.JobsCreate(md5=i.imageMD5.lower(), spider=spider, payload=i.json())
+            for i in images
+        ]
+        if jobs:
+            await self._access.enqueue(jobs)
+            JobTransitions.inc(len(jobs), state=models.JobState.PENDING.value)
+        logger.trace(f"{len(jobs)} jobs of spider {spider} have been queued.")
+        return len(jobs)
+
+    async def claim(
+        self,
+        owner: str,
+        count: int,
+        claimed: models.JobState = models.JobState.LEASED,
+    ) -> List[models.JobsRead]:
+        jobs = await self._access.claim(owner, count, self.lease, claimed)
+        if jobs:
+            JobTransitions.inc(len(jobs), state=claimed.value)
+        return jobs
+
+    async def renew(self, owner: str, jobs: Iterable[int]) -> int:
+        jids = [*jobs]
+        return await self._access.renew(owner, jids, self.lease) if jids else 0
+
+    async def _finish(
+        self, owner: str, jobs: List[models.JobsRead], state: models.JobState
+    ) -> int:
+        if not jobs:
+            return 0
+        count = await self._access.transition(owner, [i.jid for i in jobs], state)
+        if count < len(jobs):
+            logger.warning(
+                f"{len(jobs) - count} jobs could not be marked {state.value}, "
+                + "their lease ran out before."
+            )
+        JobTransitions.inc(count, state=state.value)
+        return count
+
+    async def downloaded(self, owner: str, jobs: List[models.JobsRead]) -> int:
+        return await self._finish(owner, jobs, models.JobState.DOWNLOADED)
+
+    async def complete(self, owner: str, jobs: List[models.JobsRead]) -> int:
+        return await self._finish(owner, jobs, models.JobState.DONE)
+
+    async def fail(
+        self, owner: str, job: models.JobsRead, error: Exception
+    ) -> models.JobState:
+        """Queue a job again after a delay, or give it up as ``failed``."""
+        state = models.JobState.PENDING
+        if job.attempts >= self._maxAttempts:
+            state = models.JobState.FAILED
+        await self._access.transition(
+            owner,
+            [job.jid],
+            state,
+            delay=self._retryDelay * job.attempts,
+            error=f"{type(error).__name__}: {error}"[:ERROR_LENGTH],
+        )
+        JobTransitions.inc(state=state.value)
+        return state
+
+    async def release(self, owner: str) -> int:
+        released = await self._access.release(owner)
+        if released:
+            logger.info(f"{released} jobs leased by {owner} have been released.")
+        return released
+
+    async def retry(self) -> int:
+        return await self._access.retry()
+
+    async def prune(self, age: Optional[float] = None) -> int:
+        age = JobsConfig["keep-done"].as_number() if age is None else age
+        if age <= 0:
+            return 0
+        return await self._access.prune(datetime.now() - timedelta(seconds=age))
+
+    async def stats(self) -> Dict[str, int]:
+        return await self._access.stats()
+
+    async def active(self) -> List[str]:
+        return await self._access.active()
+
+    async def drained(self) -> bool:
+        """Whether no job is waiting, leased or waiting to be stored."""
+        stats = await self.stats()
+        return not any(
+            stats[i.value] for i in models.JobState if i not in FINISHED_STATES
+        )
@@ -0,0 +1,273 @@
+import json
+import os
+from pathlib import Path
+from threading import RLock
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from ..config import Config
+from ..exceptions import DanbooruException
+from ..log import logger
+from ..utils import BatchToProcess, SyncToAsync
+from .offsets import OffsetIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows, where processes sharing a store are not checked
+    fcntl = None
+
+METADATA_PATH = Path(".") / "data" / "metadata"
+MetadataConfig = Config["persistence"]["metadata"]
+
+
+def _encode(md5: str, data: Dict[str, Any]) -> bytes:
+    return (
+        json.dumps(
+            {"md5": md5, "data": data},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        + "\n"
+    ).encode("utf-8")
+
+
+def _lockFile(path: Path, exclusive: bool, wait: bool) -> Optional[BinaryIO]:
+    """Lock ``path`` until the returned file is closed, ``None`` when another
+    process holds it and ``wait`` is false."""
+    file = path.open("ab")
+    if fcntl is None:
+        return file
+    flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(file.fileno(), flags if wait else flags | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+@BatchToProcess
+def encodeRecords(items: List[Tuple[str, Any]]) -> List[bytes]:
+    """Encode ``(md5, model)`` pairs into records, models being converted
+    with their ``dict`` method on the way."""
+    return [_encode(md5.lower(), model.dict()) for md5, model in items]
+
+
+class MetadataStore:
+    """Append-only store of picture metadata.
+
+    Metadata is written as compact JSON lines into numbered segment files
+    and located through an ``OffsetIndex`` keyed by MD5. Segments whose
+    records were mostly superseded are rewritten by ``compact``.
+
+    Files are only opened on first use, so processes which merely import
+    the store leave it alone. Only one process writes a store, it locks the
+    store on its first write.
+    Other processes reading it keep it from being compacted meanwhile, and
+    wait for a running compaction before their first read.
+    """
+
+    def __init__(
+        self, folder: Optional[Path] = None, segmentSize: Optional[int] = None
+    ) -> None:
+        self._folder = folder or METADATA_PATH
+        self._segmentSize: int = (
+            segmentSize or MetadataConfig["segment-size"].as_number()
+        )
+        self._lock = RLock()
+        self._index: Optional[OffsetIndex] = None
+        self._segment = 0
+        self._file: Optional[BinaryIO] = None
+        self._writing: Optional[BinaryIO] = None
+        self._reading: Optional[BinaryIO] = None
+
+    @property
+    def index(self) -> OffsetIndex:
+        return self._open()
+
+    def _open(self) -> OffsetIndex:
+        with self._lock:
+            if self._index is None:
+                self._folder.mkdir(parents=True, exist_ok=True)
+                self._index = OffsetIndex(self._folder)
+                self._segment = self._last()
+            return self._index
+
+    def _path(self, segment: int) -> Path:
+        return self._folder / f"segment-{segment:06d}.jsonl"
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(i.stem.split("-")[1]) for i in self._folder.glob("segment-*.jsonl")
+        )
+
+    def _last(self) -> int:
+        segments = self.segments()
+        return segments[-1] if segments else 1
+
+    def _writer(self) -> BinaryIO:
+        if self._file is None:
+            if self._writing is None:
+                self._folder.mkdir(parents=True, exist_ok=True)
+                self._writing = _lockFile(self._folder / "writer.lock", True, False)
+                if self._writing is None:
+                    raise DanbooruException(
+                        f"Metadata in {str(self._folder)!r} is being written "
+                        + "by another process."
+                    )
+                # Pick up what the previous writer left, no other process can
+                # compact the store from now on
+                if self._reading is not None:
+                    self._reading.close()
+                    self._reading = None
+                self._reopen()
+            self._file = self._path(self._segment).open("ab")
+        return self._file
+
+    def _reader(self) -> None:
+        if self._writing is None and self._reading is None:
+            self._folder.mkdir(parents=True, exist_ok=True)
+            self._reading = _lockFile(self._folder / "readers.lock", False, True)
+            self._reopen()
+
+    def _reopen(self) -> None:
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        self._open()
+
+    def _roll(self) -> None:
+        self._writer().close()
+        self._segment += 1
+        self._file = self._path(self._segment).open("ab")
+        logger.debug(f"Metadata segment {self._segment} opened.")
+
+    def put(self, md5: str, data: Dict[str, Any]) -> None:
+        self.append(md5, _encode(md5.lower(), data))
+
+    def append(self, md5: str, record: bytes) -> None:
+        """Store a record made by ``encodeRecords``."""
+        md5 = md5.lower()
+        with self._lock:
+            file = self._writer()
+            offset = file.tell()
+            if offset and offset + len(record) > self._segmentSize:
+                self._roll()
+                file = self._writer()
+                offset = file.tell()
+            file.write(record)
+            file.flush()
+            self.index.put(md5, self._segment, offset, len(record))
+
+    def _read(self, segment: int, offset: int, length: int) -> Dict[str, Any]:
+        with self._path(segment).open("rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def get(self, md5: str) -> Optional[Dict[str, Any]]:
+        # Locked, so that ``compact`` can not remove the segment in between
+        with self._lock:
+            self._reader()
+            location = self.index.get(md5.lower())
+            if location is None:
+                return None
+            return self._read(*location)["data"]
+
+    def scan(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Iterate all live records, reading each segment sequentially. The
+        store is locked meanwhile."""
+        with self._lock:
+            self._reader()
+            for segment in self.segments():
+                yield from self._segmentRecords(segment)
+
+    def compact(self, ratio: Optional[float] = None) -> int:
+        """Rewrite sealed segments whose live share fell below ``ratio``, put
+        off while other processes read the store."""
+        ratio = MetadataConfig["compact-ratio"].as_number() if ratio is None else ratio
+        with self._lock:
+            self._writer()
+            readers = _lockFile(self._folder / "readers.lock", True, False)
+            if readers is None:
+                logger.info("Metadata compaction is put off, the store is being read.")
+                return 0
+            try:
+                count = self._compact(ratio)
+            finally:
+                readers.close()
+        if count:
+            logger.info(f"{count} metadata segments have been compacted.")
+        return count
+
+    def _compact(self, ratio: float) -> int:
+        liveSize: Dict[int, int] = {}
+        for _, (segment, _, length) in self.index.items():
+            liveSize[segment] = liveSize.get(segment, 0) + length
+        candidates = [
+            segment
+            for segment in self.segments()
+            if segment != self._segment
+            and liveSize.get(segment, 0) < self._path(segment).stat().st_size * ratio
+        ]
+        if not candidates:
+            return 0
+        self._roll()
+        for segment in candidates:
+            for md5, data in self._segmentRecords(segment):
+                self.put(md5, data)
+        self.index.merge()
+        for segment in candidates:
+            os.remove(self._path(segment))
+        return len(candidates)
+
+    def _segmentRecords(self, segment: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        offset = 0
+        with self._path(segment).open("rb") as f:
+            for line in f:
+                record = json.loads(line)
+                if self.index.get(record["md5"]) == (segment, offset, len(line)):
+                    yield record["md5"], record["data"]
+                offset += len(line)
+
+    def migrate(self, root: Path, remove: bool = False) -> int:
+        """Import ``<md5>.json`` sidecar files found below ``root``."""
+        count = 0
+        for path in root.rglob("*.json"):
+            md5 = path.stem.lower()
+            if len(md5) != 32 or not path.is_file():
+                continue
+            self.put(md5, json.loads(path.read_text("utf-8")))
+            count += 1
+            if remove:
+                path.unlink()
+            if count % 10000 == 0:
+                logger.info(f"{count} metadata sidecar files migrated.")
+        self.index.merge()
+        logger.info(f"Migration finished, {count} metadata sidecar files imported.")
+        return count
+
+    @SyncToAsync
+    def putAsync(self, md5: str, data: Dict[str, Any]) -> None:
+        self.put(md5, data)
+
+    @SyncToAsync
+    def appendAsync(self, md5: str, record: bytes) -> None:
+        self.append(md5, record)
+
+    @SyncToAsync
+    def getAsync(self, md5: str) -> Optional[Dict[str, Any]]:
+        return self.get(md5)
+
+    @SyncToAsync
+    def compactAsync(self) -> int:
+        return self.compact()
+
+    def close(self) -> None:
+        with self._lock:
+            for file in (self._file, self._writing, self._reading):
+                if file is not None:
+                    file.close()
+            self._file = self._writing = self._reading = None
+            if self._index is not None:
+                self._index.close()
+                self._index = None
@@ -0,0 +1,153 @@
+import mmap
+import os
+from heapq import merge as heapMerge
+from pathlib import Path
+from struct import Struct
+from threading import RLock
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Tuple
+
+Location_T = Tuple[int, int, int]
+
+RECORD = Struct("<16sIQQ")
+MERGE_THRESHOLD = 65536
+
+
+class OffsetIndex:
+    """Digest to ``(segment, offset, length)`` index of packed files.
+
+    New records are appended to a journal and kept in a dictionary, older
+    ones live in a file of fixed-size records sorted by digest which is
+    memory-mapped and binary searched. The journal is folded into the
+    sorted file once it grows past ``MERGE_THRESHOLD`` records. It is only
+    opened for writing, and a torn last record cut off, by the first write,
+    so processes which only read can open the index next to its writer.
+    """
+
+    def __init__(self, folder: Path, name: str = "index") -> None:
+        folder.mkdir(parents=True, exist_ok=True)
+        self._sortedPath = folder / f"{name}.sorted"
+        self._journalPath = folder / f"{name}.journal"
+        self._lock = RLock()
+        self._recent: Dict[bytes, Location_T] = {}
+        self._map: Optional[mmap.mmap] = None
+        self._journal: Optional[BinaryIO] = None
+        self._count = 0
+        with self._lock:
+            self._open()
+            with self._journalPath.open("ab+") as journal:
+                journal.seek(0)
+                data = journal.read()
+            self._usable = len(data) - len(data) % RECORD.size
+            for digest, *location in RECORD.iter_unpack(data[: self._usable]):
+                self._recent[digest] = tuple(location)  # type: ignore
+
+    def _writer(self) -> BinaryIO:
+        if self._journal is None:
+            self._journal = self._journalPath.open("ab")
+            self._journal.truncate(self._usable)
+        return self._journal
+
+    @staticmethod
+    def key(md5: str) -> bytes:
+        return bytes.fromhex(md5)
+
+    def _open(self) -> None:
+        if self._map is not None:
+            self._map.close()
+        self._map, self._count = None, 0
+        if self._sortedPath.is_file() and self._sortedPath.stat().st_size:
+            with self._sortedPath.open("rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._count = len(self._map) // RECORD.size
+
+    def _search(self, digest: bytes) -> Optional[Location_T]:
+        sortedMap, low, high = self._map, 0, self._count
+        if sortedMap is None:
+            return None
+        while low < high:
+            middle = (low + high) // 2
+            position = middle * RECORD.size
+            current = sortedMap[position : position + 16]
+            if current < digest:
+                low = middle + 1
+            elif current > digest:
+                high = middle
+            else:
+                _, *location = RECORD.unpack_from(sortedMap, position)
+                return tuple(location)  # type: ignore
+        return None
+
+    def get(self, md5: str) -> Optional[Location_T]:
+        digest = self.key(md5)
+        with self._lock:
+            location = self._recent.get(digest)
+            return location if location is not None else self._search(digest)
+
+    def __contains__(self, md5: str) -> bool:
+        return self.get(md5) is not None
+
+    def put(self, md5: str, segment: int, offset: int, length: int) -> None:
+        digest = self.key(md5)
+        with self._lock:
+            journal = self._writer()
+            journal.write(RECORD.pack(digest, segment, offset, length))
+            journal.flush()
+            self._recent[digest] = (segment, offset, length)
+            if len(self._recent) >= MERGE_THRESHOLD:
+                self.merge()
+
+    def _sorted(self) -> Iterator[Tuple[bytes, int, int, int]]:
+        if self._map is not None:
+            yield from RECORD.iter_unpack(self._map)  # type: ignore
+
+    def items(self) -> Iterator[Tuple[str, Location_T]]:
+        with self._lock:
+            for digest, segment, offset, length in self._sorted():
+                if digest not in self._recent:
+                    yield digest.hex(), (segment, offset, length)
+            for digest, location in [*self._recent.items()]:
+                yield digest.hex(), location
+
+    def _replace(self, records: Iterable[Tuple[bytes, int, int, int]]) -> None:
+        temporary = self._sortedPath.with_suffix(".tmp")
+        with temporary.open("wb") as f:
+            for record in records:
+                f.write(RECORD.pack(*record))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.replace(temporary, self._sortedPath)
+        self._writer().truncate(0)
+        self._recent.clear()
+        self._open()
+
+    def rewrite(self, records: Iterable[Tuple[str, Location_T]]) -> None:
+        with self._lock:
+            self._replace(
+                sorted((self.key(md5), *location) for md5, location in records)
+            )
+
+    def merge(self) -> None:
+        with self._lock:
+            if not self._recent:
+                return
+            recent = sorted((digest, *i) for digest, i in self._recent.items())
+            existing = (i for i in self._sorted() if i[0] not in self._recent)
+            self._replace(heapMerge(existing, recent))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count + sum(
+                1 for i in self._recent if self._search(i) is None
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if self._map is not None:
+                self._map.close()
+                self._map = None
@@ -1,45 +1,116 @@
-import json
+import os
 from pathlib import Path
-from shutil import move as moveFile
-from typing import Any, Dict
+from time import time
+from typing import Collection, List, Set, Tuple
 
 from ..config import Config
 from ..log import logger
 from ..spider.models import ImageDownload
-from ..utils import AsyncOpen, SyncToAsync
+from ..tracing import mark
+from ..utils import PartialFile, SyncToAsync
+from .metadata import MetadataStore, encodeRecords
+from .space import Space
+from .storage import IMAGE_PATH, StorageBackend, getStorage, storageFor
 
-IMAGE_PATH = Path(".") / "data" / "images"
-HASH_DEPTH: int = Config["persistence"]["path-depth"].as_number()
+STAGING_PATH = IMAGE_PATH / ".staging"
+StagingConfig = Config["persistence"]["staging"]
+SpaceConfig = Config["persistence"]["space"]
 
 IMAGE_PATH.mkdir(parents=True, exist_ok=True)
+STAGING_PATH.mkdir(parents=True, exist_ok=True)
 
 
 class Persistence:
+    metadata = MetadataStore()
+    storage: StorageBackend = getStorage()
+    # Digests of finished downloads whose staged files wait to be saved
+    pending: Set[str] = set()
+
     @staticmethod
     def verify(image: ImageDownload) -> bool:
         assert image.md5
         return image.data.imageMD5.lower() == image.md5.lower()
 
     @staticmethod
-    @SyncToAsync
-    def _dump(data: Dict[str, Any]) -> str:
-        return json.dumps(data, sort_keys=True, indent=4, ensure_ascii=False)
+    def stage(md5: str) -> PartialFile:
+        return PartialFile(md5.lower(), folder=str(STAGING_PATH))
+
+    @classmethod
+    def hold(cls, image: ImageDownload) -> None:
+        """Keep the staged file of ``image`` from the janitor until it has
+        been saved or discarded."""
+        cls.pending.add(image.data.imageMD5.lower())
+
+    @classmethod
+    def release(cls, image: ImageDownload) -> None:
+        cls.pending.discard(image.data.imageMD5.lower())
+
+    @classmethod
+    async def discard(cls, image: ImageDownload) -> None:
+        try:
+            await SyncToAsync(Path(image.path).unlink)(missing_ok=True)
+        finally:
+            cls.release(image)
+        logger.trace(f"Staged file {image.path} of picture {image.data.id} discarded.")
+
+    @classmethod
+    async def save(cls, image: ImageDownload) -> str:
+        try:
+            locator = await cls.storage.storeAsync(
+                Path(image.path), image.md5, image.data.imageExt
+            )
+        finally:
+            cls.release(image)
+        mark(image, "stored")
+        Space.stored(image.size)
+        record = await encodeRecords((image.md5, image.data))
+        await cls.metadata.appendAsync(image.md5, record)
+        mark(image, "described")
+        logger.trace(f"Picture {image.data.id} has been successfully saved to {locator}")
+        return locator
 
     @staticmethod
-    @SyncToAsync
-    def _move(source: Path, destination: Path) -> None:
-        moveFile(str(source), str(destination))
+    async def read(locator: str) -> bytes:
+        return await storageFor(locator).readAsync(locator)
 
     @classmethod
-    async def save(cls, image: ImageDownload) -> Path:
-        folder = IMAGE_PATH / ("/".join(image.md5[:HASH_DEPTH]))
-        folder.mkdir(parents=True, exist_ok=True)
-        filePath = folder / f"{image.md5}.{image.data.imageExt}"
-        metadataPath = folder / f"{image.md5}.json"
-        await cls._move(image.path, filePath)
-        async with AsyncOpen(metadataPath, "wt", encoding="utf-8") as f:
-            await f.write(await cls._dump(image.data.dict()))
-        logger.trace(
-            f"Picture {image.data.id} has been successfully saved to path {filePath}"
-        )
-        return filePath
+    async def janitor(cls, active: Collection[str] = ()) -> int:
+        """Remove stale leftovers from the staging area.
+
+        Files untouched for ``max-age`` seconds are removed, then the oldest
+        remaining ones until the area fits into ``max-size`` bytes. Files of
+        digests in ``active`` and of ``pending`` downloads are never touched.
+        """
+        # Copied on the event loop, where the sets are changed
+        return await cls._janitor(frozenset({*active, *cls.pending}))
+
+    @staticmethod
+    @SyncToAsync
+    def _janitor(active: Collection[str]) -> int:
+        maxAge: float = StagingConfig["max-age"].as_number()
+        maxSize: int = StagingConfig["max-size"].as_number()
+        entries: List[Tuple[float, int, Path]] = []
+        for entry in os.scandir(STAGING_PATH):
+            if not entry.is_file() or entry.name.split(".", 1)[0] in active:
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        entries.sort()
+        totalSize, freedSize = sum(size for _, size, _ in entries), 0
+        for modifyTime, size, path in entries:
+            if modifyTime > time() - maxAge and totalSize <= maxSize:
+                break
+            path.unlink(missing_ok=True)
+            totalSize, freedSize = totalSize - size, freedSize + size
+        if freedSize:
+            logger.info(f"Staging area cleaned up, {freedSize} bytes freed.")
+        return freedSize
+
+
+Space.watch(
+    "store",
+    Persistence.storage.root,
+    SpaceConfig["store-quota"].as_number(),
+    measure=Persistence.storage.usage,
+)
+Space.watch("staging", STAGING_PATH, SpaceConfig["staging-quota"].as_number())
@@ -1,17 +1,62 @@
 import asyncio
-from typing import List, Optional
+from typing import Iterable, List, Optional, Set
 
 from ..exceptions import DatabaseException
 from ..log import logger
 from ..spider.models import ImageDownload
+from ..tracing import Trace
 from . import database
 from .database import models
+from .index import ImageHashIndex
+from .jobs import JobQueue
+from .similar import NearDuplicates
+from .tagindex import TagIndex
+from .writer import DatabaseWriter
 
 
 class DatabaseServices:
     pictures = database.Pictures()
     tags = database.Tags()
     tagsrelations = database.TagsRelation()
+    checkpoints = database.Checkpoints()
+    jobs = JobQueue(database.Jobs())
+    similar = NearDuplicates(database.PictureHashes())
+    hashIndex = ImageHashIndex()
+    tagIndex = TagIndex()
+    writer = DatabaseWriter(pictures, hashIndex, tagIndex)
+
+    @classmethod
+    async def loadHashIndex(cls) -> int:
+        return await cls.hashIndex.load(cls.pictures)
+
+    @classmethod
+    async def loadTagIndex(cls, rebuild: bool = False) -> int:
+        count = await cls.tagIndex.load(
+            cls.pictures, cls.tags, cls.tagsrelations, rebuild
+        )
+        # Near-duplicates merged into another picture may have lost their file
+        cls.tagIndex.hide(await cls.similar.collapsed())
+        return count
+
+    @classmethod
+    async def searchImages(
+        cls, expression: str, limit: Optional[int] = None, offset: int = 0
+    ) -> List[models.PicturesRead]:
+        """Stored pictures matching a filter expression, newest first."""
+        if not cls.tagIndex.loaded:
+            await cls.loadTagIndex()
+        pids = cls.tagIndex.select(expression).page(offset, limit, newest=True)
+        pictures = {i.pid: i for i in await cls.pictures.readMany(pids)}
+        return [pictures[i] for i in pids if i in pictures]
+
+    @classmethod
+    async def checkImagesExist(cls, hashes: Iterable[str]) -> Set[str]:
+        hashes = [*hashes]
+        if cls.hashIndex.loaded:
+            return cls.hashIndex.exists(hashes)
+        existHashes = await cls.pictures.exists(hashes) if hashes else []
+        lowerHashes = {md5.lower() for md5 in existHashes}
+        return {md5 for md5 in hashes if md5.lower() in lowerHashes}
 
     @classmethod
     async def checkImageExist(cls, md5: str) -> Optional[models.PicturesRead]:
@@ -21,36 +66,42 @@ class DatabaseServices:
             return None
 
     @classmethod
-    async def createImage(cls, data: ImageDownload) -> None:
+    async def createImage(cls, data: ImageDownload, locator: str) -> asyncio.Future:
         assert data.data is not None
-        if await cls.checkImageExist(data.md5):
-            return
-        pictureData: models.PicturesRead = await cls.pictures.create(
-            models.PicturesCreate(
-                **{
-                    "md5": data.data.imageMD5,
-                    "locale_path": str(data.path),
-                    "rating": data.data.rating.lower(),
-                    "source": data.data.source,
-                    "source_id": data.data.id,
-                    "source_url": data.data.imageURL,
-                }
-            )
-        )
-        await cls.tags.create(
-            [*map(lambda x: models.TagsCreate(**{"name": x}), data.data.tags)]
+        ingest = models.PicturesIngest(
+            **{
+                "md5": data.data.imageMD5,
+                "locale_path": locator,
+                "rating": data.data.rating.lower(),
+                "source": data.data.source,
+                "source_id": data.data.id,
+                "source_url": data.data.imageURL,
+                "tags": data.data.tags,
+            }
         )
-        tagsData: List[models.TagsRead] = await asyncio.gather(
-            *map(lambda x: cls.tags.read(name=x), data.data.tags)
-        )
-        await cls.tagsrelations.create(
-            [
-                *map(
-                    lambda x: models.TagsRelationCreate(
-                        **{"pid": pictureData.pid, "tid": x}
-                    ),
-                    [i.tid for i in tagsData],
-                )
-            ]
+        Trace.carry(data, ingest)
+        committed = await cls.writer.put(ingest)
+        committed.add_done_callback(
+            lambda future: data.data.finish(
+                failed=future.cancelled() or not future.result()
+            )
         )
-        logger.trace(f"Data of image {data.data!r} has been stored to database.")
+        logger.trace(f"Data of image {data.data!r} has been queued for storing.")
+        return committed
+
+    @classmethod
+    async def flush(cls) -> None:
+        await cls.writer.flush()
+
+    @classmethod
+    async def readCheckpoint(cls, name: str) -> Optional[models.CheckpointsRead]:
+        try:
+            return await cls.checkpoints.read(name)
+        except DatabaseException:
+            return None
+
+    @classmethod
+    async def updateCheckpoint(
+        cls, data: models.CheckpointsCreate
+    ) -> models.CheckpointsRead:
+        return await cls.checkpoints.update(data)
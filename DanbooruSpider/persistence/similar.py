@@ -0,0 +1,236 @@
+import asyncio
+from array import array
+from io import BytesIO
+from itertools import combinations
+from typing import Dict, Iterator, List, NoReturn, Optional, Set, Tuple
+
+from ..config import Config
+from ..exceptions import DanbooruException, DatabaseException
+from ..log import logger
+from ..utils import SyncToProcess
+from .database import PictureHashes, models
+from .persistence import Persistence
+
+try:
+    from PIL import Image
+except ImportError:  # only needed once near-duplicate detection is enabled
+    Image = None
+
+SimilarConfig = Config["persistence"]["similar"]
+HASH_SIZE = 8
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+Hash_T = Tuple[int, int, int]
+
+
+def dHash(data: bytes) -> Hash_T:
+    """64 bit difference hash of a picture along with its width and height.
+
+    The picture is shrunk to 9x8 grey pixels and every bit tells whether a
+    pixel is brighter than its right neighbour, which survives re-encoding
+    and resizing. JPEGs are decoded at a reduced scale right away.
+    """
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+        image.draft("L", (HASH_SIZE * 4, HASH_SIZE * 4))
+        pixels = [
+            *image.convert("L")
+            .resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+            .getdata()
+        ]
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + column
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value, width, height
+
+
+@SyncToProcess
+def hashPicture(data: bytes) -> Optional[Hash_T]:
+    """``dHash`` of a picture, ``None`` if it is no picture Pillow can read,
+    e.g. a video."""
+    try:
+        return dHash(data)
+    except Exception:
+        return None
+
+
+def distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+def _flips(bits: int) -> List[int]:
+    """XOR masks of a chunk with up to ``bits`` bits set."""
+    return [
+        sum(1 << i for i in positions)
+        for count in range(bits + 1)
+        for positions in combinations(range(CHUNK_BITS), count)
+    ]
+
+
+class HammingIndex:
+    """Multi-index hashing of 64 bit hashes for Hamming radius queries.
+
+    Hashes are split into ``CHUNKS`` chunks with a table each. Two hashes
+    differing in at most ``radius`` bits differ in at most
+    ``radius // CHUNKS`` bits in one of their chunks, so only those buckets
+    of the tables need to be looked at.
+    """
+
+    def __init__(self) -> None:
+        self.pids: array = array("q")
+        self.hashes: array = array("Q")
+        self.pixels: array = array("Q")
+        self._tables: List[Dict[int, List[int]]] = [{} for _ in range(CHUNKS)]
+        self._flips: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.pids)
+
+    def add(self, pid: int, phash: int, pixels: int) -> None:
+        position = len(self.pids)
+        self.pids.append(pid)
+        self.hashes.append(phash)
+        self.pixels.append(pixels)
+        for index, table in enumerate(self._tables):
+            chunk = phash >> (index * CHUNK_BITS) & CHUNK_MASK
+            table.setdefault(chunk, []).append(position)
+
+    def query(self, phash: int, radius: int) -> Iterator[Tuple[int, int]]:
+        """Positions and distances of the hashes within ``radius`` bits."""
+        bits = radius // CHUNKS
+        if bits not in self._flips:
+            self._flips[bits] = _flips(bits)
+        seen: Set[int] = set()
+        for index, table in enumerate(self._tables):
+            chunk = phash >> (index * CHUNK_BITS) & CHUNK_MASK
+            for flip in self._flips[bits]:
+                for position in table.get(chunk ^ flip, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    difference = distance(phash, self.hashes[position])
+                    if difference <= radius:
+                        yield position, difference
+
+
+class NearDuplicates:
+    """Perceptual hashes of stored pictures and their near-duplicates.
+
+    Stored pictures are hashed in the background by the process pool, the
+    hashes are kept in the database and in a ``HammingIndex``. A cluster is
+    the largest picture of a group and all others within ``radius`` bits of
+    it, which ``collapse`` merges into that picture.
+    """
+
+    def __init__(self, access: PictureHashes) -> None:
+        self._access = access
+        self.enabled: bool = SimilarConfig["enabled"].get(bool)
+        self.radius: int = SimilarConfig["radius"].as_number()
+        self.index = HammingIndex()
+        self.loaded = False
+
+    @property
+    def skipping(self) -> bool:
+        """Whether downloads covered by a stored near-duplicate are skipped."""
+        return self.loaded and SimilarConfig["skip-downloads"].get(bool)
+
+    async def load(self) -> int:
+        if Image is None:
+            raise DanbooruException(
+                "Near-duplicate detection needs Pillow, install it with "
+                + "'pip install Pillow' or disable persistence.similar."
+            )
+        self.index = HammingIndex()
+        for pid, phash, pixels in await self._access.entries():
+            self.index.add(pid, phash, pixels)
+        self.loaded = True
+        logger.info(f"Perceptual hash index loaded with {len(self.index)} pictures.")
+        return len(self.index)
+
+    async def _hash(
+        self, picture: models.PicturesRead, limiter: asyncio.Semaphore
+    ) -> models.PictureHashesCreate:
+        async with limiter:
+            try:
+                data = await Persistence.read(picture.locale_path)
+                hashed = await hashPicture(data)
+            except OSError as e:
+                logger.warning(f"Picture {picture.md5} could not be read: {e}")
+                hashed = None
+        if hashed is None:
+            return models.PictureHashesCreate(pid=picture.pid)
+        phash, width, height = hashed
+        return models.PictureHashesCreate(
+            pid=picture.pid, phash=phash, width=width, height=height
+        )
+
+    async def hashPending(self, limit: Optional[int] = None) -> int:
+        """Hash up to ``limit`` stored pictures which have no hash yet."""
+        limit = limit or SimilarConfig["batch-size"].as_number()
+        pictures = await self._access.unhashed(limit)
+        limiter = asyncio.Semaphore(SimilarConfig["workers"].as_number())
+        hashes = await asyncio.gather(*[self._hash(i, limiter) for i in pictures])
+        await self._access.createMany(hashes)
+        if self.loaded:
+            for i in hashes:
+                if i.phash is not None:
+                    self.index.add(i.pid, i.phash, (i.width or 0) * (i.height or 0))
+        return len(hashes)
+
+    async def hasher(self) -> NoReturn:
+        """Keep hashing newly stored pictures."""
+        while True:
+            try:
+                while await self.hashPending():
+                    pass
+            except DatabaseException:
+                logger.exception("Failed to store perceptual hashes:")
+            await asyncio.sleep(SimilarConfig["interval"].as_number())
+
+    def covering(self, phash: int, pixels: int) -> Optional[int]:
+        """A stored near-duplicate with at least ``pixels`` pixels, if any."""
+        for position, _ in self.index.query(phash, self.radius):
+            if self.index.pixels[position] >= pixels:
+                return self.index.pids[position]
+        return None
+
+    def clusters(self, radius: Optional[int] = None) -> List[List[int]]:
+        """Groups of near-duplicate pictures, largest picture first.
+
+        The largest pictures not grouped yet take all other ungrouped ones
+        within ``radius`` bits of themselves, so every picture of a group is
+        similar to the first one and similarity is never chained.
+        """
+        radius = self.radius if radius is None else radius
+        index = self.index
+        grouped = [False] * len(index)
+        groups: List[List[int]] = []
+        for keeper in sorted(
+            range(len(index)), key=lambda i: (-index.pixels[i], index.pids[i])
+        ):
+            if grouped[keeper]:
+                continue
+            grouped[keeper] = True
+            members = [
+                position
+                for position, _ in index.query(index.hashes[keeper], radius)
+                if not grouped[position]
+            ]
+            if not members:
+                continue
+            for position in members:
+                grouped[position] = True
+            members.sort(key=lambda i: (-index.pixels[i], index.pids[i]))
+            groups.append([index.pids[i] for i in [keeper, *members]])
+        return groups
+
+    async def collapse(self, cluster: List[int]) -> None:
+        keeper, *duplicates = cluster
+        await self._access.collapse(keeper, duplicates)
+
+    async def collapsed(self) -> List[int]:
+        return await self._access.collapsed()
@@ -0,0 +1,193 @@
+import asyncio
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from shutil import disk_usage
+from time import monotonic
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from ..config import Config
+from ..exceptions import SpiderException
+from ..log import logger
+from ..utils import SyncToAsync
+
+SpaceConfig = Config["persistence"]["space"]
+
+
+class _Area:
+    __slots__ = ("name", "path", "quota", "measure", "usage")
+
+    def __init__(
+        self, name: str, path: Path, quota: int, measure: Optional[Callable[[], int]]
+    ) -> None:
+        self.name = name
+        self.path = path
+        self.quota = quota
+        self.measure = measure
+        self.usage = 0
+
+    def current(self) -> int:
+        if self.measure is not None:
+            return self.usage
+        return sum(i.stat().st_size for i in os.scandir(self.path) if i.is_file())
+
+
+class SpaceManager:
+    """Admission control of downloads by disk space.
+
+    A download reserves its expected size before asking for a slot. The
+    reservation is granted while every area stays within its quota and
+    leaves ``free-space`` bytes free on its disk, otherwise it waits until
+    space frees up again. Only new reservations wait, downloads holding one
+    keep going. Disks and quotas are measured on a worker thread at most
+    once per ``interval``, reservations are checked against that measurement.
+    """
+
+    def __init__(self, floor: Optional[int] = None) -> None:
+        self._floor: int = (
+            SpaceConfig["free-space"].as_number() if floor is None else floor
+        )
+        self._interval: float = SpaceConfig["interval"].as_number()
+        self.defaultSize: int = SpaceConfig["default-size"].as_number()
+        self._areas: List[_Area] = []
+        self._reserved = 0
+        self._available = 0
+        self._measured: Optional[float] = None
+        self._exhausted = False
+        self._holding = False
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._poller: Optional[asyncio.Task] = None
+        self._refresher: Optional[asyncio.Task] = None
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def watch(
+        self,
+        name: str,
+        path: Path,
+        quota: int = 0,
+        measure: Optional[Callable[[], int]] = None,
+    ) -> None:
+        """Watch the disk and quota of ``path``.
+
+        Usage of areas with a ``measure`` function and a quota is measured
+        once by ``load`` and then tracked through ``stored``, other areas
+        are scanned whenever their quota is checked.
+        """
+        self._areas.append(_Area(name, path, quota, measure))
+
+    def headroom(self) -> int:
+        """Bytes which can still be reserved as of the last measurement,
+        counting current reservations."""
+        return self._available - self._reserved
+
+    def _measure(self) -> None:
+        devices: Dict[int, Path] = {}
+        for area in self._areas:
+            devices.setdefault(os.stat(area.path).st_dev, area.path)
+        available = [disk_usage(i).free - self._floor for i in devices.values()]
+        available += [i.quota - i.current() for i in self._areas if i.quota > 0]
+        self._available = min(available, default=0)
+        self._measured = monotonic()
+
+    async def _refresh(self) -> None:
+        await SyncToAsync(self._measure)()
+        self._dispatch()
+
+    def _admit(self, size: int) -> bool:
+        if self._measured is None or monotonic() - self._measured > self._interval:
+            if self._refresher is None or self._refresher.done():
+                self._refresher = asyncio.create_task(self._refresh())
+        if self._exhausted or self._measured is None or self.headroom() < size:
+            return False
+        self._reserved += size
+        return True
+
+    async def reserve(self, size: int) -> None:
+        for area in self._areas:
+            if 0 < area.quota < size:
+                raise SpiderException(
+                    f"Picture of {size} bytes can never fit into {area.name} quota."
+                )
+        if not self._waiters and self._admit(size):
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        if not self._waiters:
+            self._block()
+        self._waiters.append((size, waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(size)
+            raise
+
+    def release(self, size: int) -> None:
+        # Until the next measurement the bytes are taken to be on disk now
+        self._reserved -= size
+        self._available -= size
+        self._dispatch()
+
+    @asynccontextmanager
+    async def reservation(self, size: Optional[int]) -> AsyncIterator[None]:
+        size = size or self.defaultSize
+        await self.reserve(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def exhausted(self) -> None:
+        """Stop admitting downloads until a check finds free space again."""
+        if not (self._exhausted or self._waiters):
+            self._block()
+        self._exhausted = True
+
+    def stored(self, size: int) -> None:
+        for area in self._areas:
+            if area.measure is not None:
+                area.usage += size
+
+    def _block(self) -> None:
+        if self._measured is not None and not self._holding:
+            self._holding = True
+            logger.warning(
+                f"Disk space is running out ({self.headroom()} bytes of headroom), "
+                + "new downloads are held back."
+            )
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+
+    def _dispatch(self) -> None:
+        while self._waiters:
+            size, waiter = self._waiters[0]
+            if not waiter.done() and not self._admit(size):
+                break
+            self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+        if self._holding and not (self._waiters or self._exhausted):
+            self._holding = False
+            logger.info("Disk space is available again, downloads are resumed.")
+
+    async def _poll(self) -> None:
+        while self._exhausted or self._waiters:
+            await asyncio.sleep(self._interval)
+            self._exhausted = False
+            await self._refresh()
+            if self._waiters:
+                logger.debug(f"{len(self._waiters)} downloads waiting for disk space.")
+
+    @SyncToAsync
+    def load(self) -> None:
+        for area in self._areas:
+            if area.measure is not None and area.quota > 0:
+                area.usage = area.measure()
+                logger.debug(f"Area {area.name} takes {area.usage} bytes.")
+        self._measure()
+
+
+Space = SpaceManager()
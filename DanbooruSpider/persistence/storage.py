@@ -0,0 +1,254 @@
+import os
+import tarfile
+from errno import EXDEV
+from pathlib import Path
+from shutil import copyfileobj
+from shutil import move as moveFile
+from threading import RLock
+from time import time
+from typing import BinaryIO, Dict, List, Optional, Tuple, Type
+
+from ..config import Config
+from ..exceptions import NotImplementedException
+from ..log import logger
+from ..utils import STREAM_BUFFER_SIZE, SyncToAsync
+from .offsets import OffsetIndex
+
+IMAGE_PATH = Path(".") / "data" / "images"
+SHARD_PATH = Path(".") / "data" / "shards"
+HASH_DEPTH: int = Config["persistence"]["path-depth"].as_number()
+StorageConfig = Config["persistence"]["storage"]
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+END_OF_ARCHIVE = bytes(BLOCK_SIZE * 2)
+
+
+class StorageBackend:
+    """Where picture files end up once downloaded and verified.
+
+    ``store`` takes ownership of a staged file and returns a locator string
+    which is kept in ``pictures.locale_path`` and accepted by ``read``.
+    """
+
+    name: str = ""
+    root: Path
+
+    def store(self, source: Path, md5: str, ext: str) -> str:
+        raise NotImplementedException
+
+    def read(self, locator: str) -> bytes:
+        raise NotImplementedException
+
+    def remove(self, locator: str) -> None:
+        raise NotImplementedException
+
+    def usage(self) -> int:
+        """Bytes taken by stored pictures, may walk the whole store."""
+        raise NotImplementedException
+
+    def close(self) -> None:
+        pass
+
+    @SyncToAsync
+    def storeAsync(self, source: Path, md5: str, ext: str) -> str:
+        return self.store(source, md5, ext)
+
+    @SyncToAsync
+    def readAsync(self, locator: str) -> bytes:
+        return self.read(locator)
+
+
+class TreeStorage(StorageBackend):
+    """One file per picture, fanned out by the leading MD5 characters.
+
+    Locators are plain relative paths, the same as stored before storage
+    backends existed.
+    """
+
+    name = "tree"
+
+    def __init__(self, root: Optional[Path] = None, depth: int = HASH_DEPTH) -> None:
+        self.root = root or IMAGE_PATH
+        self._depth = depth
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def locate(self, md5: str, ext: str) -> Path:
+        md5 = md5.lower()
+        return self.root / ("/".join(md5[: self._depth])) / f"{md5}.{ext}"
+
+    def store(self, source: Path, md5: str, ext: str) -> str:
+        destination = self.locate(md5, ext)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(source, destination)
+        except OSError as e:
+            if e.errno != EXDEV:
+                raise
+            moveFile(str(source), str(destination))
+        return str(destination)
+
+    def read(self, locator: str) -> bytes:
+        return Path(locator).read_bytes()
+
+    def remove(self, locator: str) -> None:
+        Path(locator).unlink(missing_ok=True)
+
+    def usage(self) -> int:
+        total = 0
+        for folder, folders, files in os.walk(self.root):
+            folders[:] = [i for i in folders if not i.startswith(".")]
+            total += sum(os.stat(os.path.join(folder, i)).st_size for i in files)
+        return total
+
+
+class ShardStorage(StorageBackend):
+    """Pictures appended to large tar-compatible shard files.
+
+    Every picture becomes a tar member named ``<md5>.<ext>``, and the open
+    shard always ends with an end-of-archive marker which the next picture
+    overwrites, so any shard can be listed or extracted with ``tar``. Data
+    offsets are kept in an ``OffsetIndex`` keyed by MD5. Locators look like
+    ``shard://000001/<md5>.<ext>``.
+    """
+
+    name = "shards"
+    prefix = "shard://"
+
+    def __init__(
+        self, folder: Optional[Path] = None, shardSize: Optional[int] = None
+    ) -> None:
+        self.root = folder or SHARD_PATH
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._shardSize: int = shardSize or StorageConfig["shard-size"].as_number()
+        self._lock = RLock()
+        self.index = OffsetIndex(self.root)
+        shards = self.shards()
+        self._shard = shards[-1] if shards else 1
+        self._file: Optional[BinaryIO] = None
+        self._position = 0
+
+    def _path(self, shard: int) -> Path:
+        return self.root / f"shard-{shard:06d}.tar"
+
+    def _open(self, shard: int) -> BinaryIO:
+        path = self._path(shard)
+        path.touch(exist_ok=True)
+        return path.open("r+b")
+
+    def shards(self) -> List[int]:
+        return sorted(
+            int(i.stem.split("-")[1]) for i in self.root.glob("shard-*.tar")
+        )
+
+    def _writable(self) -> BinaryIO:
+        """Open the last shard for appending, on the first store only so
+        that processes which merely read pictures never touch it."""
+        if self._file is None:
+            self._file = self._open(self._shard)
+            position = self._end()
+            if position is None:
+                logger.warning(
+                    f"Shard {self._shard} is not properly terminated, sealed."
+                )
+                self._roll()
+            else:
+                self._position = position
+        return self._file
+
+    def _end(self) -> Optional[int]:
+        assert self._file is not None
+        size = self._file.seek(0, os.SEEK_END)
+        if not size:
+            return 0
+        if size < len(END_OF_ARCHIVE):
+            return None
+        self._file.seek(size - len(END_OF_ARCHIVE))
+        if self._file.read(len(END_OF_ARCHIVE)) != END_OF_ARCHIVE:
+            return None
+        return size - len(END_OF_ARCHIVE)
+
+    def _roll(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._shard += 1
+        self._file = self._open(self._shard)
+        self._position = 0
+        logger.debug(f"Image shard {self._shard} opened.")
+
+    def locator(self, shard: int, md5: str, ext: str) -> str:
+        return f"{self.prefix}{shard:06d}/{md5}.{ext}"
+
+    def _parse(self, locator: str) -> Tuple[int, str]:
+        assert locator.startswith(self.prefix)
+        shard, name = locator[len(self.prefix) :].split("/", 1)
+        return int(shard), name.split(".", 1)[0]
+
+    def store(self, source: Path, md5: str, ext: str) -> str:
+        md5 = md5.lower()
+        with self._lock:
+            location = self.index.get(md5)
+            if location is None:
+                self._writable()
+                size = source.stat().st_size
+                if self._position and self._position + size > self._shardSize:
+                    self._roll()
+                location = self._append(source, f"{md5}.{ext}", size)
+                self.index.put(md5, *location)
+        source.unlink(missing_ok=True)
+        return self.locator(location[0], md5, ext)
+
+    def _append(self, source: Path, name: str, size: int) -> Tuple[int, int, int]:
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime, info.mode = size, int(time()), 0o644
+        file = self._writable()
+        file.seek(self._position)
+        file.write(info.tobuf(format=tarfile.USTAR_FORMAT))
+        offset = file.tell()
+        with source.open("rb") as f:
+            copyfileobj(f, file, STREAM_BUFFER_SIZE)
+        file.write(bytes(-size % BLOCK_SIZE))
+        position = file.tell()
+        file.write(END_OF_ARCHIVE)
+        file.flush()
+        self._position = position
+        return self._shard, offset, size
+
+    def read(self, locator: str) -> bytes:
+        shard, md5 = self._parse(locator)
+        location = self.index.get(md5)
+        if location is None or location[0] != shard:
+            raise FileNotFoundError(f"Picture {locator!r} is not in the shards.")
+        _, offset, length = location
+        with self._path(shard).open("rb") as f:
+            return os.pread(f.fileno(), length, offset)
+
+    def usage(self) -> int:
+        return sum(self._path(i).stat().st_size for i in self.shards())
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.index.close()
+
+
+STORAGE_BACKENDS: Dict[str, Type[StorageBackend]] = {
+    TreeStorage.name: TreeStorage,
+    ShardStorage.name: ShardStorage,
+}
+_storages: Dict[str, StorageBackend] = {}
+
+
+def getStorage(name: Optional[str] = None) -> StorageBackend:
+    name = name or StorageConfig["backend"].as_str()
+    assert name in STORAGE_BACKENDS, f"Unknown storage backend {name!r}."
+    if name not in _storages:
+        _storages[name] = STORAGE_BACKENDS[name]()
+    return _storages[name]
+
+
+def storageFor(locator: str) -> StorageBackend:
+    if locator.startswith(ShardStorage.prefix):
+        return getStorage(ShardStorage.name)
+    return getStorage(TreeStorage.name)
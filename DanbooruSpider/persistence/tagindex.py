@@ -0,0 +1,426 @@
+import asyncio
+import operator
+import os
+import pickle
+import re
+from array import array
+from functools import reduce
+from heapq import nlargest
+from itertools import islice
+from pathlib import Path
+from threading import Lock as threadLock
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from sqlalchemy import func
+
+from ..config import Config
+from ..exceptions import NotImplementedException
+from ..log import logger
+from ..spider.filters import PostFilter
+from ..utils import SyncToAsync
+from .database import models
+from .database.access import (
+    PicturesAccess,
+    TagsAccess,
+    TagsRelationAccess,
+    chunks,
+    processDatabaseAccess,
+)
+
+TagIndexConfig = Config["persistence"]["tag-index"]
+SNAPSHOT_PATH = Path(".") / "data" / "tagindex"
+SNAPSHOT_VERSION = 1
+LOAD_BATCH_SIZE = 10000
+# A bitmap takes a bit for every picture, an array four bytes for each of its
+# pictures, so a posting list becomes a bitmap once it holds 1/32 of them
+DENSE_RATIO = 32
+FACETS = ("rating", "source", "ext")
+
+Posting_T = Union[array, int]
+Postings_T = Dict[str, List[int]]
+Facets_T = Dict[Tuple[str, str], List[int]]
+
+_NONZERO = re.compile(rb"[^\x00]")
+_BITS = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+
+try:
+    _popcount = int.bit_count  # Python 3.10+
+except AttributeError:
+
+    def _popcount(value: int) -> int:
+        return bin(value).count("1")
+
+
+def bitmap(pids: Sequence[int]) -> int:
+    """Bitmap with the bits of ``pids`` set."""
+    if not len(pids):
+        return 0
+    buffer = bytearray((max(pids) >> 3) + 1)
+    for pid in pids:
+        buffer[pid >> 3] |= 1 << (pid & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def _ext(locator: str) -> str:
+    return locator.rsplit(".", 1)[-1].lower() if "." in locator else ""
+
+
+class Selection:
+    """Pictures matched by a query, as a bitmap of their pids."""
+
+    __slots__ = ("bits", "_count")
+
+    def __init__(self, bits: int) -> None:
+        self.bits = bits
+        self._count: Optional[int] = None
+
+    def __len__(self) -> int:
+        if self._count is None:
+            self._count = _popcount(self.bits)
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        return self.pids()
+
+    def pids(self, newest: bool = False) -> Iterator[int]:
+        """Matched pids in ascending order, or descending with ``newest``."""
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")
+        if not newest:
+            for match in _NONZERO.finditer(data):
+                position = match.start()
+                for bit in _BITS[data[position]]:
+                    yield position << 3 | bit
+            return
+        last = len(data) - 1
+        for match in _NONZERO.finditer(data[::-1]):
+            position = last - match.start()
+            for bit in reversed(_BITS[data[position]]):
+                yield position << 3 | bit
+
+    def page(
+        self, offset: int = 0, limit: Optional[int] = None, newest: bool = False
+    ) -> List[int]:
+        stop = None if limit is None else offset + limit
+        return [*islice(self.pids(newest), offset, stop)]
+
+
+class TagIndex:
+    """Posting lists of the pictures of every tag, kept in memory.
+
+    A posting list is a sorted ``array`` of pids while the tag is rare and
+    becomes a bitmap, a Python integer with one bit per pid, once that is
+    smaller. Ratings, sources and file extensions are kept as bitmaps too.
+    Queries use the filter expressions of the spiders and are evaluated by
+    bitwise operations, rare tags are turned into bitmaps on the fly.
+    Hidden pictures are left out of their results.
+
+    The index is snapshotted to disk and catches up with pictures stored
+    since by their pid, it is rebuilt from the database whenever the
+    snapshot does not add up with it anymore.
+    """
+
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self._path = path or SNAPSHOT_PATH
+        self._lock = threadLock()
+        self._hidden = 0
+        self._clear()
+        self._dirty = False
+        self.loaded = False
+
+    def _clear(self) -> None:
+        self._postings: Dict[str, Posting_T] = {}
+        self._sizes: Dict[str, int] = {}
+        self._facets: Dict[str, Dict[str, int]] = {i: {} for i in FACETS}
+        self._all = 0
+        self.highest = 0
+        self.pictures = 0
+        self.relations = 0
+
+    def __len__(self) -> int:
+        return self.pictures
+
+    def _extend(self, name: str, pids: List[int]) -> None:
+        """Append ``pids``, all higher than those indexed, to a posting list."""
+        posting = self._postings.get(name)
+        if isinstance(posting, int):
+            self._postings[name] = posting | bitmap(pids)
+            self._sizes[name] += len(pids)
+        elif posting is None:
+            self._postings[name] = array("I", pids)
+        else:
+            posting.extend(pids)
+
+    def _densify(self, names: Iterable[str]) -> None:
+        for name in names:
+            posting = self._postings[name]
+            if isinstance(posting, int):
+                continue
+            if len(posting) * DENSE_RATIO > self.highest:
+                self._postings[name] = bitmap(posting)
+                self._sizes[name] = len(posting)
+
+    def _merge(
+        self, pids: List[int], facets: Facets_T, postings: Postings_T, relations: int
+    ) -> None:
+        self._all |= bitmap(pids)
+        for (field, value), members in facets.items():
+            bucket = self._facets[field]
+            bucket[value] = bucket.get(value, 0) | bitmap(members)
+        for name, members in postings.items():
+            self._extend(name, members)
+        self.highest = max(self.highest, pids[-1])
+        self.pictures += len(pids)
+        self.relations += relations
+        self._densify(postings)
+        self._dirty = True
+
+    def _catchUp(
+        self, pictures: PicturesAccess, tags: TagsAccess, relations: TagsRelationAccess
+    ) -> int:
+        since = self.highest
+        pids: List[int] = []
+        facets: Facets_T = {}
+        table = pictures.table
+        with pictures.connect(write=False) as session:
+            for pid, rating, source, locator in (
+                session.query(table.pid, table.rating, table.source, table.locale_path)
+                .filter(table.pid > since)
+                .order_by(table.pid)
+                .yield_per(LOAD_BATCH_SIZE)
+            ):
+                pids.append(pid)
+                for key in (
+                    ("rating", rating.lower()),
+                    ("source", source.lower()),
+                    ("ext", _ext(locator)),
+                ):
+                    facets.setdefault(key, []).append(pid)
+            if not pids:
+                return 0
+            # Relations of pictures stored after the scan above are left for
+            # the next catch up, otherwise they would be indexed twice
+            query = session.query(relations.table.tid, relations.table.pid).filter(
+                relations.table.pid > since, relations.table.pid <= pids[-1]
+            )
+            if since:
+                query = query.order_by(relations.table.pid)
+            else:
+                query = query.order_by(relations.table.tid, relations.table.pid)
+            members: Dict[int, List[int]] = {}
+            count = 0
+            for tid, pid in query.yield_per(LOAD_BATCH_SIZE):
+                members.setdefault(tid, []).append(pid)
+                count += 1
+            if since:
+                names = {
+                    tid: name
+                    for chunk in chunks([*members])
+                    for tid, name in session.query(
+                        tags.table.tid, tags.table.name
+                    ).filter(tags.table.tid.in_(chunk))
+                }
+            else:
+                names = dict(session.query(tags.table.tid, tags.table.name))
+        postings = {names[tid]: i for tid, i in members.items() if tid in names}
+        self._merge(pids, facets, postings, count)
+        return len(pids)
+
+    def _consistent(
+        self, pictures: PicturesAccess, relations: TagsRelationAccess
+    ) -> bool:
+        with pictures.connect(write=False) as session:
+            counts = (
+                session.query(func.count(pictures.table.pid))
+                .filter(pictures.table.pid <= self.highest)
+                .scalar(),
+                session.query(func.count(relations.table.pid))
+                .filter(relations.table.pid <= self.highest)
+                .scalar(),
+            )
+        return counts == (self.pictures, self.relations)
+
+    def _restore(self) -> bool:
+        try:
+            with self._path.open("rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            logger.warning(f"Tag index snapshot could not be read: {e}")
+            return False
+        if state[0] != SNAPSHOT_VERSION:
+            return False
+        (
+            _,
+            self.highest,
+            self.pictures,
+            self.relations,
+            self._postings,
+            self._sizes,
+            self._facets,
+            self._all,
+        ) = state
+        return True
+
+    @processDatabaseAccess
+    def load(
+        self,
+        pictures: PicturesAccess,
+        tags: TagsAccess,
+        relations: TagsRelationAccess,
+        rebuild: bool = False,
+    ) -> int:
+        with self._lock:
+            if rebuild or not self._restore():
+                self._clear()
+            added = self._catchUp(pictures, tags, relations)
+            if self.highest and not self._consistent(pictures, relations):
+                logger.info("Tag index snapshot is outdated, rebuilding it.")
+                self._clear()
+                added = self._catchUp(pictures, tags, relations)
+            self.loaded = True
+        if self._dirty:
+            self.save()
+        logger.info(
+            f"Tag index loaded with {len(self._postings)} tags of "
+            + f"{self.pictures} pictures, {added} of them read from the database."
+        )
+        return self.pictures
+
+    def save(self) -> None:
+        temporary = self._path.with_suffix(".tmp")
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            state = (
+                SNAPSHOT_VERSION,
+                self.highest,
+                self.pictures,
+                self.relations,
+                self._postings,
+                self._sizes,
+                self._facets,
+                self._all,
+            )
+            with temporary.open("wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            self._dirty = False
+        os.replace(temporary, self._path)
+
+    @SyncToAsync
+    def saveAsync(self) -> None:
+        self.save()
+
+    async def keeper(self) -> NoReturn:
+        """Snapshot the index while pictures are being added to it."""
+        while True:
+            await asyncio.sleep(TagIndexConfig["snapshot-interval"].as_number())
+            if self._dirty:
+                await self.saveAsync()
+
+    def add(
+        self, pictures: Iterable[models.PicturesRead], tags: Dict[str, List[str]]
+    ) -> None:
+        """Index newly stored pictures, ``tags`` maps their MD5 to their tags."""
+        if not self.loaded:
+            return
+        with self._lock:
+            fresh = sorted(
+                (i for i in pictures if i.pid > self.highest), key=lambda i: i.pid
+            )
+            if not fresh:
+                return
+            facets: Facets_T = {}
+            postings: Postings_T = {}
+            count = 0
+            for picture in fresh:
+                for key in (
+                    ("rating", picture.rating.lower()),
+                    ("source", picture.source.lower()),
+                    ("ext", _ext(picture.locale_path)),
+                ):
+                    facets.setdefault(key, []).append(picture.pid)
+                for name in dict.fromkeys(tags.get(picture.md5, ())):
+                    postings.setdefault(name, []).append(picture.pid)
+                    count += 1
+            self._merge([i.pid for i in fresh], facets, postings, count)
+
+    def hide(self, pids: Sequence[int]) -> None:
+        """Leave ``pids`` out of all selections, such as pictures merged into
+        a near-duplicate."""
+        self._hidden |= bitmap(pids)
+
+    def everything(self) -> int:
+        return self._all
+
+    def tag(self, name: str) -> int:
+        posting = self._postings.get(name, 0)
+        return posting if isinstance(posting, int) else bitmap(posting)
+
+    def choice(self, field: str, values: Tuple[str, ...]) -> int:
+        bucket = self._facets[field]
+        return reduce(operator.or_, (bucket.get(i, 0) for i in values), 0)
+
+    def compare(self, field: str, bounds: List[Tuple[str, int]]) -> NoReturn:
+        raise NotImplementedException(
+            f"The tag index does not know the {field} of pictures."
+        )
+
+    def negate(self, bits: int) -> int:
+        return self._all & ~bits
+
+    def select(self, expression: str) -> Selection:
+        """Pictures matching a filter expression such as
+        ``1girl -monochrome rating:s,q source:yande.re``."""
+        postFilter = PostFilter(expression)
+        unknown = postFilter.comparisons()
+        if unknown:
+            raise NotImplementedException(
+                "The tag index cannot compare "
+                + ", ".join(sorted(unknown))
+                + ", queries may only use tags, rating, source and ext."
+            )
+        return Selection(postFilter.select(self) & ~self._hidden)
+
+    def count(self, name: str) -> int:
+        posting = self._postings.get(name)
+        if posting is None:
+            return 0
+        return self._sizes[name] if isinstance(posting, int) else len(posting)
+
+    def tagCounts(
+        self, limit: Optional[int] = None, prefix: str = ""
+    ) -> List[Tuple[str, int]]:
+        """Tags with the most pictures along with their picture counts."""
+        counts = (
+            (name, self.count(name))
+            for name in self._postings
+            if name.startswith(prefix)
+        )
+        if limit is None:
+            return sorted(counts, key=lambda i: i[1], reverse=True)
+        return nlargest(limit, counts, key=lambda i: i[1])
+
+    def facetCounts(
+        self, selection: Optional[Selection] = None
+    ) -> Dict[str, Dict[str, int]]:
+        """Pictures of every rating, source and extension, within
+        ``selection`` if given."""
+        bits = self._all if selection is None else selection.bits
+        return {
+            field: {
+                value: _popcount(members & bits)
+                for value, members in sorted(bucket.items())
+            }
+            for field, bucket in self._facets.items()
+        }
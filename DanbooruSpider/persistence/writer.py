@@ -0,0 +1,150 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from ..config import Config
+from ..exceptions import DatabaseException
+from ..log import logger
+from ..metrics import IngestBatchSize, IngestLatency, QueueDepth
+from ..tracing import Trace, Tracer
+from .database import Pictures, models
+from .index import ImageHashIndex
+from .tagindex import TagIndex
+
+WriterConfig = Config["persistence"]["database"]["writer"]
+
+Entry_T = Tuple[models.PicturesIngest, asyncio.Future]
+
+
+class DatabaseWriter:
+    """Single writer which commits queued pictures in batches.
+
+    Pictures are collected until either ``batch-size`` items are queued or
+    ``interval`` seconds passed since the first one, then stored together
+    with their tags and relations in one transaction. A failed batch is
+    retried up to ``retries`` times, after that its pictures are reported
+    as not committed to whoever put them and to the next ``flush``.
+    """
+
+    def __init__(
+        self,
+        access: Pictures,
+        index: Optional[ImageHashIndex] = None,
+        tagIndex: Optional[TagIndex] = None,
+        *,
+        batchSize: Optional[int] = None,
+        interval: Optional[float] = None,
+    ) -> None:
+        self._access = access
+        self._index = index
+        self._tagIndex = tagIndex
+        self._batchSize: int = batchSize or WriterConfig["batch-size"].as_number()
+        self._interval: float = interval or WriterConfig["interval"].as_number()
+        self._retries: int = WriterConfig["retries"].as_number()
+        self._failed = 0
+        self._tagsCache: Dict[str, int] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _start(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self._batchSize * 4)
+            QueueDepth.track(self._queue.qsize, queue="database", spider="")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._writer())
+        return self._queue
+
+    async def _collect(self, queue: asyncio.Queue) -> List[Entry_T]:
+        loop = asyncio.get_event_loop()
+        batch: List[Entry_T] = [await queue.get()]
+        deadline = loop.time() + self._interval
+        while len(batch) < self._batchSize:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _commit(
+        self, batch: List[models.PicturesIngest]
+    ) -> List[models.PicturesRead]:
+        for attempt in range(self._retries + 1):
+            try:
+                with IngestLatency.time():
+                    return await self._access.createMany(batch, self._tagsCache)
+            except DatabaseException as e:
+                if attempt >= self._retries:
+                    raise
+                logger.warning(
+                    f"Failed to store a batch of {len(batch)} pictures, "
+                    + f"retrying ({attempt + 1}/{self._retries}): {e}"
+                )
+                await asyncio.sleep(self._interval * (attempt + 1))
+        return []
+
+    async def _write(self, entries: List[Entry_T]) -> None:
+        batch = [data for data, _ in entries]
+        try:
+            results = await self._commit(batch)
+        except DatabaseException:
+            logger.exception(f"Failed to store a batch of {len(batch)} pictures:")
+            self._failed += len(batch)
+            for _, future in entries:
+                if not future.done():
+                    future.set_result(False)
+            return
+        IngestBatchSize.observe(len(batch))
+        for item, future in entries:
+            trace = Trace.of(item)
+            if trace is not None:
+                trace.mark("committed")
+                Tracer.finish(trace)
+            if not future.done():
+                future.set_result(True)
+        if self._index is not None:
+            self._index.update(i.md5 for i in results)
+        if self._tagIndex is not None and results:
+            self._tagIndex.add(results, {i.md5: i.tags for i in batch})
+        logger.trace(
+            f"Batch of {len(batch)} pictures committed, "
+            + f"{len(results)} of them are new."
+        )
+
+    async def _writer(self) -> None:
+        queue = self._start()
+        while True:
+            entries = await self._collect(queue)
+            try:
+                await self._write(entries)
+            finally:
+                # Only after the futures, so that flush returns after their
+                # callbacks have run
+                for _ in entries:
+                    queue.task_done()
+
+    async def put(self, data: models.PicturesIngest) -> asyncio.Future:
+        """Queue a picture, the returned future tells whether it has been
+        committed once its batch is done."""
+        future = asyncio.get_event_loop().create_future()
+        await self._start().put((data, future))
+        return future
+
+    async def flush(self) -> None:
+        """Wait until all queued pictures are handled, raising if any of
+        them could not be committed since the last flush."""
+        if self._queue is not None:
+            await self._queue.join()
+        failed, self._failed = self._failed, 0
+        if failed:
+            raise DatabaseException(f"{failed} pictures could not be stored.")
+
+    async def stop(self) -> None:
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
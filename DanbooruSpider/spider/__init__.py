@@ -1,3 +1,6 @@
+from .client import ClientRegistry
 from .image import ImageSpiderWorker
+from .jobs import JobWorker
 from .list import ListSpiderManager
 from .list.worker import DanbooruImageList_T, ListSpiderWorker
+from .scheduler import DownloadScheduler, Scheduler
@@ -0,0 +1,154 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+from mmap import PAGESIZE
+from pathlib import Path
+from threading import Lock
+from typing import Deque, Iterable, Iterator, Optional
+
+from ..config import Config
+from ..log import logger
+from ..metrics import BudgetUsage
+from . import models
+
+BudgetConfig = Config["spider"]["budget"]
+DEFAULT_SIZE: int = Config["persistence"]["space"]["default-size"].as_number()
+
+
+def resident() -> int:
+    """Resident memory of this process in bytes, zero where unknown."""
+    try:
+        pages = int(Path("/proc/self/statm").read_text().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return pages * PAGESIZE
+
+
+class PipelineBudget:
+    """Backpressure on list fetching, shared by all spiders.
+
+    Posts are charged once their page has been parsed and released once
+    the post has been finished, when its picture has been committed, skipped
+    or given up. Until then they count with their estimated size against the
+    ``memory`` limit and with the file size from the API against the
+    ``in-flight`` limit, download buffers count against ``memory`` as well.
+    A new page is only requested while all limits hold, or when no post is
+    left in the pipeline so that crawling always makes progress.
+    """
+
+    def __init__(
+        self,
+        memory: Optional[int] = None,
+        inFlight: Optional[int] = None,
+        rss: Optional[int] = None,
+    ) -> None:
+        self.memoryLimit: int = (
+            BudgetConfig["memory"].as_number() if memory is None else memory
+        )
+        self.inFlightLimit: int = (
+            BudgetConfig["in-flight"].as_number() if inFlight is None else inFlight
+        )
+        self.rssLimit: int = BudgetConfig["rss"].as_number() if rss is None else rss
+        self._interval: float = BudgetConfig["interval"].as_number()
+        self._lock = Lock()
+        self.posts = 0
+        self.memory = 0
+        self.inFlight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._throttled = False
+
+    @staticmethod
+    def _size(image: models.DanbooruImage) -> int:
+        return image.imageSize or DEFAULT_SIZE
+
+    def charge(self, images: Iterable[models.DanbooruImage]) -> None:
+        memory, inFlight, posts = 0, 0, 0
+        for image in images:
+            image.budget = self
+            memory += image.footprint()
+            inFlight += self._size(image)
+            posts += 1
+        with self._lock:
+            self.posts += posts
+            self.memory += memory
+            self.inFlight += inFlight
+
+    def release(self, image: models.DanbooruImage) -> None:
+        """Give back the share of a freed post, from any thread."""
+        with self._lock:
+            self.posts -= 1
+            self.memory -= image.footprint()
+            self.inFlight -= self._size(image)
+        self._wakeup()
+
+    @contextmanager
+    def buffer(self, size: int) -> Iterator[None]:
+        """Account a download buffer of ``size`` bytes while in use."""
+        with self._lock:
+            self.memory += size
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.memory -= size
+            self._wakeup()
+
+    def exceeded(self) -> Optional[str]:
+        """Name of the first limit currently exceeded, if any."""
+        if self.memoryLimit > 0 and self.memory >= self.memoryLimit:
+            return "memory"
+        if self.inFlightLimit > 0 and self.inFlight >= self.inFlightLimit:
+            return "in-flight"
+        if self.rssLimit > 0 and resident() >= self.rssLimit:
+            return "rss"
+        return None
+
+    def admissible(self) -> bool:
+        limit = self.exceeded() if self.posts > 0 else None
+        if limit is not None and not self._throttled:
+            logger.debug(
+                f"List fetching throttled by {limit} budget, {self.posts} posts "
+                + f"taking {self.memory} bytes with {self.inFlight} bytes to download."
+            )
+        elif limit is None and self._throttled:
+            logger.debug("List fetching resumed.")
+        self._throttled = limit is not None
+        return limit is None
+
+    def _wakeup(self) -> None:
+        if not self._waiters or self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch)
+        except RuntimeError:
+            pass
+
+    def _dispatch(self) -> None:
+        while self._waiters and self.admissible():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def admit(self) -> None:
+        """Wait until another page of posts may be requested.
+
+        Resident memory is not announced by anyone, so waiting pages check
+        it every ``interval`` seconds.
+        """
+        self._loop = asyncio.get_event_loop()
+        while not self.admissible():
+            waiter = self._loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait([waiter], timeout=self._interval)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                waiter.cancel()
+
+
+Budget = PipelineBudget()
+BudgetUsage.track(lambda: Budget.memory, kind="memory")
+BudgetUsage.track(lambda: Budget.inFlight, kind="in-flight")
+BudgetUsage.track(lambda: Budget.posts, kind="posts")
@@ -0,0 +1,153 @@
+import asyncio
+import socket
+from ssl import SSLContext
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import httpcore
+
+# The DNS cache hooks into internals of the httpcore and httpx versions
+# pinned exactly in requirements.txt
+from httpcore._async.connection import AsyncHTTPConnection
+from httpcore._backends.asyncio import SocketStream
+from httpcore._backends.auto import AutoBackend
+from httpx import URL, AsyncClient, PoolLimits, Timeout
+from httpx._config import SSLConfig
+
+from ..config import Config
+from ..log import logger
+
+NetworkConfig = Config["spider"]["network"]
+
+ClientKey_T = Tuple[str, Optional[str]]
+KEEPALIVE_EXPIRY = 5.0
+
+
+class _DNSCache:
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._records: Dict[Tuple[str, int], Tuple[float, List[Any]]] = {}
+
+    async def resolve(self, host: str, port: int) -> List[Any]:
+        expire, record = self._records.get((host, port), (0, []))
+        if expire > monotonic():
+            return record
+        record = await asyncio.get_event_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+        self._records[host, port] = (monotonic() + self.ttl, record)
+        return record
+
+    def clear(self) -> None:
+        self._records.clear()
+
+
+class _CachingBackend(AutoBackend):
+    """Opens connections to addresses resolved through the DNS cache, TLS
+    still verifies against the hostname."""
+
+    def __init__(self, cache: _DNSCache) -> None:
+        self._cache = cache
+
+    async def open_tcp_stream(
+        self,
+        hostname: bytes,
+        port: int,
+        ssl_context: Optional[SSLContext],
+        timeout: Dict[str, Optional[float]],
+    ) -> SocketStream:
+        host = hostname.decode("ascii")
+        try:
+            addresses = await self._cache.resolve(host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(e)
+        error: Optional[Exception] = None
+        for *_, address in addresses:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(
+                        address[0],
+                        port,
+                        ssl=ssl_context,
+                        server_hostname=host if ssl_context else None,
+                    ),
+                    timeout.get("connect"),
+                )
+            except asyncio.TimeoutError as e:
+                error = httpcore.ConnectTimeout(e)
+            except OSError as e:
+                error = httpcore.ConnectError(e)
+            else:
+                return SocketStream(stream_reader=reader, stream_writer=writer)
+        raise error or httpcore.ConnectError(f"No address found for {host!r}.")
+
+
+class _CachingPool(httpcore.AsyncConnectionPool):
+    def __init__(self, cache: _DNSCache, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._backend = _CachingBackend(cache)
+
+    async def _add_to_pool(
+        self, connection: AsyncHTTPConnection, timeout: Any = None
+    ) -> None:
+        connection.backend = self._backend
+        await super()._add_to_pool(connection, timeout=timeout)
+
+
+class ClientRegistry:
+    """Process-wide ``AsyncClient`` pool keyed by origin and proxy.
+
+    Clients keep their connections alive between requests, so list pages
+    and images from the same site reuse TCP/TLS connections (multiplexed
+    over HTTP/2 where the site supports it) instead of opening new ones.
+    Direct connections resolve hosts through a cache kept for
+    ``dns-cache-ttl`` seconds.
+    """
+
+    _clients: Dict[ClientKey_T, AsyncClient] = {}
+    _dnsCache = _DNSCache(NetworkConfig["dns-cache-ttl"].as_number())
+
+    @staticmethod
+    def _key(url: Union[str, URL], proxy: Optional[str]) -> ClientKey_T:
+        urlParsed = URL(url)
+        return f"{urlParsed.scheme}://{urlParsed.authority}", (proxy or None)
+
+    @classmethod
+    def get(cls, url: Union[str, URL], proxy: Optional[str] = None) -> AsyncClient:
+        key = cls._key(url, proxy)
+        client = cls._clients.get(key)
+        if client is not None:
+            return client
+        http2: bool = NetworkConfig["http2"].get(bool)
+        limits = PoolLimits(
+            max_keepalive=NetworkConfig["max-keepalive"].as_number(),
+            max_connections=NetworkConfig["max-connections"].as_number(),
+        )
+        transport: Optional[httpcore.AsyncHTTPTransport] = None
+        if cls._dnsCache.ttl > 0:
+            transport = _CachingPool(
+                cls._dnsCache,
+                ssl_context=SSLConfig(trust_env=True).ssl_context,
+                max_keepalive=limits.max_keepalive,
+                max_connections=limits.max_connections,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+                http2=http2,
+            )
+        client = AsyncClient(
+            http2=http2,
+            proxies=key[1],
+            timeout=Timeout(NetworkConfig["timeout"].as_number()),
+            pool_limits=limits,
+            transport=transport,
+        )
+        cls._clients[key] = client
+        logger.debug(f"HTTP client for {key[0]!r} created (proxy: {key[1]!r}).")
+        return client
+
+    @classmethod
+    async def close(cls) -> None:
+        clients = [*cls._clients.values()]
+        cls._clients.clear()
+        cls._dnsCache.clear()
+        await asyncio.gather(*[i.aclose() for i in clients], return_exceptions=True)
+        logger.debug(f"{len(clients)} HTTP clients have been closed.")
@@ -0,0 +1,341 @@
+import operator
+import re
+from functools import lru_cache, reduce
+from typing import Any, Callable, Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from ..exceptions import NotImplementedException, SpiderException
+
+_ALTERNATIVE = re.compile(r"(\|)")
+_COMPARISON = re.compile(r"^(>=|<=|>|<|=)?(.+)$")
+_UNITS = {"": 1, "b": 1, "kb": 2 ** 10, "mb": 2 ** 20, "gb": 2 ** 30}
+_OPERATORS = {">=": ">=", "<=": "<=", ">": ">", "<": "<", "=": "==", "": "=="}
+# Metatags both Danbooru and Moebooru understand in their tag search
+_PUSHABLE = ("width", "height", "score")
+
+
+class PostFields(NamedTuple):
+    """Fields of a post the filter expressions are evaluated on."""
+
+    tags: FrozenSet[str]
+    rating: str
+    width: Optional[int]
+    height: Optional[int]
+    score: Optional[int]
+    size: Optional[int]
+    ext: str
+    source: str
+
+    @classmethod
+    def of(
+        cls, post: Dict[str, Any], tags: Tuple[str, ...], ext: str, source: str
+    ) -> "PostFields":
+        def number(*keys: str) -> Optional[int]:
+            for key in keys:
+                if post.get(key) is not None:
+                    return int(post[key])
+            return None
+
+        return cls(
+            tags=frozenset(tags),
+            rating=str(post.get("rating", ""))[:1].lower(),
+            width=number("width", "image_width"),
+            height=number("height", "image_height"),
+            score=number("score"),
+            size=number("file_size"),
+            ext=ext.lower(),
+            source=source.lower(),
+        )
+
+
+class _Node:
+    def code(self) -> str:
+        raise NotImplementedException
+
+    def query(self) -> Optional[str]:
+        """The term to send to the site, if it can evaluate this node."""
+        return None
+
+    def select(self, index: Any) -> Any:
+        """Evaluate this node on the sets of posts ``index`` provides through
+        its ``tag``, ``choice``, ``compare`` and ``negate`` methods."""
+        raise NotImplementedException
+
+
+class _Tag(_Node):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def code(self) -> str:
+        return f"({self.name!r} in p.tags)"
+
+    def query(self) -> Optional[str]:
+        return self.name
+
+    def select(self, index: Any) -> Any:
+        return index.tag(self.name)
+
+
+class _Choice(_Node):
+    def __init__(self, field: str, values: Tuple[str, ...]) -> None:
+        self.field, self.values = field, values
+
+    def code(self) -> str:
+        return f"(p.{self.field} in {self.values!r})"
+
+    def query(self) -> Optional[str]:
+        if self.field == "rating" and len(self.values) == 1:
+            return f"rating:{self.values[0]}"
+        return None
+
+    def select(self, index: Any) -> Any:
+        return index.choice(self.field, self.values)
+
+
+class _Compare(_Node):
+    def __init__(self, field: str, name: str, text: str) -> None:
+        self.field, self.name, self.text = field, name, text
+        self.bounds: List[Tuple[str, int]] = []
+        if ".." in text:
+            low, high = text.split("..", 1)
+            self.bounds = [(">=", self._number(low)), ("<=", self._number(high))]
+        else:
+            match = _COMPARISON.match(text)
+            if match is None:
+                raise SpiderException(
+                    f"Invalid comparison {name}:{text!r} in filter."
+                )
+            self.bounds = [(_OPERATORS[match[1] or ""], self._number(match[2]))]
+
+    def _number(self, text: str) -> int:
+        match = re.match(r"^(-?\d+(?:\.\d+)?)([a-z]*)$", text.lower())
+        if match is None or (match[2] and self.field != "size"):
+            raise SpiderException(
+                f"Invalid number {text!r} for {self.name} in filter."
+            )
+        if match[2] not in _UNITS:
+            raise SpiderException(f"Unknown size unit {match[2]!r} in filter.")
+        return int(float(match[1]) * _UNITS[match[2]])
+
+    def code(self) -> str:
+        checks = [f"p.{self.field} {op} {value!r}" for op, value in self.bounds]
+        return f"(p.{self.field} is not None and {' and '.join(checks)})"
+
+    def query(self) -> Optional[str]:
+        return f"{self.name}:{self.text}" if self.name in _PUSHABLE else None
+
+    def select(self, index: Any) -> Any:
+        return index.compare(self.field, self.bounds)
+
+
+class _Not(_Node):
+    def __init__(self, node: _Node) -> None:
+        self.node = node
+
+    def code(self) -> str:
+        return f"(not {self.node.code()})"
+
+    def query(self) -> Optional[str]:
+        # Negated metatags are not understood everywhere
+        if isinstance(self.node, (_Tag, _Choice)):
+            term = self.node.query()
+            return term and f"-{term}"
+        return None
+
+    def select(self, index: Any) -> Any:
+        return index.negate(self.node.select(index))
+
+
+class _All(_Node):
+    def __init__(self, nodes: List[_Node]) -> None:
+        self.nodes = nodes
+
+    def code(self) -> str:
+        return "(" + " and ".join(i.code() for i in self.nodes) + ")"
+
+    def select(self, index: Any) -> Any:
+        return reduce(operator.and_, (i.select(index) for i in self.nodes))
+
+
+class _Any(_Node):
+    def __init__(self, nodes: List[_Node]) -> None:
+        self.nodes = nodes
+
+    def code(self) -> str:
+        return "(" + " or ".join(i.code() for i in self.nodes) + ")"
+
+    def select(self, index: Any) -> Any:
+        return reduce(operator.or_, (i.select(index) for i in self.nodes))
+
+
+def _tokens(expression: str) -> List[str]:
+    """Split an expression into terms, ``|`` and parentheses.
+
+    Parentheses only group at the edges of whitespace separated words, and
+    closing ones only beyond those opened inside the word, so that tags
+    such as ``saber_(fate)`` stay whole.
+    """
+    tokens: List[str] = []
+    for word in expression.split():
+        for piece in _ALTERNATIVE.split(word):
+            if piece == "|":
+                tokens.append(piece)
+                continue
+            while piece.startswith(("(", "-(")):
+                if piece[0] == "-":
+                    tokens.append("-")
+                    piece = piece[1:]
+                tokens.append("(")
+                piece = piece[1:]
+            body = piece.rstrip(")")
+            closing = len(piece) - len(body)
+            inner = min(closing, max(body.count("(") - body.count(")"), 0))
+            body += ")" * inner
+            if body:
+                tokens.append(body)
+            tokens.extend(")" * (closing - inner))
+    return tokens
+
+
+class _Parser:
+    """Recursive descent over ``or``/``|`` alternatives of whitespace
+    separated terms, each optionally negated by ``-`` or ``not``."""
+
+    def __init__(self, expression: str) -> None:
+        self.expression = expression
+        self.tokens: List[str] = _tokens(expression)
+        self.position = 0
+
+    def _peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self) -> str:
+        token = self._peek()
+        if token is None:
+            raise SpiderException(f"Filter {self.expression!r} ended unexpectedly.")
+        self.position += 1
+        return token
+
+    def parse(self) -> Optional[_Node]:
+        if not self.tokens:
+            return None
+        node = self._alternatives()
+        if self._peek() is not None:
+            raise SpiderException(
+                f"Unexpected {self._peek()!r} in filter {self.expression!r}."
+            )
+        return node
+
+    def _alternatives(self) -> _Node:
+        nodes = [self._terms()]
+        while self._peek() in ("or", "|"):
+            self._next()
+            nodes.append(self._terms())
+        return nodes[0] if len(nodes) == 1 else _Any(nodes)
+
+    def _terms(self) -> _Node:
+        nodes = [self._unary()]
+        while self._peek() not in (None, ")", "or", "|"):
+            nodes.append(self._unary())
+        return nodes[0] if len(nodes) == 1 else _All(nodes)
+
+    def _unary(self) -> _Node:
+        token = self._next()
+        if token in ("-", "not"):
+            return _Not(self._unary())
+        if token == "(":
+            node = self._alternatives()
+            if self._next() != ")":
+                raise SpiderException(f"Unbalanced ( in filter {self.expression!r}.")
+            return node
+        if token == ")":
+            raise SpiderException(f"Unbalanced ) in filter {self.expression!r}.")
+        if token.startswith("-"):
+            return _Not(self._term(token[1:]))
+        return self._term(token)
+
+    @staticmethod
+    def _term(token: str) -> _Node:
+        name, _, value = token.partition(":")
+        name = name.lower()
+        if value and name == "rating":
+            return _Choice("rating", tuple(i[:1].lower() for i in value.split(",")))
+        if value and name in ("ext", "filetype"):
+            values = tuple(i.lower().lstrip(".") for i in value.split(","))
+            return _Choice("ext", values)
+        if value and name == "source":
+            return _Choice("source", tuple(i.lower() for i in value.split(",")))
+        if value and name in ("width", "height", "score"):
+            return _Compare(name, name, value)
+        if value and name in ("filesize", "size"):
+            return _Compare("size", "filesize", value)
+        return _Tag(token.lower())
+
+
+class PostFilter:
+    """Filter expression of a spider, compiled once into a predicate.
+
+    Terms are tags, ``rating:s,q``, ``ext:jpg,png``, ``source:yande.re`` and
+    comparisons of ``width``, ``height``, ``score`` and ``filesize`` such as
+    ``width:>=1920``, ``score:10..100`` or ``filesize:<15MB``. Terms separated
+    by whitespace must all hold, ``or`` (or ``|``) separates alternatives,
+    ``-`` or ``not`` negates a term and parentheses at the edges of words
+    group, tags like ``touhou_(series)`` keep theirs. Comparisons with a
+    field the post does not have are false.
+
+    ``query`` holds up to ``pushdown`` top-level terms the site can evaluate
+    itself, which are sent along as its tag search. The whole expression is
+    still checked locally, sites quietly drop terms above their limits.
+    """
+
+    def __init__(self, expression: str = "", pushdown: int = 0) -> None:
+        self.expression = expression
+        self.root = _Parser(expression).parse()
+        self.accepts: Callable[[PostFields], bool] = self._compile(self.root)
+        self.query: Tuple[str, ...] = self._pushdown(self.root, pushdown)
+
+    def __bool__(self) -> bool:
+        return bool(self.expression.strip())
+
+    def comparisons(self) -> FrozenSet[str]:
+        """Names of the fields compared anywhere in the expression."""
+        names: List[str] = []
+        nodes = [] if self.root is None else [self.root]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, _Compare):
+                names.append(node.name)
+            elif isinstance(node, _Not):
+                nodes.append(node.node)
+            elif isinstance(node, (_All, _Any)):
+                nodes.extend(node.nodes)
+        return frozenset(names)
+
+    def select(self, index: Any) -> Any:
+        """Evaluate the expression on the sets of posts of ``index``, which
+        provides ``everything`` besides the methods used by the terms."""
+        return index.everything() if self.root is None else self.root.select(index)
+
+    @staticmethod
+    def _compile(root: Optional[_Node]) -> Callable[[PostFields], bool]:
+        if root is None:
+            return lambda p: True
+        namespace: Dict[str, Any] = {"__builtins__": {}}
+        return eval(f"lambda p: {root.code()}", namespace)
+
+    @staticmethod
+    def _pushdown(root: Optional[_Node], limit: int) -> Tuple[str, ...]:
+        if root is None or limit <= 0:
+            return ()
+        nodes = root.nodes if isinstance(root, _All) else [root]
+        terms = [term for term in (i.query() for i in nodes) if term]
+        # Ratings narrow the search most reliably, tags come next
+        terms.sort(key=lambda i: (not i.lstrip("-").startswith("rating:"), ":" in i))
+        return tuple(terms[:limit])
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def compiled(expression: str) -> "PostFilter":
+        """Shared instance for ``expression``, e.g. inside pool processes."""
+        return PostFilter(expression)
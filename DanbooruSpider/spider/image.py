@@ -1,14 +1,38 @@
 import asyncio
+from errno import ENOSPC
 from random import choice as randChoice
-from typing import AsyncIterator, List, NoReturn, Optional, Union
+from time import perf_counter
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from httpx import URL, AsyncClient, HTTPError
+from httpx import URL, HTTPError, Response
 
 from ..config import VERSION, Config
 from ..exceptions import DanbooruException, NetworkException, SpiderException
 from ..log import logger
-from ..utils import AsyncOpen, HashCreator, Retry, TempFile
+from ..metrics import (
+    DownloadBytes,
+    DownloadLatency,
+    DownloadSize,
+    DownloadsInFlight,
+    NearDuplicatesSkipped,
+    QueueDepth,
+)
+from ..tracing import Trace, mark
+from ..utils import HashCreator, Retry, StreamSink
 from . import models
+from .budget import Budget
+from .client import ClientRegistry
+from .scheduler import Scheduler
 
 ImageSpiderConfig = Config["spider"]["images"]
 
@@ -18,110 +42,267 @@ class StoppedException(DanbooruException):
 
 
 class ImageSpiderWorker:
+    downloading: Set[str] = set()
+
     def __init__(
         self,
         queue: Optional[asyncio.Queue] = None,
         *,
-        workers: Optional[int] = None,
+        name: str = "default",
+        queueSize: Optional[int] = None,
         proxy: Optional[str] = None,
     ) -> None:
-        self._proxy: Optional[str] = proxy or ImageSpiderConfig[
-            "proxy"
-        ].as_str() or None
-        self._workers: int = workers or ImageSpiderConfig["workers"].as_number()
-        self._queue: asyncio.Queue = asyncio.Queue(self._workers)
-        self._tasks: List[asyncio.Task] = []
-        self._running = 0
+        self._name = name
+        self._proxy: Optional[str] = (
+            proxy or ImageSpiderConfig["proxy"].as_str() or None
+        )
+        self._queue: asyncio.Queue = asyncio.Queue(
+            queueSize or ImageSpiderConfig["queue-size"].as_number()
+        )
+        self._bufferSize: int = ImageSpiderConfig["buffer-size"].as_number()
+        QueueDepth.track(self._queue.qsize, queue="images", spider=name)
+        self._tasks: Set[asyncio.Task] = set()
         self._stopped = False
 
         if queue is not None:
-            self._tasks.append(asyncio.create_task(self._imagesListFetcher(queue)))
-        self._tasks.append(asyncio.create_task(self._runningTaskCleaner()))
+            self._spawn(self._imagesListFetcher(queue))
 
-    async def _imagesListFetcher(self, queue: asyncio.Queue) -> NoReturn:
-        while True:
-            imagesList: List[models.DanbooruImage] = await queue.get()
-            await self.add(imagesList)
+    def _spawn(self, coroutine: Awaitable) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
 
-    async def _runningTaskCleaner(self) -> NoReturn:
+    async def _imagesListFetcher(self, queue: asyncio.Queue) -> None:
         while True:
-            for finishedTask in filter(lambda x: x.done(), self._tasks):
-                self._tasks.remove(finishedTask)
-            await asyncio.sleep(1)
+            imagesList: Optional[List[models.DanbooruImage]] = await queue.get()
+            if imagesList is None:
+                break
+            await self.add(imagesList)
+        await self.stop()
 
     @Retry(
         retries=ImageSpiderConfig["retries"]["times"].as_number(),
         delay=ImageSpiderConfig["retries"]["delay"].as_number(),
     )
-    async def _imageDownload(
-        self, client: AsyncClient, data: models.DanbooruImage,
-    ) -> models.ImageDownload:
-        while self._running >= self._workers:
-            await asyncio.sleep(1)
-        self._running += 1
+    async def _imageDownload(self, data: models.DanbooruImage) -> models.ImageDownload:
+        from ..persistence import Persistence, Space
 
         urlParsed = URL(data.imageURL)
-        logger.trace(
-            "Start downloading picture "
-            + f"{urlParsed.full_path!r} from {urlParsed.host!r}."
-        )
-        tempfile, hashData, totalWrite = TempFile().create(), HashCreator(), 0
-        try:
-            response = await client.get(
-                urlParsed,
-                headers={
-                    "User-Agent": randChoice(
-                        ImageSpiderConfig["user-agents"].get(list)
-                        or [f"DanbooruSpider/{VERSION}"]
-                    ),
-                },
+        partial, hashData = Persistence.stage(data.imageMD5), HashCreator()
+        state = await partial.state()
+        if state.get("url") != str(urlParsed):
+            state = {"url": str(urlParsed), "offset": 0}
+        offset: int = state["offset"]
+        headers = {
+            "User-Agent": randChoice(
+                ImageSpiderConfig["user-agents"].get(list)
+                or [f"DanbooruSpider/{VERSION}"]
             )
-            response.raise_for_status()
-            async with AsyncOpen(str(tempfile), "wb") as f:
-                async for chunk in response.aiter_bytes():
-                    await hashData.update(chunk)
-                    totalWrite += await f.write(chunk)
+        }
+        if offset > 0:
+            headers["Range"] = f"bytes={offset}-"
+            if state.get("etag") or state.get("last_modified"):
+                headers["If-Range"] = state.get("etag") or state["last_modified"]
+        client = ClientRegistry.get(urlParsed, self._proxy)
+        beginTime: Optional[float] = None
+        try:
+            # Waiting for disk space holds no slot, a reservation is only kept
+            # waiting for slots handed back by running downloads
+            async with Space.reservation(data.imageSize), Scheduler.slot(self._name):
+                DownloadsInFlight.inc(spider=self._name)
+                beginTime = perf_counter()
+                mark(data, "slot")
+                logger.trace(
+                    "Start downloading picture "
+                    + f"{urlParsed.full_path!r} from {urlParsed.host!r}"
+                    + (f", resuming from byte {offset}." if offset else ".")
+                )
+                async with client.stream("GET", urlParsed, headers=headers) as response:
+                    if response.status_code == 416:
+                        await partial.reset()
+                    response.raise_for_status()
+                    try:
+                        state, offset = self._resumeState(state, response, offset)
+                    except NetworkException:
+                        await partial.reset()
+                        raise
+                    mark(data, "response")
+                    if offset > 0:
+                        await partial.rehash(hashData, offset)
+                        mark(data, "rehashed")
+                    else:
+                        await partial.reset()
+                    await partial.save(**state)
+                    size = state["size"] or data.imageSize
+                    buffered = min(size or self._bufferSize, self._bufferSize)
+                    with Budget.buffer(buffered):
+                        sink = await StreamSink.open(
+                            partial.path,
+                            hashData,
+                            offset,
+                            self._bufferSize,
+                            preallocate=size,
+                        )
+                        try:
+                            async for chunk in response.aiter_bytes():
+                                await Scheduler.throttle(len(chunk))
+                                DownloadBytes.inc(len(chunk), host=urlParsed.host)
+                                await sink.write(chunk)
+                        finally:
+                            offset, digest = await sink.close()
+                            await partial.save(**{**state, "offset": offset})
+                mark(data, "transferred")
+                DownloadLatency.observe(perf_counter() - beginTime, spider=self._name)
+                DownloadSize.observe(offset, spider=self._name)
             logger.trace(
                 "Finished downloading picture "
                 + f"{urlParsed.full_path!r} from {urlParsed.host!r}, "
-                + f"total write {totalWrite} bytes."
+                + f"total write {offset} bytes."
             )
         except HTTPError as e:
             raise NetworkException(
                 "There was an error in the network when processing the picture "
                 + f"'{urlParsed}', the reason is: {e}"
             )
+        except SpiderException:
+            raise
         except Exception as e:
+            if isinstance(e, OSError) and e.errno == ENOSPC:
+                Space.exhausted()
             raise SpiderException(
                 "There was a unknown error when processing the picture "
                 + f"'{urlParsed}', the reason is: {e}"
             )
         finally:
-            self._running -= 1
-        return models.ImageDownload(
+            if beginTime is not None:
+                DownloadsInFlight.dec(spider=self._name)
+        result = models.ImageDownload(
             **{
                 "source": str(urlParsed),
-                "path": tempfile,
-                "size": totalWrite,
-                "md5": await hashData.hexdigest(),
+                "path": await partial.finish(),
+                "size": offset,
+                "md5": digest,
                 "data": data,
             }
         )
+        Trace.carry(data, result)
+        Persistence.hold(result)
+        return result
+
+    @staticmethod
+    def _resumeState(
+        state: Dict[str, Any], response: Response, offset: int
+    ) -> Tuple[Dict[str, Any], int]:
+        """Check a response against the partial file state.
+
+        Returns the state to store and the offset to continue writing at,
+        which is zero whenever the server did not resume the same file.
+        """
+        etag = response.headers.get("ETag")
+        lastModified = response.headers.get("Last-Modified")
+        if response.status_code == 206:
+            contentRange = response.headers.get("Content-Range", "")
+            unit, _, ranges = contentRange.partition(" ")
+            span, _, total = ranges.partition("/")
+            start = span.partition("-")[0]
+            if (
+                unit != "bytes"
+                or not start.isdigit()
+                or int(start) != offset
+                or (state.get("size") and total != str(state["size"]))
+                or (state.get("etag") and etag and etag != state["etag"])
+            ):
+                raise NetworkException(
+                    f"Server resumed {state['url']!r} with unexpected range "
+                    + f"{contentRange!r}, restarting download."
+                )
+            size = int(total) if total.isdigit() else state.get("size")
+        else:
+            offset = 0
+            length = response.headers.get("Content-Length", "")
+            size = int(length) if length.isdigit() else None
+        return (
+            {
+                "url": state["url"],
+                "etag": etag,
+                "last_modified": lastModified,
+                "size": size,
+                "offset": offset,
+            },
+            offset,
+        )
+
+    async def _covered(self, data: models.DanbooruImage) -> Optional[int]:
+        """A stored near-duplicate at least as large as the post, judged by
+        the perceptual hash of its preview."""
+        from ..persistence import Services
+        from ..persistence.similar import hashPicture
+
+        metadata = data.metadata
+        preview = metadata.get("preview_url") or metadata.get("preview_file_url")
+        width = metadata.get("width") or metadata.get("image_width")
+        height = metadata.get("height") or metadata.get("image_height")
+        if not (preview and width and height):
+            return None
+        client = ClientRegistry.get(URL(preview), self._proxy)
+        try:
+            async with Scheduler.slot(self._name):
+                response = await client.get(preview)
+            response.raise_for_status()
+        except HTTPError as e:
+            logger.debug(f"Preview of picture {data.id} could not be fetched: {e}")
+            return None
+        hashed = await hashPicture(response.content)
+        if hashed is None:
+            return None
+        return Services.similar.covering(hashed[0], int(width) * int(height))
+
+    async def download(
+        self, data: models.DanbooruImage
+    ) -> Optional[models.ImageDownload]:
+        """Download a picture into the staging area, skipping it with ``None``
+        while the same picture is being downloaded already, or when a larger
+        near-duplicate is stored and such downloads are to be skipped."""
+        from ..persistence import Services
+
+        md5 = data.imageMD5.lower()
+        if md5 in self.downloading:
+            logger.debug(
+                f"Download of picture {data.id} from {data.source!r} "
+                + "has been skipped as it is being downloaded already."
+            )
+            return None
+        self.downloading.add(md5)
+        try:
+            if Services.similar.skipping:
+                duplicate = await self._covered(data)
+                if duplicate is not None:
+                    NearDuplicatesSkipped.inc(spider=self._name)
+                    logger.debug(
+                        f"Download of picture {data.id} from {data.source!r} "
+                        + f"has been skipped for its near-duplicate {duplicate}."
+                    )
+                    return None
+            return await self._imageDownload(data)
+        finally:
+            self.downloading.discard(md5)
 
     async def _imageQueuePut(self, images: List[models.DanbooruImage]) -> asyncio.Queue:
-        async def customers(client: AsyncClient, data: models.DanbooruImage) -> None:
-            result: Union[models.ImageDownload, Exception]
+        async def customers(data: models.DanbooruImage) -> None:
+            result: Union[models.ImageDownload, Exception, None]
             try:
-                result = await self._imageDownload(client, data)
+                result = await self.download(data)
             except Exception as e:
                 result = e
-            await self._queue.put(result)
+            if not isinstance(result, models.ImageDownload):
+                data.finish(failed=result is not None)
+            if result is not None:
+                await self._queue.put(result)
 
-        async with AsyncClient(proxies=self._proxy) as client:
-            await asyncio.gather(
-                *map(lambda data: customers(client, data), images),
-                return_exceptions=True,
-            )
+        tasks = [asyncio.create_task(customers(i)) for i in images]
+        if tasks:
+            await asyncio.wait(tasks)
         return self._queue
 
     async def add(self, images: List[models.DanbooruImage], wait: bool = True) -> None:
@@ -129,24 +310,30 @@ class ImageSpiderWorker:
 
         if self._stopped:
             raise StoppedException
-        for image in [*images]:
-            if not await Services.checkImageExist(image.imageMD5):
+        existHashes = await Services.checkImagesExist(i.imageMD5 for i in images)
+        queued: List[models.DanbooruImage] = []
+        for image in images:
+            if image.imageMD5 not in existHashes:
+                mark(image, "queued")
+                queued.append(image)
                 continue
             logger.debug(
                 f"Download of picture {image.id} from {image.source!r}"
                 + "has been skipped due to hash duplicate."
             )
-            images.remove(image)
-        task = asyncio.create_task(self._imageQueuePut(images))
-        self._tasks.append(task)
-        while wait and not task.done():
-            await asyncio.sleep(1)
+            image.finish()
+        task = self._spawn(self._imageQueuePut(queued))
+        if wait:
+            await asyncio.wait([task])
         return
 
     async def results(self) -> AsyncIterator[models.ImageDownload]:
-        while (not self._stopped) or self._queue.empty():
-            result: Union[models.ImageDownload, Exception] = await self._queue.get()
-            if isinstance(result, Exception):
+        while True:
+            result: Union[models.ImageDownload, Exception, None]
+            result = await self._queue.get()
+            if result is None:
+                break
+            elif isinstance(result, Exception):
                 try:
                     raise result
                 except NetworkException as e:
@@ -154,17 +341,18 @@ class ImageSpiderWorker:
                 except Exception as e:
                     logger.exception("An unknown error occurred while processing:")
             elif isinstance(result, models.ImageDownload):
+                mark(result, "delivered")
                 yield result
         return
 
     async def stop(self, nowait: bool = False):
+        if self._stopped:
+            return
         self._stopped = True
+        tasks = [i for i in self._tasks if i is not asyncio.current_task()]
         if nowait:
-            for task in self._tasks:
-                if task.done():
-                    continue
+            for task in tasks:
                 task.cancel()
-        else:
-            while [*filter(lambda x: not x.done(), self._tasks)]:
-                await asyncio.sleep(1)
-        self._tasks.clear()
+        if tasks:
+            await asyncio.wait(tasks)
+        await self._queue.put(None)
@@ -0,0 +1,131 @@
+import asyncio
+import os
+from socket import gethostname
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from ..config import Config
+from ..exceptions import NetworkException, SpiderException
+from ..log import logger
+from ..metrics import VerifyFailures
+from ..persistence.database.models import JobsRead, JobState
+from .image import ImageSpiderWorker
+
+JobsConfig = Config["spider"]["jobs"]
+
+
+class JobWorker:
+    """Download worker fed by the durable job queue.
+
+    Up to ``claim-size`` jobs are leased at a time and their leases renewed
+    while downloads run. Verified pictures stay in the staging area and
+    their jobs are marked downloaded for the storing process to pick up.
+    Leases still held when the worker stops are handed back, partially
+    downloaded files are resumed by whoever claims them next.
+    """
+
+    def __init__(
+        self, owner: Optional[str] = None, capacity: Optional[int] = None
+    ) -> None:
+        self.owner: str = owner or f"{gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+        self._capacity: int = capacity or JobsConfig["claim-size"].as_number()
+        self._interval: float = JobsConfig["poll-interval"].as_number()
+        self._workers: Dict[str, ImageSpiderWorker] = {}
+        self._active: Dict[int, asyncio.Task] = {}
+        self._stopped = False
+
+    def _worker(self, spider: str) -> ImageSpiderWorker:
+        if spider not in self._workers:
+            self._workers[spider] = ImageSpiderWorker(name=spider)
+        return self._workers[spider]
+
+    async def _process(self, job: JobsRead) -> None:
+        from ..persistence import Persistence, Services
+
+        image = Services.jobs.image(job)
+        try:
+            result = await self._worker(job.spider).download(image)
+            if result is None:
+                raise SpiderException(
+                    f"Picture {image.id} is being downloaded already."
+                )
+            if not Persistence.verify(result):
+                VerifyFailures.inc(spider=job.spider)
+                await Persistence.discard(result)
+                raise SpiderException(
+                    f"Hash verify of image {result.source!r} failed. "
+                    + f"({result.md5} did not match {image.imageMD5})"
+                )
+        except Exception as e:
+            state = await Services.jobs.fail(self.owner, job, e)
+            message = f"Job {job.jid} of picture {image.id} failed, {state.value}: {e}"
+            if isinstance(e, NetworkException) and state != JobState.FAILED:
+                logger.debug(message)
+            else:
+                logger.warning(message)
+            return
+        try:
+            await Services.jobs.downloaded(self.owner, [job])
+        finally:
+            # From now on the staged file is kept by the state of its job
+            Persistence.release(result)
+
+    async def _heartbeat(self) -> None:
+        from ..persistence import Services
+
+        while True:
+            await asyncio.sleep(Services.jobs.lease / 3)
+            try:
+                await Services.jobs.renew(self.owner, [*self._active])
+            except Exception:
+                logger.exception("Failed to renew leases of running jobs:")
+
+    def _spawn(self, job: JobsRead) -> None:
+        task = asyncio.create_task(self._process(job))
+        self._active[job.jid] = task
+        task.add_done_callback(lambda _: self._active.pop(job.jid, None))
+
+    def stop(self) -> None:
+        """Stop claiming jobs and hand back those already claimed."""
+        if not self._stopped:
+            logger.info(f"Worker {self.owner} is stopping.")
+        self._stopped = True
+
+    async def run(self, finished: Callable[[], bool] = lambda: False) -> None:
+        """Work on jobs until stopped, or until ``finished`` returns true and
+        the jobs at hand are done."""
+        from ..persistence import Services
+
+        heartbeat = asyncio.create_task(self._heartbeat())
+        logger.info(f"Worker {self.owner} started.")
+        try:
+            while not self._stopped:
+                claimed: List[JobsRead] = []
+                if finished():
+                    if not self._active:
+                        break
+                elif len(self._active) < self._capacity:
+                    claimed = await Services.jobs.claim(
+                        self.owner, self._capacity - len(self._active)
+                    )
+                for job in claimed:
+                    self._spawn(job)
+                if claimed and len(self._active) < self._capacity:
+                    continue
+                if self._active:
+                    await asyncio.wait(
+                        [*self._active.values()],
+                        timeout=self._interval,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                else:
+                    await asyncio.sleep(self._interval)
+        finally:
+            heartbeat.cancel()
+            tasks = [*self._active.values()]
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+            await Services.jobs.release(self.owner)
+            logger.info(f"Worker {self.owner} stopped.")
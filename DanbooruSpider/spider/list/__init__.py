@@ -3,6 +3,8 @@ from typing import Any, Dict, Optional, Type
 
 from ...config import Config
 from ...log import logger
+from ...metrics import QueueDepth
+from ..scheduler import Scheduler
 from .impl import DanbooruUnified
 from .worker import ListSpiderWorker
 
@@ -10,7 +12,6 @@ ListSpiderConfig = Config["spider"]["lists"]
 
 
 class ListSpiderManager:
-    workers: int = ListSpiderConfig["workers"].as_number()
     _implementations: Dict[str, Type[ListSpiderWorker]] = {}
     _instances: Dict[str, ListSpiderWorker] = {}
     _tasks: Dict[str, asyncio.Task] = {}
@@ -31,14 +32,20 @@ class ListSpiderManager:
 
     @classmethod
     def instance(
-        cls, implementation: str, name: str, config: Optional[Dict[str, Any]] = None
+        cls,
+        implementation: str,
+        name: str,
+        config: Optional[Dict[str, Any]] = None,
+        weight: float = 1,
     ) -> ListSpiderWorker:
         config = config or {}
         assert implementation in cls._implementations
         assert name not in cls._instances
         worker: Type[ListSpiderWorker] = cls._implementations[implementation]
         workerInstance: ListSpiderWorker = worker(**config)
+        workerInstance.name = name
         cls._instances[name] = workerInstance
+        Scheduler.register(name, weight)
         logger.info(
             f"Instance of {implementation} has been created as {name} with config {config!r}."
         )
@@ -47,23 +54,29 @@ class ListSpiderManager:
     @classmethod
     async def run(cls, name: str) -> asyncio.Queue:
         async def queuePutter(worker: ListSpiderWorker, queue: asyncio.Queue) -> None:
-            async for result in worker.run():
-                await queue.put(result)
-
-        while (
-            len([*filter(lambda t: not t.done(), cls._tasks.values())]) >= cls.workers
-        ):
-            await asyncio.sleep(1)
+            try:
+                async for result in worker.run():
+                    await queue.put(result)
+            finally:
+                await queue.put(None)
 
         assert name in cls._instances
         assert name not in cls._tasks
         worker: ListSpiderWorker = cls._instances[name]
         queue: asyncio.Queue = asyncio.Queue(ListSpiderConfig["queue-size"].as_number())
+        QueueDepth.track(queue.qsize, queue="lists", spider=name)
         workTask = queuePutter(worker, queue)
         cls._tasks[name] = asyncio.create_task(workTask, name=name)
         logger.info(f"Task of instance {name} created.")
         return queue
 
+    @classmethod
+    async def drain(cls) -> None:
+        """Wait for the checkpoints of finished pages to be saved."""
+        for worker in cls._instances.values():
+            if worker.ledger is not None:
+                await worker.ledger.drain()
+
     @classmethod
     def cancel(cls, name: str) -> bool:
         assert name in cls._tasks
@@ -1,49 +1,155 @@
-from httpx import URL, AsyncClient
+import json
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-from ..models import DanbooruImage, Ratings
-from .worker import APIResult_T, DanbooruImageList_T, ListSpiderWorker
+from httpx import URL
 
+from ...exceptions import SpiderException
+from ...log import logger
+from ...utils import SyncToProcess
+from ..filters import PostFields, PostFilter
+from ..models import DanbooruImage, Ratings, Tags
+from .worker import APIResult_T, DanbooruImageList_T, ListSpiderWorker, Page_T
 
-def _getRating(rating: str) -> Ratings:
-    return {i.value: i for i in Ratings.__members__.values()}[rating.lower()]
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+RATINGS = {i.value: i for i in Ratings}
 
 
 def _getExt(url: str) -> str:
-    path = URL(url).full_path
+    path = urlsplit(url).path
     name, ext = path.rsplit(".", 1)
     return ext
 
 
+def _splitPage(text: str) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Decode a JSON array of posts one element at a time, yielding each
+    post along with its slice of the original text."""
+    decoder = json.JSONDecoder()
+
+    def blank(index: int) -> int:
+        match = _WHITESPACE.match(text, index)
+        return match.end() if match else index
+
+    def skip(index: int, separator: str) -> int:
+        index = blank(index)
+        if text.startswith(separator, index):
+            index = blank(index + 1)
+        return index
+
+    index = blank(0)
+    if not text.startswith("[", index):
+        raise ValueError("a list of posts was expected")
+    index = skip(index, "[")
+    while index < len(text) and text[index] != "]":
+        post, end = decoder.raw_decode(text, index)
+        yield post, text[index:end]
+        index = skip(end, ",")
+
+
+def _identifiers(posts: Iterable[Dict[str, Any]]) -> List[int]:
+    result: List[int] = []
+    for post in posts:
+        try:
+            result.append(int(post["id"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return result
+
+
+def _parsePosts(
+    site: str, posts: Iterable[Tuple[Dict[str, Any], str]], expression: str = ""
+) -> DanbooruImageList_T:
+    """Build the records of a page, validating all its posts in one pass and
+    leaving out malformed ones and those rejected by the filter
+    ``expression``."""
+    accepts = PostFilter.compiled(expression).accepts if expression else None
+    result: DanbooruImageList_T = []
+    for post, raw in posts:
+        if "file_url" not in post:
+            continue
+        try:
+            url: str = post["file_url"]
+            size = post.get("file_size")
+            tags = Tags.split(post["tags" if "tags" in post else "tag_string"])
+            ext = _getExt(url)
+            if accepts is not None and not accepts(
+                PostFields.of(post, tags, ext, site)
+            ):
+                continue
+            result.append(
+                DanbooruImage(
+                    id=int(post["id"]),
+                    source=site,
+                    tags=tags,
+                    rating=RATINGS[post["rating"].lower()],
+                    imageURL=url,
+                    imageMD5=str(post["md5"]),
+                    imageExt=ext,
+                    imageSize=None if size is None else int(size),
+                    raw=raw,
+                )
+            )
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logger.warning(
+                f"Post {post.get('id')!r} of {site} is malformed and skipped: {e!r}"
+            )
+    return result
+
+
+@SyncToProcess
+def _loadPage(site: str, body: bytes, expression: str = "") -> Page_T:
+    try:
+        posts = [*_splitPage(body.decode("utf-8"))]
+    except ValueError as e:
+        raise SpiderException(f"List of {site} is not valid JSON: {e}")
+    return _identifiers(i for i, _ in posts), _parsePosts(site, posts, expression)
+
+
 class DanbooruUnified(ListSpiderWorker):
-    def __init__(self, url: str, **kwargs) -> None:
+    """Danbooru and Moebooru (konachan, yande.re) compatible list spider.
+
+    ``pagination`` selects how pages below a known post are requested:
+    ``cursor`` uses Danbooru's ``page=b<id>``, ``id-tag`` searches for
+    ``id:<<id>`` which Moebooru understands as well and can be combined with
+    page numbers for prefetching, and ``offset`` falls back to plain page
+    numbers.
+    """
+
+    PAGINATIONS = ("cursor", "id-tag", "offset")
+
+    def __init__(self, url: str, pagination: str = "offset", **kwargs) -> None:
+        assert pagination in self.PAGINATIONS
         self._url = URL(url)
+        self._pagination = pagination
         self.site = self._url.host
+        self.cursor = pagination != "offset"
+        self.anchored = pagination == "id-tag"
         super().__init__(**kwargs)
 
     async def parse(self, data: APIResult_T) -> DanbooruImageList_T:
         assert isinstance(data, list)
-        return [
-            DanbooruImage(
-                **{
-                    "id": i["id"],
-                    "source": self.site,
-                    "tags": [
-                        j.strip()
-                        for j in i["tags" if "tags" in i else "tag_string"].split(" ")
-                        if j.strip()
-                    ],
-                    "rating": _getRating(i["rating"]),
-                    "imageURL": i["file_url"],
-                    "imageMD5": i["md5"],
-                    "imageExt": _getExt(i["file_url"]),
-                    "metadata": i.copy(),
-                }
-            )
-            for i in data
-            if ("file_url" in i)
-        ]
-
-    async def fetch(self, page: int, size: int) -> APIResult_T:
-        fullURL = URL(self._url, params={"limit": size, "page": page})
-        async with AsyncClient() as client:
-            return await self._listDownload(client, fullURL)
+        posts = ((i, json.dumps(i)) for i in data)
+        return _parsePosts(self.site, posts, self.filter.expression)
+
+    async def load(self, body: bytes) -> Page_T:
+        return await _loadPage(self.site, body, self.filter.expression)
+
+    def identifiers(self, data: APIResult_T) -> List[int]:
+        assert isinstance(data, list)
+        return _identifiers(data)
+
+    async def fetch(
+        self, page: int, size: int, before: Optional[int] = None
+    ) -> bytes:
+        params: Dict[str, Any] = {"limit": size, "page": page}
+        tags = [*self.filter.query]
+        if before is not None and self._pagination == "cursor":
+            params["page"] = f"b{before}"
+        elif before is not None and self._pagination == "id-tag":
+            tags.append(f"id:<{before}")
+        if tags:
+            params["tags"] = " ".join(tags)
+        fullURL = URL(self._url, params=params)
+        return await self._listDownload(fullURL)
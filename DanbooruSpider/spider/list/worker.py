@@ -1,49 +1,175 @@
 import asyncio
-from itertools import count
+import json
+from collections import deque
 from random import choice as randChoice
-from typing import Any, AsyncIterator, Dict, List, Optional, Union
+from time import perf_counter
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple, Union
 
-from httpx import URL, AsyncClient, HTTPError
+from httpx import URL, HTTPError
 
 from ...config import VERSION, Config
 from ...exceptions import NetworkException, NotImplementedException, SpiderException
 from ...log import logger
+from ...metrics import ListLatency, PagesFetched
+from ...persistence.database.models import (
+    CheckpointsCreate,
+    CheckpointsRead,
+    CrawlDirection,
+)
+from ...tracing import Trace
 from ...utils import Retry
 from .. import models
+from ..budget import Budget
+from ..client import ClientRegistry
+from ..filters import PostFilter
+from ..scheduler import Scheduler
 
 ListSpiderConfig = Config["spider"]["lists"]
 APIResult_T = Union[Dict[str, Any], List[Dict[str, Any]]]
 DanbooruImageList_T = List[models.DanbooruImage]
+Page_T = Tuple[List[int], DanbooruImageList_T]
+
+
+class _Page:
+    __slots__ = ("ledger", "left", "checkpoint", "failed")
+
+    def __init__(
+        self,
+        ledger: "CheckpointLedger",
+        left: int,
+        checkpoint: Optional[CheckpointsCreate],
+    ) -> None:
+        self.ledger = ledger
+        self.left = left
+        self.checkpoint = checkpoint
+        self.failed = False
+
+    def finish(self, failed: bool = False) -> None:
+        self.failed = self.failed or failed
+        self.left -= 1
+        if self.left <= 0:
+            self.ledger._advance()
+
+
+class CheckpointLedger:
+    """Checkpoints of the pages handed out by a spider.
+
+    The checkpoint reached with a page is only saved once every post of it
+    and of all earlier pages has been finished, that is committed or
+    skipped, so a crash never moves a checkpoint past posts which are still
+    on their way. Once a post fails or a page is skipped, no later
+    checkpoint is saved for the rest of the run, the next run lists those
+    posts again. ``head`` is the checkpoint of the latest page, saved or
+    not.
+    """
+
+    def __init__(self, name: str, head: Optional[CheckpointsCreate]) -> None:
+        self.name = name
+        self.head = head
+        self._pages: Deque[_Page] = deque()
+        self._latest: Optional[CheckpointsCreate] = None
+        self._saver: Optional[asyncio.Task] = None
+        self._held = False
+
+    def track(
+        self,
+        images: DanbooruImageList_T,
+        checkpoint: Optional[CheckpointsCreate] = None,
+    ) -> None:
+        """Add a page about to be handed out, with the checkpoint reached
+        once it is done."""
+        page = _Page(self, len(images), checkpoint)
+        for image in images:
+            image.page = page
+        if checkpoint is not None:
+            self.head = checkpoint
+        self._pages.append(page)
+        self._advance()
+
+    def skip(self) -> None:
+        """Add a page which could not be fetched."""
+        page = _Page(self, 0, None)
+        page.failed = True
+        self._pages.append(page)
+        self._advance()
+
+    def _advance(self) -> None:
+        while self._pages and self._pages[0].left <= 0:
+            page = self._pages.popleft()
+            if page.failed and not self._held:
+                self._held = True
+                logger.warning(
+                    f"Checkpoint of {self.name} is held back for this run, "
+                    + "posts which failed are listed again next time."
+                )
+            if not self._held:
+                self._latest = page.checkpoint or self._latest
+        if self._latest is not None and (self._saver is None or self._saver.done()):
+            self._saver = asyncio.create_task(self._save())
+
+    async def _save(self) -> None:
+        from ...persistence import Services
+
+        while self._latest is not None:
+            checkpoint, self._latest = self._latest, None
+            try:
+                await Services.updateCheckpoint(checkpoint)
+            except Exception:
+                logger.exception(f"Failed to save checkpoint of {self.name}:")
+            else:
+                logger.trace(f"Checkpoint of {self.name} saved: {checkpoint!r}")
+
+    async def drain(self) -> None:
+        """Wait for checkpoints of finished pages to be saved."""
+        if self._saver is not None:
+            await asyncio.wait([self._saver])
 
 
 class ListSpiderWorker:
     site: str = ""
+    cursor: bool = False
+    anchored: bool = False
 
-    def __init__(self, **kwargs) -> None:
-        pass
+    def __init__(
+        self,
+        *,
+        proxy: Optional[str] = None,
+        filter: str = "",
+        pushdown: int = 0,
+        **kwargs,
+    ) -> None:
+        self.name: str = self.site
+        self._proxy: Optional[str] = proxy or ListSpiderConfig["proxy"].as_str() or None
+        self.filter = PostFilter(filter, pushdown)
+        self.ledger: Optional[CheckpointLedger] = None
 
     @Retry(
         retries=ListSpiderConfig["retries"]["times"].as_number(),
         delay=ListSpiderConfig["retries"]["delay"].as_number(),
     )
-    async def _listDownload(self, client: AsyncClient, url: str) -> APIResult_T:
+    async def _listDownload(self, url: Union[str, URL]) -> bytes:
         urlParsed = URL(url)
+        client = ClientRegistry.get(urlParsed, self._proxy)
         logger.info(
             "Start downloading list "
             + f"{urlParsed.full_path!r} from {urlParsed.host!r}."
         )
         try:
-            response = await client.get(
-                url,
-                headers={
-                    "User-Agent": randChoice(
-                        ListSpiderConfig["user-agents"].get(list)
-                        or [f"DanbooruSpider/{VERSION}"]
-                    )
-                },
-            )
+            async with Scheduler.slot(self.name):
+                beginTime = perf_counter()
+                response = await client.get(
+                    url,
+                    headers={
+                        "User-Agent": randChoice(
+                            ListSpiderConfig["user-agents"].get(list)
+                            or [f"DanbooruSpider/{VERSION}"]
+                        )
+                    },
+                )
+                ListLatency.observe(perf_counter() - beginTime, spider=self.name)
             response.raise_for_status()
-            data: APIResult_T = response.json()
+            data = response.content
+            PagesFetched.inc(spider=self.name)
             logger.trace(
                 "Finished downloading list "
                 + f"{urlParsed.full_path!r} from {urlParsed.host!r}."
@@ -63,30 +189,196 @@ class ListSpiderWorker:
     async def parse(self, data: APIResult_T) -> DanbooruImageList_T:
         raise NotImplementedException
 
-    async def fetch(self, page: int, size: int) -> APIResult_T:
+    def identifiers(self, data: APIResult_T) -> List[int]:
         raise NotImplementedException
 
+    async def fetch(self, page: int, size: int, before: Optional[int] = None) -> bytes:
+        raise NotImplementedException
+
+    async def load(self, body: bytes) -> Page_T:
+        """Decode a fetched page into its post IDs and the parsed posts.
+
+        Implementations may override this to do the whole decoding away from
+        the event loop, see ``utils.SyncToProcess``.
+        """
+        try:
+            data: APIResult_T = json.loads(body)
+        except ValueError as e:
+            raise SpiderException(f"List of {self.site} is not valid JSON: {e}")
+        identifiers = self.identifiers(data)
+        return identifiers, (await self.parse(data) if identifiers else [])
+
+    async def _fetchPage(self, page: int, size: int, before: Optional[int]) -> Page_T:
+        body = await self.fetch(page, size=size, before=before)
+        identifiers, result = await self.load(body)
+        Budget.charge(result)
+        for image in result:
+            Trace.attach(image, f"{self.name}/{image.id}")
+        return identifiers, result
+
+    async def _walk(
+        self, begin: int, end: int, size: int, before: Optional[int] = None
+    ) -> AsyncIterator[Page_T]:
+        """Yield post IDs and parsed posts page by page, in order.
+
+        Up to ``prefetch`` pages are requested ahead. With cursor support
+        pages are requested below the smallest ID seen so far, as page
+        offsets from it when the site allows combining both, otherwise the
+        next page is requested as soon as the previous one arrived. A page
+        failing by network errors is requested again up to ``retries.pages``
+        times before any later page is yielded, other failures skip it,
+        which holds the checkpoint back. Without page offsets the walk stops
+        there instead. An empty pair is yielded once the site runs out of
+        posts.
+        """
+        window = max(ListSpiderConfig["prefetch"].as_number(), 1)
+        retries: int = ListSpiderConfig["retries"]["pages"].as_number()
+        parallel = self.anchored or not self.cursor
+        pending: Deque[Tuple[int, int, Optional[int], int, asyncio.Task]] = deque()
+        page, pagenumber = begin, begin
+
+        def request(page: int, before: Optional[int]) -> asyncio.Task:
+            return asyncio.create_task(self._fetchPage(page, size, before))
+
+        def schedule(page: int, before: Optional[int]) -> None:
+            nonlocal pagenumber
+            pending.append((pagenumber, page, before, 0, request(page, before)))
+            pagenumber += 1
+
+        def fill() -> None:
+            nonlocal page
+            while (
+                pagenumber < end and len(pending) < window and (parallel or not pending)
+            ):
+                if pending and not Budget.admissible():
+                    break  # hand out the pages at hand to free the budget
+                schedule(page, before)
+                page += 1
+
+        try:
+            while pending or pagenumber < end:
+                if not pending:
+                    await Budget.admit()
+                fill()
+                number, requestPage, requestBefore, attempt, task = pending.popleft()
+                try:
+                    identifiers, result = await task
+                except Exception as e:
+                    if isinstance(e, NetworkException):
+                        logger.warning(
+                            f"A network error {e} occurred during fetching list from {self.site} page {number}."
+                        )
+                        if attempt < retries:
+                            retry = request(requestPage, requestBefore)
+                            pending.appendleft(
+                                (number, requestPage, requestBefore, attempt + 1, retry)
+                            )
+                            continue
+                    else:
+                        logger.exception(
+                            f"An unknown error {e} occurred during fetching list from {self.site} page {number}:"
+                        )
+                    if not parallel:
+                        logger.warning(
+                            f"List of {self.site} stops at page {number}, "
+                            + "which could not be fetched."
+                        )
+                        break
+                    logger.warning(f"Page {number} of {self.site} has been skipped.")
+                    if self.ledger is not None:
+                        self.ledger.skip()
+                    continue
+                if not identifiers:
+                    yield [], []
+                    break
+                if self.cursor:
+                    before, page = min(identifiers), len(pending) + 1
+                    if Budget.admissible():
+                        fill()
+                yield identifiers, result
+        finally:
+            for *_, task in pending:
+                task.cancel()
+        return
+
+    async def _update(
+        self, checkpoint: CheckpointsRead, end: int, size: int
+    ) -> AsyncIterator[DanbooruImageList_T]:
+        assert self.ledger is not None
+        highest, reached = checkpoint.highest_id, False
+        async for identifiers, result in self._walk(1, end, size):
+            if not identifiers:
+                reached = True
+                break
+            fresh = [i for i in result if i.id > checkpoint.highest_id]
+            for image in result:
+                if image.id <= checkpoint.highest_id:
+                    image.finish()
+            self.ledger.track(fresh)
+            if fresh:
+                yield fresh
+            highest = max(highest, *identifiers)
+            if min(identifiers) <= checkpoint.highest_id:
+                reached = True
+                break
+        if not reached:
+            logger.warning(
+                f"Update of {self.name} stopped before reaching known posts, "
+                + f"posts newer than {checkpoint.highest_id} may be missing."
+            )
+            return
+        self.ledger.track(
+            [], CheckpointsCreate(**{**checkpoint.dict(), "highest_id": highest})
+        )
+        logger.info(f"Spider {self.name} updated up to post {highest}.")
+
     async def run(
-        self, begin: int = 1, end: Optional[int] = None, size: Optional[int] = None
+        self,
+        begin: int = 1,
+        end: Optional[int] = None,
+        size: Optional[int] = None,
+        mode: Optional[str] = None,
     ) -> AsyncIterator[DanbooruImageList_T]:
+        from ...persistence import Services
+
         size = size or ListSpiderConfig["size"].as_number()
         end = end or ListSpiderConfig["max-page"].as_number()
-        for pagenumber in count(begin):
-            if pagenumber >= end:
-                break
-            try:
-                result: DanbooruImageList_T = await self.parse(
-                    await self.fetch(pagenumber, size=size)
-                )
-                if not result:
-                    break
+        mode = mode or ListSpiderConfig["mode"].as_str()
+        assert mode in ("full", "update")
+
+        saved = await Services.readCheckpoint(self.name)
+        self.ledger = CheckpointLedger(
+            self.name, saved and CheckpointsCreate(**saved.dict())
+        )
+        if saved is not None:
+            async for result in self._update(saved, end, size):
                 yield result
-            except NetworkException as e:
-                logger.warning(
-                    f"A network error {e} occurred during fetching list from {self.site} page {pagenumber}."
-                )
-            except Exception as e:
-                logger.exception(
-                    f"An unknown error {e} occurred during fetching list from {self.site} page {pagenumber}:"
+            checkpoint = self.ledger.head
+            assert checkpoint is not None
+            if mode == "update" or checkpoint.direction == CrawlDirection.FORWARD:
+                return
+
+        checkpoint = self.ledger.head
+        highest = checkpoint.highest_id if checkpoint else None
+        lowest = checkpoint.lowest_id if checkpoint else None
+        before = lowest if self.cursor else None
+        async for identifiers, result in self._walk(begin, end, size, before):
+            direction = CrawlDirection.BACKWARD
+            if identifiers:
+                highest = max(identifiers + ([] if highest is None else [highest]))
+                lowest = min(identifiers + ([] if lowest is None else [lowest]))
+            elif self.cursor or begin == 1:
+                direction = CrawlDirection.FORWARD
+            if highest is not None and lowest is not None:
+                checkpoint = CheckpointsCreate(
+                    **{
+                        "name": self.name,
+                        "highest_id": highest,
+                        "lowest_id": lowest,
+                        "direction": direction,
+                    }
                 )
+            self.ledger.track(result, checkpoint)
+            if identifiers:
+                yield result
         return
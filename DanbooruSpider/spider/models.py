@@ -1,9 +1,24 @@
+import json
+import sys
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
 from pydantic import BaseModel
 
+if TYPE_CHECKING:
+    from .budget import PipelineBudget
+    from .list.worker import _Page
+
 
 class Ratings(str, Enum):
     SAFE = "s"
@@ -11,18 +26,166 @@ class Ratings(str, Enum):
     EXPLICIT = "e"
 
 
-class DanbooruImage(BaseModel):
-    id: int
-    source: str
-    tags: List[str]
-    rating: Ratings
-    imageURL: str
-    imageMD5: str
-    imageExt: str
-    metadata: Dict[str, Any]
+class TagTable:
+    """Canonical copy of every tag string seen by this process.
+
+    Posts share their tag strings through it instead of each holding fresh
+    copies, a popular tag is stored once however many posts carry it.
+    """
+
+    def __init__(self) -> None:
+        self._tags: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def intern(self, tags: Iterable[str]) -> Tuple[str, ...]:
+        table = self._tags
+        return tuple(table.setdefault(i, i) for i in tags)
+
+    def split(self, text: str) -> Tuple[str, ...]:
+        return self.intern(text.split())
+
+
+Tags = TagTable()
+
+
+class DanbooruImage:
+    """Compact record of a post found by a list spider.
+
+    Tags are tuples of strings from ``Tags``, and the post as returned by
+    the API is kept as its JSON text in ``raw``, only decoded on access to
+    ``metadata``. A record charged to the pipeline budget gives its share
+    back by ``finish`` once the post has been handled, or when freed
+    without that. ``finish`` reports the post to the page it was listed on
+    as well, see ``CheckpointLedger``. Records are built already
+    validated, by the list parser for a whole page at once, so constructing
+    one checks nothing. ``dict``, ``json`` and ``parse_raw`` behave like
+    their pydantic counterparts.
+    """
+
+    FIELDS = (
+        "id",
+        "source",
+        "tags",
+        "rating",
+        "imageURL",
+        "imageMD5",
+        "imageExt",
+        "imageSize",
+        "raw",
+    )
+    __slots__ = (*FIELDS, "trace", "budget", "page")
+    budget: Optional["PipelineBudget"]
+    page: Optional["_Page"]
+
+    def __init__(
+        self,
+        id: int,
+        source: str,
+        tags: Tuple[str, ...],
+        rating: Ratings,
+        imageURL: str,
+        imageMD5: str,
+        imageExt: str,
+        imageSize: Optional[int],
+        raw: str,
+    ) -> None:
+        self.id = id
+        self.source = source
+        self.tags = tags
+        self.rating = rating
+        self.imageURL = imageURL
+        self.imageMD5 = imageMD5
+        self.imageExt = imageExt
+        self.imageSize = imageSize
+        self.raw = raw
+
+    def __del__(self) -> None:
+        # A post dropped unfinished is not acknowledged to its page
+        self._release()
+
+    def _release(self) -> None:
+        budget = getattr(self, "budget", None)
+        if budget is not None:
+            self.budget = None
+            budget.release(self)
+
+    def finish(self, failed: bool = False) -> None:
+        """Mark the post as handled, stored or skipped unless ``failed``."""
+        self._release()
+        page = getattr(self, "page", None)
+        if page is not None:
+            self.page = None
+            page.finish(failed)
+
+    def __repr__(self) -> str:
+        return f"<DanbooruImage {self.source}/{self.id} md5={self.imageMD5}>"
+
+    def __getstate__(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, i) for i in self.FIELDS)
+
+    def __setstate__(self, state: Tuple[Any, ...]) -> None:
+        for name, value in zip(self.FIELDS, state):
+            setattr(self, name, value)
+        # Records come back from the process pool with tags of their own.
+        self.tags = Tags.intern(self.tags)
+
+    def footprint(self) -> int:
+        """Estimated bytes held by this record, shared tags not counted."""
+        return sys.getsizeof(self) + sum(
+            map(
+                sys.getsizeof,
+                (self.raw, self.tags, self.imageURL, self.imageMD5, self.imageExt),
+            )
+        )
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return json.loads(self.raw)
+
+    def dict(self) -> Dict[str, Any]:
+        data = {i: getattr(self, i) for i in self.FIELDS if i != "raw"}
+        data.update(tags=[*self.tags], metadata=self.metadata)
+        return data
+
+    def json(self) -> str:
+        return json.dumps(self.dict())
+
+    @classmethod
+    def parse_obj(cls, data: Dict[str, Any]) -> "DanbooruImage":
+        return cls(
+            id=int(data["id"]),
+            source=str(data["source"]),
+            tags=Tags.intern(data["tags"]),
+            rating=Ratings(data["rating"]),
+            imageURL=str(data["imageURL"]),
+            imageMD5=str(data["imageMD5"]),
+            imageExt=str(data["imageExt"]),
+            imageSize=data.get("imageSize"),
+            raw=json.dumps(data["metadata"]),
+        )
+
+    @classmethod
+    def parse_raw(cls, text: str) -> "DanbooruImage":
+        return cls.parse_obj(json.loads(text))
+
+    @classmethod
+    def __get_validators__(cls) -> Iterator[Callable[[Any], "DanbooruImage"]]:
+        yield cls._validate
+
+    @classmethod
+    def _validate(cls, value: Any) -> "DanbooruImage":
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls.parse_obj(value)
+        raise TypeError(f"{type(value).__name__} is not a DanbooruImage")
 
 
 class ImageDownload(BaseModel):
+    __slots__ = ("trace",)
+
     source: str
     path: Path
     size: int
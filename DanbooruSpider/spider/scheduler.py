@@ -0,0 +1,148 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+from ..config import Config
+from ..log import logger
+from ..metrics import SchedulerSlots
+
+SchedulerConfig = Config["spider"]["scheduler"]
+
+
+class _Flow:
+    __slots__ = ("name", "weight", "virtual", "running", "waiters")
+
+    def __init__(self, name: str, weight: float = 1) -> None:
+        self.name = name
+        self.weight = weight
+        self.virtual = 0.0
+        self.running = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+
+class DownloadScheduler:
+    """Global download slots shared by all spiders.
+
+    Slots are handed out with start-time fair queuing: every spider has a
+    virtual clock advanced by ``1 / weight`` per granted slot and the waiting
+    spider with the smallest clock goes first. Spiders without waiting work
+    don't take part, so their share flows to the busy ones. While paused no
+    new slots are granted, downloads holding one run to completion.
+    """
+
+    def __init__(
+        self, workers: Optional[int] = None, bandwidth: Optional[int] = None
+    ) -> None:
+        self.workers: int = workers or SchedulerConfig["workers"].as_number()
+        self._bandwidth: int = (
+            SchedulerConfig["bandwidth"].as_number() if bandwidth is None else bandwidth
+        )
+        self._flows: Dict[str, _Flow] = {}
+        self._virtual = 0.0
+        self._running = 0
+        self._waiting = 0
+        self._paused = False
+        self._tokens = float(self._bandwidth)
+        self._updated: Optional[float] = None
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def pause(self) -> None:
+        if not self._paused:
+            logger.debug("Download scheduler paused.")
+        self._paused = True
+
+    def resume(self) -> None:
+        if self._paused:
+            logger.debug("Download scheduler resumed.")
+        self._paused = False
+        self._dispatch()
+
+    def register(self, name: str, weight: float = 1) -> None:
+        assert weight > 0
+        self._flow(name).weight = weight
+        logger.debug(f"Spider {name} registered to scheduler with weight {weight}.")
+
+    def _flow(self, name: str) -> _Flow:
+        if name not in self._flows:
+            self._flows[name] = _Flow(name)
+        return self._flows[name]
+
+    def _grant(self, flow: _Flow) -> None:
+        self._virtual = max(self._virtual, flow.virtual)
+        flow.virtual += 1 / flow.weight
+        flow.running += 1
+        self._running += 1
+
+    def _dispatch(self) -> None:
+        while self._running < self.workers and self._waiting and not self._paused:
+            flow = min(
+                (i for i in self._flows.values() if i.waiters),
+                key=lambda i: i.virtual,
+            )
+            waiter = flow.waiters.popleft()
+            self._waiting -= 1
+            if waiter.done():
+                continue
+            self._grant(flow)
+            waiter.set_result(None)
+
+    async def acquire(self, name: str) -> None:
+        flow = self._flow(name)
+        if not flow.waiters and not flow.running:
+            flow.virtual = max(flow.virtual, self._virtual)
+        if self._running < self.workers and not (self._waiting or self._paused):
+            self._grant(flow)
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        flow.waiters.append(waiter)
+        self._waiting += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(name)
+            raise
+
+    def release(self, name: str) -> None:
+        flow = self._flow(name)
+        flow.running -= 1
+        self._running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, name: str) -> AsyncIterator[None]:
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    async def throttle(self, size: int) -> None:
+        if self._bandwidth <= 0:
+            return
+        now = asyncio.get_event_loop().time()
+        if self._updated is not None:
+            self._tokens = min(
+                self._bandwidth, self._tokens + (now - self._updated) * self._bandwidth
+            )
+        self._updated = now
+        self._tokens -= size
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._bandwidth)
+
+
+Scheduler = DownloadScheduler()
+SchedulerSlots.track(lambda: Scheduler.running, state="running")
+SchedulerSlots.track(lambda: Scheduler.waiting, state="waiting")
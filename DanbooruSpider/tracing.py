@@ -0,0 +1,246 @@
+import asyncio
+import cProfile
+import heapq
+import io
+import json
+import pstats
+import signal
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import Config
+from .log import logger
+from .metrics import Metrics, StageLatency
+
+TracingConfig = Config["general"]["tracing"]
+PROFILE_PATH = Path(".") / "data" / "profiles"
+
+
+class Trace:
+    """Timestamps of one picture passing the pipeline stages.
+
+    Traces ride along as a ``trace`` slot on the models handed from one
+    stage to the next. The time between two marks is accounted to the stage
+    named by the later one.
+    """
+
+    __slots__ = ("name", "marks")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.marks: List[Tuple[str, float]] = [("listed", perf_counter())]
+
+    def mark(self, stage: str) -> None:
+        self.marks.append((stage, perf_counter()))
+
+    def stages(self) -> List[Tuple[str, float]]:
+        return [
+            (stage, end - begin)
+            for (_, begin), (stage, end) in zip(self.marks, self.marks[1:])
+        ]
+
+    @property
+    def total(self) -> float:
+        return self.marks[-1][1] - self.marks[0][1]
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "total_ms": self.total * 1000,
+            "stages": [(stage, duration * 1000) for stage, duration in self.stages()],
+        }
+
+    @classmethod
+    def attach(cls, target: Any, name: str) -> "Trace":
+        trace = cls(name)
+        object.__setattr__(target, "trace", trace)
+        return trace
+
+    @staticmethod
+    def of(target: Any) -> Optional["Trace"]:
+        return getattr(target, "trace", None)
+
+    @staticmethod
+    def carry(source: Any, target: Any) -> None:
+        trace = getattr(source, "trace", None)
+        if trace is not None:
+            object.__setattr__(target, "trace", trace)
+
+
+def mark(target: Any, stage: str) -> None:
+    trace = getattr(target, "trace", None)
+    if trace is not None:
+        trace.mark(stage)
+
+
+class TraceCollector:
+    """Aggregates finished traces into stage breakdowns and keeps the
+    ``slow-samples`` slowest of them."""
+
+    def __init__(self, samples: Optional[int] = None) -> None:
+        self._samples: int = samples or TracingConfig["slow-samples"].as_number()
+        self._threshold: float = TracingConfig["slow-threshold"].as_number()
+        self._stages: Dict[str, List[float]] = {}
+        self._slow: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._finished = 0
+
+    def finish(self, trace: Optional[Trace]) -> None:
+        if trace is None:
+            return
+        self._finished += 1
+        for stage, duration in trace.stages():
+            StageLatency.observe(duration, stage=stage)
+            count, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+            longest = max(longest, duration)
+            self._stages[stage] = [count + 1, total + duration, longest]
+        entry = (trace.total, self._finished, trace.describe())
+        if len(self._slow) < self._samples:
+            heapq.heappush(self._slow, entry)
+        elif entry[0] > self._slow[0][0]:
+            heapq.heapreplace(self._slow, entry)
+        if 0 < self._threshold < trace.total:
+            logger.info(f"Slow picture trace: {entry[2]!r}")
+
+    def report(self) -> Dict[str, Any]:
+        overall = sum(total for _, total, _ in self._stages.values()) or 1
+        return {
+            "finished": self._finished,
+            "stages": {
+                stage: {
+                    "count": count,
+                    "mean_ms": total / count * 1000,
+                    "max_ms": longest * 1000,
+                    "share": total / overall,
+                }
+                for stage, (count, total, longest) in self._stages.items()
+            },
+            "slow": [i for *_, i in sorted(self._slow, reverse=True)],
+        }
+
+    def summary(self) -> List[str]:
+        report = self.report()
+        lines = [f"{report['finished']} pictures traced, time spent per stage:"]
+        stages = sorted(report["stages"].items(), key=lambda i: -i[1]["share"])
+        for stage, data in stages:
+            lines.append(
+                f"{stage:>12} {data['share']:6.1%} "
+                + f"mean {data['mean_ms']:.1f}ms max {data['max_ms']:.1f}ms"
+            )
+        return lines
+
+    async def dump(self, interval: Optional[float] = None) -> None:
+        interval = interval or TracingConfig["report-interval"].as_number()
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("\n".join(self.summary()))
+
+
+class Profiler:
+    """Captures a cProfile or tracemalloc window of the running process.
+
+    Only the event loop thread is seen by cProfile, work pushed to executor
+    threads through ``SyncToAsync`` shows up as time spent awaiting it.
+    """
+
+    KINDS = ("cpu", "memory")
+    _running = False
+
+    @classmethod
+    def _path(cls, kind: str, suffix: str) -> Path:
+        PROFILE_PATH.mkdir(parents=True, exist_ok=True)
+        return PROFILE_PATH / f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{suffix}"
+
+    @classmethod
+    async def cpu(cls, duration: float) -> Path:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profile.disable()
+        path = cls._path("cpu", "prof")
+        profile.dump_stats(str(path))
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(30)
+        path.with_suffix(".txt").write_text(text.getvalue())
+        return path
+
+    @classmethod
+    async def memory(cls, duration: float) -> Path:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(TracingConfig["tracemalloc-frames"].as_number())
+        before = tracemalloc.take_snapshot()
+        try:
+            await asyncio.sleep(duration)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+        path = cls._path("memory", "snapshot")
+        after.dump(str(path))
+        lines = ["Top allocations:"]
+        lines += [str(i) for i in after.statistics("lineno")[:30]]
+        lines += ["", f"Growth during the {duration}s window:"]
+        lines += [str(i) for i in after.compare_to(before, "lineno")[:30]]
+        path.with_suffix(".txt").write_text("\n".join(lines) + "\n")
+        return path
+
+    @classmethod
+    async def capture(cls, kind: str, duration: Optional[float] = None) -> Path:
+        assert kind in cls.KINDS, f"Unknown profile kind {kind!r}."
+        if cls._running:
+            raise RuntimeError("A profile is being captured already.")
+        duration = duration or TracingConfig["profile-duration"].as_number()
+        cls._running = True
+        logger.info(f"Capturing {kind} profile for {duration} seconds.")
+        try:
+            path = await (cls.cpu if kind == "cpu" else cls.memory)(duration)
+        finally:
+            cls._running = False
+        logger.info(f"Profile {kind} saved to {path}, see {path.with_suffix('.txt')}.")
+        return path
+
+    @classmethod
+    def trigger(cls, kind: str) -> None:
+        async def capture() -> None:
+            try:
+                await cls.capture(kind)
+            except RuntimeError as e:
+                logger.warning(str(e))
+
+        asyncio.create_task(capture())
+
+    @classmethod
+    def installSignals(cls) -> None:
+        """``SIGUSR1`` captures a CPU profile, ``SIGUSR2`` a memory one.
+
+        Both are missing on Windows, profiles are taken through the metrics
+        endpoint there."""
+        if not hasattr(signal, "SIGUSR1"):
+            return
+        loop = asyncio.get_event_loop()
+        for number, kind in ((signal.SIGUSR1, "cpu"), (signal.SIGUSR2, "memory")):
+            loop.add_signal_handler(number, cls.trigger, kind)
+
+
+Tracer = TraceCollector()
+
+
+async def _tracesRoute(query: Dict[str, str]) -> Tuple[str, bytes]:
+    return "application/json", json.dumps(Tracer.report(), indent=2).encode()
+
+
+async def _profileRoute(query: Dict[str, str]) -> Tuple[str, bytes]:
+    seconds = query.get("seconds")
+    path = await Profiler.capture(
+        query.get("kind", "cpu"), float(seconds) if seconds else None
+    )
+    return "text/plain", path.with_suffix(".txt").read_bytes()
+
+
+Metrics.route("/traces", _tracesRoute)
+Metrics.route("/profile", _profileRoute)
@@ -1,26 +1,48 @@
-from asyncio import AbstractEventLoop, get_event_loop
+import json
+import multiprocessing
+import os
+from asyncio import AbstractEventLoop, Future, get_event_loop
 from asyncio import sleep as sleepAsync
+from concurrent.futures.process import BrokenProcessPool, ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
-from functools import partial, wraps
+from functools import partial, reduce, wraps
 from hashlib import md5
-from inspect import iscoroutinefunction
+from importlib import import_module
+from inspect import iscoroutinefunction, unwrap
 from pathlib import Path
 from random import randint
 from shutil import rmtree
 from time import sleep as sleepSync
 from time import time
-from typing import Any, Awaitable, Callable, Optional, Union
+from typing import (
+    Any,
+    Awaitable,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 from uuid import uuid4
 
 import aiofiles
 from aiofiles.base import AiofilesContextManager
 
+from .config import Config
 from .log import logger
+from .metrics import Retries
+
+ExecutorConfig = Config["general"]["executor"]
 
 TEMP_FILE_DIR = Path(".") / "data" / "temp"
+HASH_READ_SIZE = 1024 * 1024
+STREAM_BUFFER_SIZE = 1024 * 1024
 
 _EXECUTOR = ThreadPoolExecutor()
-rmtree(TEMP_FILE_DIR, ignore_errors=True)
+if multiprocessing.parent_process() is None:
+    rmtree(TEMP_FILE_DIR, ignore_errors=True)
 TEMP_FILE_DIR.mkdir(exist_ok=True)
 
 AsyncFunc_T = Callable[..., Awaitable[Any]]
@@ -37,7 +59,7 @@ class TempFile:
         return self._fullPath.absolute()
 
     def clean(self) -> None:
-        self._fullPath.rmdir()
+        self._fullPath.unlink(missing_ok=True)
 
     def __enter__(self) -> Path:
         return self.create()
@@ -97,7 +119,7 @@ def Retry(
     func: Optional[Callable] = None, retries: int = 5, delay: float = 5
 ) -> Callable:
     if func is None:
-        return partial(Retry, retries=retries)
+        return partial(Retry, retries=retries, delay=delay)
 
     @Timing
     @wraps(func)
@@ -113,6 +135,7 @@ def Retry(
                     f"Error {e!r}{e} occurred during executing sync function "
                     + f"{func.__qualname__!r}, retring ({i}/{retries})."
                 )
+                Retries.inc(function=func.__qualname__)
             sleepSync(delay if delay > 0 else randint(0, 10))
 
     @Timing
@@ -129,6 +152,7 @@ def Retry(
                     f"Error {e!r}{e} occurred during executing async function "
                     + f"{func.__qualname__!r}, retring ({i}/{retries})."
                 )
+                Retries.inc(function=func.__qualname__)
             await sleepAsync(delay if delay > 0 else randint(0, 10))
 
     return asyncWrapper if iscoroutinefunction(func) else syncWrapper
@@ -154,20 +178,268 @@ def SyncToAsync(
     return wrapper
 
 
+class ProcessPool:
+    """Process pool for CPU-bound work which would hold up the event loop.
+
+    Worker processes are spawned on first use and import the modules of the
+    functions they run. With ``processes`` set to 0 the work is done on the
+    thread pool instead.
+    """
+
+    _executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def get(cls) -> Optional[ProcessPoolExecutor]:
+        processes: int = ExecutorConfig["processes"].as_number()
+        if processes <= 0:
+            return None
+        if cls._executor is None:
+            cls._executor = ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context("spawn")
+            )
+            logger.debug(f"Process pool of {processes} workers created.")
+        return cls._executor
+
+    @classmethod
+    async def run(cls, func: Callable, *args, **kwargs) -> Any:
+        """Run ``func`` in a worker process, which finds it by its module and
+        qualified name, so it has to be defined at module or class level."""
+        eventLoop = get_event_loop()
+        executor = cls.get()
+        if executor is None:
+            runner: Callable[[], Any] = lambda: func(*args, **kwargs)
+            return await eventLoop.run_in_executor(_EXECUTOR, runner)
+        call = partial(_invoke, func.__module__, func.__qualname__, args, kwargs)
+        try:
+            return await eventLoop.run_in_executor(executor, call)
+        except BrokenProcessPool:
+            logger.warning("A worker process died, the process pool is recreated.")
+            cls.shutdown(wait=False)
+            raise
+
+    @classmethod
+    def shutdown(cls, wait: bool = True) -> None:
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=wait)
+            cls._executor = None
+
+
+def _invoke(module: str, qualname: str, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+    func = reduce(getattr, qualname.split("."), import_module(module))
+    return unwrap(func)(*args, **kwargs)
+
+
+def SyncToProcess(func: Callable) -> AsyncFunc_T:
+    """Like ``SyncToAsync``, but runs ``func`` in the ``ProcessPool``.
+
+    Arguments and results are pickled, so they should be compact, such as
+    raw response bodies in and parsed records out.
+    """
+
+    @Timing
+    @wraps(func)
+    async def wrapper(*args, **kwargs) -> Any:
+        return await ProcessPool.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def BatchToProcess(
+    func: Optional[Callable] = None, *, size: Optional[int] = None
+) -> Callable[[Any], Awaitable[Any]]:
+    """Turn ``func``, mapping a list of items to a list of results, into a
+    coroutine function taking a single item.
+
+    Items passed within one event loop iteration are sent to the
+    ``ProcessPool`` together, up to ``batch-size`` of them per call.
+    """
+    if func is None:
+        return partial(BatchToProcess, size=size)  # type: ignore
+    batchSize: int = size or ExecutorConfig["batch-size"].as_number()
+    pending: List[Tuple[Any, Future]] = []
+
+    def resolve(batch: List[Tuple[Any, Future]], result: Future) -> None:
+        for index, (_, waiter) in enumerate(batch):
+            if waiter.done():
+                continue
+            elif result.cancelled():
+                waiter.cancel()
+            elif result.exception() is not None:
+                waiter.set_exception(result.exception())  # type: ignore
+            else:
+                waiter.set_result(result.result()[index])
+
+    def flush() -> None:
+        if not pending:
+            return
+        batch = pending[:]
+        pending.clear()
+        assert func
+        task = get_event_loop().create_task(
+            ProcessPool.run(func, [item for item, _ in batch])
+        )
+        task.add_done_callback(partial(resolve, batch))
+
+    @wraps(func)
+    async def wrapper(item: Any) -> Any:
+        eventLoop = get_event_loop()
+        waiter = eventLoop.create_future()
+        pending.append((item, waiter))
+        if len(pending) >= batchSize:
+            flush()
+        elif len(pending) == 1:
+            eventLoop.call_soon(flush)
+        return await waiter
+
+    return wrapper
+
+
 class HashCreator:
     def __init__(self, algorithm: Callable = md5) -> None:
         self._hash = algorithm()
 
-    @SyncToAsync
-    def update(self, data: bytes) -> int:
+    def updateSync(self, data: bytes) -> int:
         self._hash.update(data)
         return len(data)
 
+    @SyncToAsync
+    def update(self, data: bytes) -> int:
+        return self.updateSync(data)
+
     @SyncToAsync
     def hexdigest(self) -> str:
         return self._hash.hexdigest()
 
 
+class StreamSink:
+    """Buffered hash-and-write target for streamed downloads.
+
+    Chunks are collected until ``bufferSize`` bytes are pending, then hashed
+    and written to the file by a single executor call. The file may be
+    preallocated to its expected size and is truncated to the written size
+    when the sink is closed.
+    """
+
+    def __init__(
+        self, file: BinaryIO, hashData: HashCreator, offset: int, bufferSize: int
+    ) -> None:
+        self._file = file
+        self._hash = hashData
+        self._bufferSize = bufferSize
+        self._buffer = bytearray()
+        self.written = offset
+
+    @classmethod
+    async def open(
+        cls,
+        path: Path,
+        hashData: HashCreator,
+        offset: int = 0,
+        bufferSize: int = 0,
+        preallocate: Optional[int] = None,
+    ) -> "StreamSink":
+        def opener() -> BinaryIO:
+            file = path.open("r+b")
+            if preallocate and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(file.fileno(), 0, preallocate)
+                except OSError:
+                    pass
+            file.seek(offset)
+            return file
+
+        eventLoop = get_event_loop()
+        file = await eventLoop.run_in_executor(_EXECUTOR, opener)
+        return cls(file, hashData, offset, bufferSize or STREAM_BUFFER_SIZE)
+
+    def _flush(self, data: bytearray) -> int:
+        self._hash.updateSync(data)
+        return self._file.write(data)
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        data, self._buffer = self._buffer, bytearray()
+        eventLoop = get_event_loop()
+        self.written += await eventLoop.run_in_executor(_EXECUTOR, self._flush, data)
+
+    async def write(self, chunk: bytes) -> int:
+        self._buffer += chunk
+        if len(self._buffer) >= self._bufferSize:
+            await self.flush()
+        return len(chunk)
+
+    async def close(self) -> Tuple[int, str]:
+        def closer() -> None:
+            try:
+                self._file.truncate(self.written)
+            finally:
+                self._file.close()
+
+        try:
+            await self.flush()
+        finally:
+            await get_event_loop().run_in_executor(_EXECUTOR, closer)
+        return self.written, await self._hash.hexdigest()
+
+
+class PartialFile:
+    """Download target kept across retries and restarts.
+
+    The file is named after the expected digest and accompanied by a JSON
+    state file holding the number of bytes known to be written and the
+    validators of the response they came from. Its methods do their file
+    I/O on the thread pool.
+    """
+
+    def __init__(self, name: str, *, folder: Optional[str] = None) -> None:
+        folderPath = Path(folder or str(TEMP_FILE_DIR))
+        folderPath.mkdir(parents=True, exist_ok=True)
+        self.path = (folderPath / f"{name}.part").absolute()
+        self._statePath = folderPath / f"{name}.part.json"
+
+    @SyncToAsync
+    def state(self) -> Dict[str, Any]:
+        try:
+            state: Dict[str, Any] = json.loads(self._statePath.read_text("utf-8"))
+        except (OSError, ValueError):
+            return {}
+        if not self.path.is_file() or self.path.stat().st_size < state["offset"]:
+            return {}
+        return state
+
+    @SyncToAsync
+    def save(self, **state: Any) -> None:
+        temporary = self._statePath.with_suffix(".tmp")
+        temporary.write_text(json.dumps(state), "utf-8")
+        temporary.replace(self._statePath)
+
+    @SyncToAsync
+    def reset(self) -> None:
+        self._statePath.unlink(missing_ok=True)
+        self.path.open("wb").close()
+
+    @SyncToAsync
+    def finish(self) -> Path:
+        self._statePath.unlink(missing_ok=True)
+        return self.path
+
+    @SyncToAsync
+    def clean(self) -> None:
+        self._statePath.unlink(missing_ok=True)
+        self.path.unlink(missing_ok=True)
+
+    @SyncToAsync
+    def rehash(self, hashData: HashCreator, offset: int) -> int:
+        with self.path.open("rb") as f:
+            while offset > f.tell():
+                chunk = f.read(min(HASH_READ_SIZE, offset - f.tell()))
+                if not chunk:
+                    break
+                hashData.updateSync(chunk)
+            return f.tell()
+
+
 def AsyncOpen(
     file: Union[str, Path],
     mode: str = "r",
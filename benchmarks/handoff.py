@@ -0,0 +1,106 @@
+"""Time-to-first-byte of a queued download after a slot has been freed.
+
+Compares the former sleep-polling admission loop with ``DownloadScheduler``
+against a local HTTP server. Run it from the repository root::
+
+    python -m benchmarks.handoff --workers 4 --jobs 64
+"""
+import argparse
+import asyncio
+import json
+from statistics import mean, median
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+from httpx import AsyncClient
+
+from DanbooruSpider.spider.scheduler import DownloadScheduler
+
+
+class PollingGate:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.running = 0
+
+    async def acquire(self, name: str) -> None:
+        while self.running >= self.workers:
+            await asyncio.sleep(1)
+        self.running += 1
+
+    def release(self, name: str) -> None:
+        self.running -= 1
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while await reader.readuntil(b"\r\n\r\n"):
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n"
+                + b"Content-Type: text/plain\r\n\r\nok"
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def measure(gate: Any, url: str, jobs: int, hold: float) -> List[float]:
+    releases: List[float] = []
+    latencies: List[float] = []
+
+    async with AsyncClient() as client:
+
+        async def job() -> None:
+            await gate.acquire("benchmark")
+            try:
+                freedAt: Optional[float] = releases[-1] if releases else None
+                response = await client.get(url)
+                firstByte = perf_counter()
+                response.raise_for_status()
+                if freedAt is not None:
+                    latencies.append(firstByte - freedAt)
+                await asyncio.sleep(hold)
+            finally:
+                releases.append(perf_counter())
+                gate.release("benchmark")
+
+        await asyncio.gather(*[job() for _ in range(jobs)])
+    return latencies
+
+
+def summary(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        "samples": len(ordered),
+        "mean_ms": mean(ordered) * 1000,
+        "p50_ms": median(ordered) * 1000,
+        "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+    }
+
+
+async def main(arguments: argparse.Namespace) -> Dict[str, Any]:
+    server = await asyncio.start_server(_serve, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/"
+    results: Dict[str, Any] = {}
+    try:
+        for name, gate in [
+            ("polling", PollingGate(arguments.workers)),
+            ("scheduler", DownloadScheduler(workers=arguments.workers, bandwidth=0)),
+        ]:
+            results[name] = summary(
+                await measure(gate, url, arguments.jobs, arguments.hold)
+            )
+    finally:
+        server.close()
+        await server.wait_closed()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=32)
+    parser.add_argument("--hold", type=float, default=0.05)
+    print(json.dumps(asyncio.run(main(parser.parse_args())), indent=4))
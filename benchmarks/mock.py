@@ -0,0 +1,197 @@
+"""Fake Danbooru/Moebooru API serving synthetic posts and pictures.
+
+Post lists are served on ``/posts.json`` (Danbooru flavour, ``tag_string``
+and ``page=b<id>`` cursors) and ``/post.json`` (Moebooru flavour, ``tags``
+and ``id:<<id>`` searches), pictures on ``/images/<id>.jpg``. Latency,
+bandwidth, server errors and ``429 Too Many Requests`` can be injected.
+"""
+import asyncio
+import json
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from hashlib import md5
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from random import Random
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+CHUNK_SIZE = 65536
+
+
+@dataclass
+class MockOptions:
+    pages: int = 10
+    pageSize: int = 100
+    imageSize: int = 262144
+    latency: float = 0.0  # Seconds before each response
+    bandwidth: int = 0  # Bytes per second and response, 0 means unlimited
+    errorRate: float = 0.0  # Share of requests answered with 500
+    throttleRate: float = 0.0  # Share of requests answered with 429
+    seed: int = 0
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    lists: int = 0
+    images: int = 0
+    errors: int = 0
+    throttled: int = 0
+    bytes: int = 0
+    statuses: Dict[int, int] = field(default_factory=dict)
+
+
+def imageBody(identifier: int, size: int) -> bytes:
+    pattern = f"{identifier:016d}".encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+@lru_cache(maxsize=None)
+def imageDigest(identifier: int, size: int) -> str:
+    return md5(imageBody(identifier, size)).hexdigest()
+
+
+class MockBooru:
+    def __init__(self, options: MockOptions) -> None:
+        self.options = options
+        self.stats = MockStats()
+        self._random = Random(options.seed)
+        self._port = 0
+
+    @property
+    def total(self) -> int:
+        return self.options.pages * self.options.pageSize
+
+    def _post(self, identifier: int, danbooru: bool) -> Dict[str, Any]:
+        digest = imageDigest(identifier, self.options.imageSize)
+        tags = f"tag_{identifier % 97} tag_{identifier % 13} common"
+        return {
+            "id": identifier,
+            ("tag_string" if danbooru else "tags"): tags,
+            "rating": "sqe"[identifier % 3],
+            "file_url": f"http://127.0.0.1:{self._port}/images/{identifier}.jpg",
+            "md5": digest,
+            "file_size": self.options.imageSize,
+            "width": 1000 + identifier % 1000,
+            "height": 800 + identifier % 800,
+            "score": identifier % 200,
+        }
+
+    def posts(self, path: str, query: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+        danbooru = path == "/posts.json"
+        limit = int(query.get("limit", ["100"])[0])
+        page, below = query.get("page", ["1"])[0], self.total + 1
+        if page.startswith("b"):
+            page, below = "1", int(page[1:])
+        for tag in query.get("tags", [""])[0].split():
+            if tag.startswith("id:<"):
+                below = min(below, int(tag[4:]))
+        begin = below - 1 - (int(page) - 1) * limit
+        return [
+            self._post(i, danbooru) for i in range(begin, max(begin - limit, 0), -1)
+        ]
+
+    async def _respond(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes = b"",
+        contentType: str = "application/json",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.stats.statuses[status] = self.stats.statuses.get(status, 0) + 1
+        reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests"}
+        head = [
+            f"HTTP/1.1 {status} {reason.get(status, 'Internal Server Error')}",
+            f"Content-Type: {contentType}",
+            f"Content-Length: {len(body)}",
+            *[f"{k}: {v}" for k, v in (headers or {}).items()],
+        ]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        bandwidth = self.options.bandwidth
+        for offset in range(0, len(body), CHUNK_SIZE):
+            chunk = body[offset : offset + CHUNK_SIZE]
+            writer.write(chunk)
+            await writer.drain()
+            if bandwidth > 0:
+                await asyncio.sleep(len(chunk) / bandwidth)
+        await writer.drain()
+        self.stats.bytes += len(body)
+
+    async def _request(self, writer: asyncio.StreamWriter, target: str) -> None:
+        self.stats.requests += 1
+        if self.options.latency > 0:
+            await asyncio.sleep(self.options.latency)
+        roll = self._random.random()
+        if roll < self.options.throttleRate:
+            self.stats.throttled += 1
+            return await self._respond(writer, 429, headers={"Retry-After": "1"})
+        if roll < self.options.throttleRate + self.options.errorRate:
+            self.stats.errors += 1
+            return await self._respond(writer, 500)
+        url = urlsplit(target)
+        if url.path in ("/posts.json", "/post.json"):
+            self.stats.lists += 1
+            body = json.dumps(self.posts(url.path, parse_qs(url.query))).encode()
+            return await self._respond(writer, 200, body)
+        if url.path.startswith("/images/"):
+            identifier = int(url.path[len("/images/") :].split(".")[0])
+            if 0 < identifier <= self.total:
+                self.stats.images += 1
+                size = self.options.imageSize
+                return await self._respond(
+                    writer,
+                    200,
+                    imageBody(identifier, size),
+                    "image/jpeg",
+                    {"ETag": f'"{imageDigest(identifier, size)}"'},
+                )
+        await self._respond(writer, 404)
+
+    async def _serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                _, target, _ = head.split(b"\r\n", 1)[0].decode().split(" ", 2)
+                await self._request(writer, target)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, connection: Connection) -> None:
+        server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self._port = server.sockets[0].getsockname()[1]
+        connection.send(self._port)
+        await asyncio.get_event_loop().run_in_executor(None, connection.recv)
+        server.close()
+        connection.send(asdict(self.stats))
+
+
+def _main(options: MockOptions, connection: Connection) -> None:
+    asyncio.run(MockBooru(options).run(connection))
+
+
+class MockServer:
+    """Run a ``MockBooru`` in a child process so it doesn't compete with the
+    measured pipeline for the event loop."""
+
+    def __init__(self, options: MockOptions) -> None:
+        self.options = options
+        self._connection, child = Pipe()
+        self._process = Process(target=_main, args=(options, child), daemon=True)
+        self.port = 0
+
+    def start(self) -> str:
+        self._process.start()
+        self.port = self._connection.recv()
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self) -> Dict[str, Any]:
+        self._connection.send(None)
+        stats: Dict[str, Any] = self._connection.recv()
+        self._process.join()
+        return stats
@@ -0,0 +1,262 @@
+"""End-to-end crawl of a local fake Danbooru/Moebooru site.
+
+Drives the real ``ListSpiderManager`` -> ``ImageSpiderWorker`` ->
+``Persistence`` -> ``DatabaseServices`` pipeline in a scratch directory and
+reports throughput, download latency, peak and steady-state RSS and database
+ingest rate.
+Run it from the repository root::
+
+    python -m benchmarks.pipeline --pages 20 --latency 0.02 --output run.json
+    python -m benchmarks.pipeline --compare run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+from pathlib import Path
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+from typing import Any, Dict, List
+
+from .mock import MockOptions, MockServer
+
+ROOT = Path(__file__).resolve().parent.parent
+FLAVOURS = {"danbooru": ("/posts.json", "cursor"), "moebooru": ("/post.json", "id-tag")}
+COMPARED = (
+    "images_per_s",
+    "mb_per_s",
+    "latency_p50_ms",
+    "latency_p99_ms",
+    "loop_lag_p99_ms",
+)
+LAG_INTERVAL = 0.01
+RSS_INTERVAL = 0.25
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def prepare(folder: Path, arguments: argparse.Namespace) -> None:
+    """Write a configuration pointing the pipeline at the fake site.
+
+    Retry delays are shortened, otherwise the injected errors would mostly
+    measure the configured back-off.
+    """
+    (folder / "data").mkdir(parents=True, exist_ok=True)
+    copyfile(ROOT / "data" / "config.default.yml", folder / "data" / "config.default.yml")
+    overrides = {
+        "general": {
+            "log": {"level": arguments.log_level},
+            "metrics": {"port": 0, "log-interval": 0},
+            "executor": {"processes": arguments.processes},
+        },
+        "spider": {
+            "images": {"retries": {"times": 10, "delay": arguments.retry_delay}},
+            "scheduler": {"workers": arguments.workers},
+            "budget": {"in-flight": arguments.in_flight, "rss": arguments.rss_limit},
+            "lists": {
+                "size": arguments.page_size,
+                "max-page": arguments.pages + 2,
+                "retries": {"times": 10, "delay": arguments.retry_delay},
+            },
+        },
+        "persistence": {
+            "storage": {"backend": arguments.storage},
+            "space": {"free-space": 0},
+        },
+    }
+    # JSON is valid YAML, confuse merges it over the defaults
+    (folder / "data" / "config.yml").write_text(json.dumps(overrides, indent=2))
+
+
+def resident() -> float:
+    """Current RSS in MiB, the peak where ``/proc`` is not available."""
+    try:
+        pages = int(Path("/proc/self/statm").read_text().split()[1])
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return pages * resource.getpagesize() / 2 ** 20
+
+
+async def probe(lags: List[float], rss: List[float]) -> None:
+    """Record how late the event loop wakes up from short sleeps, and the
+    RSS every ``RSS_INTERVAL`` seconds."""
+    loop = asyncio.get_event_loop()
+    sampledTime = loop.time()
+    while True:
+        beginTime = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - beginTime - LAG_INTERVAL)
+        if loop.time() - sampledTime >= RSS_INTERVAL:
+            sampledTime = loop.time()
+            rss.append(resident())
+
+
+async def crawl(url: str, pagination: str, filter: str) -> Dict[str, Any]:
+    from DanbooruSpider.metrics import IngestBatchSize, IngestLatency
+    from DanbooruSpider.persistence import Persistence, Services, Space
+    from DanbooruSpider.spider import (
+        ClientRegistry,
+        ImageSpiderWorker,
+        ListSpiderManager,
+    )
+    from DanbooruSpider.utils import ProcessPool
+
+    latencies: List[float] = []
+    lags: List[float] = []
+    rss: List[float] = []
+
+    class TimedImageSpiderWorker(ImageSpiderWorker):
+        async def _imageDownload(self, data):
+            beginTime = perf_counter()
+            result = await super()._imageDownload(data)
+            latencies.append(perf_counter() - beginTime)
+            return result
+
+    await Services.loadHashIndex()
+    await Space.load()
+    ListSpiderManager.instance(
+        "danbooru-unified",
+        "mock",
+        {"url": url, "pagination": pagination, "filter": filter, "pushdown": 2},
+    )
+    beginTime = perf_counter()
+    prober = asyncio.create_task(probe(lags, rss))
+    queue = await ListSpiderManager.run(name="mock")
+    images, totalSize, failures = 0, 0, 0
+    async for image in TimedImageSpiderWorker(queue, name="mock").results():
+        if not Persistence.verify(image):
+            failures += 1
+            await Persistence.discard(image)
+            image.data.finish(failed=True)
+            continue
+        locator = await Persistence.save(image)
+        await Services.createImage(image, locator)
+        images, totalSize = images + 1, totalSize + image.size
+    await Services.flush()
+    await ListSpiderManager.drain()
+    elapsed = perf_counter() - beginTime
+    prober.cancel()
+    await ClientRegistry.close()
+    ProcessPool.shutdown()
+
+    def histogram(metric) -> Dict[str, float]:
+        samples = {name: value for name, _, value in metric.samples()}
+        return {
+            "count": samples.get(f"{metric.name}_count", 0),
+            "sum": samples.get(f"{metric.name}_sum", 0),
+        }
+
+    commit, batches = histogram(IngestLatency), histogram(IngestBatchSize)
+    return {
+        "images": images,
+        "bytes": totalSize,
+        "verify_failures": failures,
+        "elapsed_s": elapsed,
+        "images_per_s": images / elapsed,
+        "mb_per_s": totalSize / elapsed / 1e6,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+        "loop_lag_p50_ms": percentile(lags, 0.5) * 1000,
+        "loop_lag_p99_ms": percentile(lags, 0.99) * 1000,
+        # the first half of the run is spent warming up caches and pools
+        "steady_rss_mib": percentile(rss[len(rss) // 2 :], 0.5),
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "db_ingest": {
+            "pictures": batches["sum"],
+            "batches": batches["count"],
+            "commit_s": commit["sum"],
+            "pictures_per_commit_s": batches["sum"] / commit["sum"]
+            if commit["sum"]
+            else 0.0,
+            "pictures_per_s": batches["sum"] / elapsed,
+        },
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, str]:
+    return {
+        key: f"{baseline[key]:.4g} -> {current[key]:.4g} "
+        + f"({(current[key] / baseline[key] - 1) * 100:+.1f}%)"
+        for key in (*COMPARED, "steady_rss_mib", "peak_rss_mib")
+        if baseline.get(key)
+    }
+
+
+def main(arguments: argparse.Namespace) -> Dict[str, Any]:
+    output = arguments.output and Path(arguments.output).resolve()
+    baseline = arguments.compare and json.loads(Path(arguments.compare).read_text())
+    options = MockOptions(
+        pages=arguments.pages,
+        pageSize=arguments.page_size,
+        imageSize=arguments.image_size,
+        latency=arguments.latency,
+        bandwidth=arguments.bandwidth,
+        errorRate=arguments.error_rate,
+        throttleRate=arguments.throttle_rate,
+        seed=arguments.seed,
+    )
+    server = MockServer(options)
+    url = server.start()
+    folder = Path(arguments.workdir or mkdtemp(prefix="danbooru-benchmark-"))
+    prepare(folder, arguments)
+    path, pagination = FLAVOURS[arguments.flavour]
+    workingDirectory = os.getcwd()
+    os.chdir(folder)
+    sys.path.insert(0, str(ROOT))
+    try:
+        results: Dict[str, Any] = {
+            "parameters": vars(arguments),
+            **asyncio.run(crawl(url + path, pagination, arguments.filter)),
+            "expected_images": arguments.pages * arguments.page_size,
+        }
+    finally:
+        os.chdir(workingDirectory)
+        serverStats = server.stop()
+        if not arguments.workdir:
+            rmtree(folder, ignore_errors=True)
+    results["server"] = serverStats
+    if baseline:
+        results["comparison"] = compare(results, baseline)
+    if output:
+        output.write_text(json.dumps(results, indent=4))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--flavour", choices=[*FLAVOURS], default="moebooru")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--image-size", type=int, default=262144, help="bytes")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per response")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="429 share")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument(
+        "--processes", type=int, default=2, help="process pool size, 0 uses threads"
+    )
+    parser.add_argument(
+        "--in-flight", type=int, default=0, help="bytes listed but not stored"
+    )
+    parser.add_argument("--rss-limit", type=int, default=0, help="bytes")
+    parser.add_argument("--filter", default="", help="post filter expression")
+    parser.add_argument("--storage", choices=["tree", "shards"], default="tree")
+    parser.add_argument("--retry-delay", type=float, default=0.1)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--workdir", help="keep data in this folder")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    print(json.dumps(main(parser.parse_args()), indent=4))
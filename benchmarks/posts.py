@@ -0,0 +1,124 @@
+"""Parse time and retained memory per post of list pages.
+
+Compares the former pydantic post model, holding fresh tag strings and a
+copy of the decoded API post, with the compact ``DanbooruImage`` records.
+Run it from the repository root::
+
+    python -m benchmarks.posts --pages 50 --page-size 100
+"""
+import argparse
+import gc
+import inspect
+import json
+import tracemalloc
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Optional
+
+from httpx import URL
+from pydantic import BaseModel
+
+from DanbooruSpider.spider.list.impl import _loadPage
+from DanbooruSpider.spider.models import Ratings
+
+
+class PydanticImage(BaseModel):
+    id: int
+    source: str
+    tags: List[str]
+    rating: Ratings
+    imageURL: str
+    imageMD5: str
+    imageExt: str
+    imageSize: Optional[int] = None
+    metadata: Dict[str, Any]
+
+
+def pydanticPage(site: str, body: bytes) -> List[PydanticImage]:
+    return [
+        PydanticImage(
+            id=i["id"],
+            source=site,
+            tags=[j.strip() for j in i["tag_string"].split(" ") if j.strip()],
+            rating={j.value: j for j in Ratings}[i["rating"].lower()],
+            imageURL=i["file_url"],
+            imageMD5=i["md5"],
+            imageExt=URL(i["file_url"]).full_path.rsplit(".", 1)[1],
+            imageSize=i.get("file_size"),
+            metadata=i.copy(),
+        )
+        for i in json.loads(body)
+        if "file_url" in i
+    ]
+
+
+def compactPage(site: str, body: bytes) -> List[Any]:
+    return inspect.unwrap(_loadPage)(site, body)[1]
+
+
+def pages(count: int, size: int, vocabulary: int) -> List[bytes]:
+    """Danbooru-like pages, posts carrying 25 tags out of ``vocabulary``."""
+    result = []
+    for page in range(count):
+        posts = []
+        for identifier in range(page * size, (page + 1) * size):
+            tags = " ".join(
+                f"tag_{(identifier * 7 + j * 131) % vocabulary}" for j in range(25)
+            )
+            posts.append(
+                {
+                    "id": identifier,
+                    "tag_string": tags,
+                    "tag_string_general": tags,
+                    "rating": "sqe"[identifier % 3],
+                    "file_url": f"https://example.com/data/{identifier:032x}.jpg",
+                    "md5": f"{identifier:032x}",
+                    "file_size": 262144 + identifier,
+                    "image_width": 1000 + identifier % 1000,
+                    "image_height": 800 + identifier % 800,
+                    "score": identifier % 200,
+                    "created_at": "2020-01-01T00:00:00.000+00:00",
+                    "source": f"https://example.com/source/{identifier}",
+                }
+            )
+        result.append(json.dumps(posts).encode())
+    return result
+
+
+def measure(parse: Callable[[str, bytes], List[Any]], bodies: List[bytes]):
+    gc.collect()
+    tracemalloc.start()
+    beginTime = perf_counter()
+    kept = [parse("example.com", body) for body in bodies]
+    elapsed = perf_counter() - beginTime
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    posts = sum(len(i) for i in kept)
+    return {
+        "posts": posts,
+        "parse_us_per_post": elapsed / posts * 1e6,
+        "bytes_per_post": retained / posts,
+    }
+
+
+def main(arguments: argparse.Namespace) -> Dict[str, Any]:
+    bodies = pages(arguments.pages, arguments.page_size, arguments.vocabulary)
+    # timings under tracemalloc are inflated alike, take them from a plain run
+    results: Dict[str, Any] = {}
+    for name, parse in [("pydantic", pydanticPage), ("compact", compactPage)]:
+        results[name] = measure(parse, bodies)
+        beginTime = perf_counter()
+        for body in bodies:
+            parse("example.com", body)
+        results[name]["parse_us_per_post"] = (
+            (perf_counter() - beginTime) / results[name]["posts"] * 1e6
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--vocabulary", type=int, default=2000)
+    print(json.dumps(main(parser.parse_args()), indent=4))
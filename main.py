@@ -1,40 +1,580 @@
+import argparse
 import asyncio
-from typing import NoReturn
+import json
+import multiprocessing
+import os
+import signal
+from multiprocessing.synchronize import Event
+from pathlib import Path
+from socket import gethostname
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NoReturn, Optional, Tuple
+from urllib.request import urlopen
 
+from DanbooruSpider import __doc__ as banner
 from DanbooruSpider.config import Config
+from DanbooruSpider.exceptions import (
+    DanbooruException,
+    DatabaseException,
+    NotImplementedException,
+)
 from DanbooruSpider.log import logger
-from DanbooruSpider.persistence import Persistence, Services
-from DanbooruSpider.spider import ImageSpiderWorker, ListSpiderManager
+from DanbooruSpider.metrics import JobStates, Metrics, VerifyFailures
+from DanbooruSpider.persistence import (
+    IMAGE_PATH,
+    DatasetExport,
+    Persistence,
+    Selection,
+    Services,
+    Space,
+    storageFor,
+)
+from DanbooruSpider.persistence.database.models import JobsRead, JobState
+from DanbooruSpider.spider import (
+    ClientRegistry,
+    ImageSpiderWorker,
+    JobWorker,
+    ListSpiderManager,
+    Scheduler,
+)
+from DanbooruSpider.spider.models import ImageDownload
+from DanbooruSpider.tracing import Profiler, Tracer
+from DanbooruSpider.utils import ProcessPool, SyncToAsync
 
 SpidersConfig = Config["spider"]["lists"]["spiders"]
+JobsConfig = Config["spider"]["jobs"]
+StagingConfig = Config["persistence"]["staging"]
+MetadataConfig = Config["persistence"]["metadata"]
+TagIndexConfig = Config["persistence"]["tag-index"]
+MetricsConfig = Config["general"]["metrics"]
+TracingConfig = Config["general"]["tracing"]
 
+JOBS_REFRESH_INTERVAL = 30
+FLEET_CHECK_INTERVAL = 5
+FLEET_STOP_TIMEOUT = 30
 
-async def customer(queue: asyncio.Queue) -> None:
-    worker = ImageSpiderWorker(queue)
+
+def weight(spider: Any) -> float:
+    return spider["weight"].as_number() if spider["weight"].exists() else 1
+
+
+async def customer(name: str, queue: asyncio.Queue) -> None:
+    worker = ImageSpiderWorker(queue, name=name)
     async for image in worker.results():
         if not Persistence.verify(image):
             logger.warning(
                 f"Hash verify of image {image.source!r} failed. "
                 + f"({image.md5} did not match {image.data.imageMD5})"
             )
+            VerifyFailures.inc(spider=name)
+            await Persistence.discard(image)
+            image.data.finish(failed=True)
             continue
-        image.path = await Persistence.save(image)
-        await Services.createImage(image)
+        try:
+            locator = await Persistence.save(image)
+        except OSError as e:
+            logger.warning(f"Picture {image.data.id} could not be saved: {e}")
+            image.data.finish(failed=True)
+            continue
+        await Services.createImage(image, locator)
 
 
-async def main():
+async def janitor(jobs: bool = False) -> NoReturn:
+    while True:
+        if jobs:
+            await Persistence.janitor({*await Services.jobs.active()})
+        else:
+            await Persistence.janitor(ImageSpiderWorker.downloading)
+        await asyncio.sleep(StagingConfig["interval"].as_number())
+
+
+async def compactor() -> NoReturn:
+    while True:
+        await asyncio.sleep(MetadataConfig["compact-interval"].as_number())
+        await Persistence.metadata.compactAsync()
+
+
+async def jobsKeeper() -> NoReturn:
+    while True:
+        for state, count in (await Services.jobs.stats()).items():
+            JobStates.set(count, state=state)
+        await Services.jobs.prune()
+        await asyncio.sleep(JOBS_REFRESH_INTERVAL)
+
+
+async def startup(
+    jobs: bool = False,
+) -> Tuple[List[asyncio.Task], Optional[asyncio.AbstractServer]]:
+    await Services.loadHashIndex()
+    await Space.load()
+    maintenance = [
+        asyncio.create_task(janitor(jobs)),
+        asyncio.create_task(compactor()),
+    ]
+    if jobs:
+        maintenance.append(asyncio.create_task(jobsKeeper()))
+    if TagIndexConfig["enabled"].get(bool):
+        await Services.loadTagIndex()
+        maintenance.append(asyncio.create_task(Services.tagIndex.keeper()))
+    if Services.similar.enabled:
+        await Services.similar.load()
+        maintenance.append(asyncio.create_task(Services.similar.hasher()))
+    if MetricsConfig["log-interval"].as_number() > 0:
+        maintenance.append(asyncio.create_task(Metrics.dump()))
+    if TracingConfig["report-interval"].as_number() > 0:
+        maintenance.append(asyncio.create_task(Tracer.dump()))
+    Profiler.installSignals()
+    server = await Metrics.serve() if MetricsConfig["port"].as_number() > 0 else None
+    return maintenance, server
+
+
+async def shutdown(
+    maintenance: List[asyncio.Task], server: Optional[asyncio.AbstractServer]
+) -> None:
+    for task in maintenance:
+        task.cancel()
+    if server is not None:
+        server.close()
+    try:
+        await Services.flush()
+    except DatabaseException as e:
+        logger.error(f"Pictures were lost on shutdown: {e}")
+    await ListSpiderManager.drain()
+    if Services.tagIndex.loaded:
+        await Services.tagIndex.saveAsync()
+    await ClientRegistry.close()
+    ProcessPool.shutdown()
+
+
+async def spiders() -> Dict[str, asyncio.Queue]:
+    queues: Dict[str, asyncio.Queue] = {}
     for i in SpidersConfig:
+        name = i["name"].as_str()
         ListSpiderManager.instance(
-            i["impl"].as_str(), i["name"].as_str(), i["config"].get(dict)
+            i["impl"].as_str(), name, i["config"].get(dict), weight=weight(i)
         )
-        queue = await ListSpiderManager.run(name=i["name"].as_str())
-        asyncio.create_task(customer(queue))
+        queues[name] = await ListSpiderManager.run(name=name)
+    return queues
+
+
+async def main():
+    maintenance, server = await startup()
+    customers = [
+        asyncio.create_task(customer(name, queue))
+        for name, queue in (await spiders()).items()
+    ]
+    try:
+        await asyncio.gather(*customers)
+    finally:
+        await shutdown(maintenance, server)
+
+
+async def producer(name: str, queue: asyncio.Queue) -> None:
     while True:
-        await asyncio.sleep(10)
+        images = await queue.get()
+        if images is None:
+            break
+        existHashes = await Services.checkImagesExist(i.imageMD5 for i in images)
+        await Services.jobs.put(
+            name, [i for i in images if i.imageMD5 not in existHashes]
+        )
+        for image in images:
+            image.finish()
+
+
+async def store(job: JobsRead) -> Optional[asyncio.Future]:
+    """Store the picture of a job, returning whether its row has been
+    committed as a future, or ``None`` when it was stored before."""
+    image = Services.jobs.image(job)
+    staged = Persistence.stage(image.imageMD5)
+    if await Services.checkImagesExist([image.imageMD5]):
+        await staged.clean()
+        return None
+    download = ImageDownload(
+        **{
+            "source": image.imageURL,
+            "path": staged.path,
+            "size": (await SyncToAsync(os.stat)(staged.path)).st_size,
+            "md5": image.imageMD5.lower(),
+            "data": image,
+        }
+    )
+    locator = await Persistence.save(download)
+    return await Services.createImage(download, locator)
+
+
+async def ingester(finished: Callable[[], bool]) -> None:
+    """Store pictures downloaded by the workers, marking their jobs done
+    once committed to the database."""
+    owner = f"{gethostname()}:{os.getpid()}:ingester"
+    size: int = JobsConfig["claim-size"].as_number()
+    try:
+        while True:
+            jobs = await Services.jobs.claim(owner, size, JobState.STORING)
+            if not jobs:
+                if finished() and await Services.jobs.drained():
+                    return
+                await asyncio.sleep(JobsConfig["poll-interval"].as_number())
+                continue
+            stored: List[Tuple[JobsRead, Optional[asyncio.Future]]] = []
+            for job in jobs:
+                try:
+                    stored.append((job, await store(job)))
+                except Exception as e:
+                    state = await Services.jobs.fail(owner, job, e)
+                    logger.warning(f"Storing job {job.jid} failed, {state.value}: {e}")
+            try:
+                await Services.flush()
+            except DatabaseException as e:
+                logger.warning(f"Storing jobs failed partly: {e}")
+            committed: List[JobsRead] = []
+            for job, future in stored:
+                if future is None or await future:
+                    committed.append(job)
+                    continue
+                # The picture is downloaded again, its file has been moved
+                error = DatabaseException(
+                    f"Picture of job {job.jid} was not committed."
+                )
+                state = await Services.jobs.fail(owner, job, error)
+                logger.warning(f"Storing job {job.jid} failed, {state.value}: {error}")
+            await Services.jobs.complete(owner, committed)
+    finally:
+        await Services.jobs.release(owner)
+
+
+def workerProcess(index: Optional[int], stopping: Optional[Event]) -> None:
+    async def run() -> None:
+        await Space.load()
+        for i in SpidersConfig:
+            Scheduler.register(i["name"].as_str(), weight(i))
+        port: int = MetricsConfig["port"].as_number()
+        server = None
+        if index is not None and port > 0:
+            server = await Metrics.serve(port=port + 1 + index)
+        Profiler.installSignals()
+        worker = JobWorker()
+        loop = asyncio.get_event_loop()
+        for number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(number, worker.stop)
+            except NotImplementedError:
+                # Windows event loops have no signal handlers, interrupts
+                # end the worker there
+                break
+        try:
+            if stopping is not None:
+                await worker.run(stopping.is_set)
+            else:
+                await worker.run()
+        finally:
+            if server is not None:
+                server.close()
+            await ClientRegistry.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerFleet:
+    """Download worker processes, restarted whenever one of them exits."""
+
+    def __init__(self, size: int) -> None:
+        self._context = multiprocessing.get_context("spawn")
+        self.stopping = self._context.Event()
+        self._processes: List[Any] = [None] * size
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=workerProcess, args=(index, self.stopping), name=f"worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Worker process {index} started as {process.pid}.")
+
+    def start(self) -> None:
+        for index in range(len(self._processes)):
+            self._spawn(index)
+
+    async def supervise(self) -> NoReturn:
+        while True:
+            await asyncio.sleep(FLEET_CHECK_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if process.exitcode is None or self.stopping.is_set():
+                    continue
+                logger.warning(
+                    f"Worker process {index} exited with {process.exitcode}, "
+                    + "restarting."
+                )
+                self._spawn(index)
+
+    async def stop(self, timeout: float = FLEET_STOP_TIMEOUT) -> None:
+        self.stopping.set()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while any(i.is_alive() for i in self._processes) and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+        for process in self._processes:
+            if process.is_alive():
+                logger.warning(
+                    f"Worker process {process.pid} did not stop, terminated."
+                )
+                process.terminate()
+            process.join()
+
+
+async def fleet(size: int) -> None:
+    maintenance, server = await startup(jobs=True)
+    workers = WorkerFleet(size)
+    workers.start()
+    maintenance.append(asyncio.create_task(workers.supervise()))
+    producers = [
+        asyncio.create_task(producer(name, queue))
+        for name, queue in (await spiders()).items()
+    ]
+    try:
+        await ingester(lambda: all(i.done() for i in producers))
+        await asyncio.gather(*producers)
+    finally:
+        for task in producers:
+            task.cancel()
+        await workers.stop()
+        await shutdown(maintenance, server)
+
+
+def migrateMetadata(arguments: argparse.Namespace) -> None:
+    try:
+        Persistence.metadata.migrate(IMAGE_PATH, remove=arguments.remove)
+    except DanbooruException as e:
+        logger.error(f"Metadata cannot be migrated now: {e}")
+        exit(1)
+
+
+def compactMetadata(arguments: argparse.Namespace) -> None:
+    try:
+        Persistence.metadata.compact()
+    except DanbooruException as e:
+        logger.error(f"Metadata cannot be compacted now: {e}")
+        exit(1)
+
+
+def admin(path: str, timeout: float = 30) -> str:
+    host, port = MetricsConfig["host"].as_str(), MetricsConfig["port"].as_number()
+    with urlopen(f"http://{host}:{port}{path}", timeout=timeout) as response:
+        return response.read().decode("utf-8")
+
+
+def profile(arguments: argparse.Namespace) -> None:
+    seconds = arguments.seconds or TracingConfig["profile-duration"].as_number()
+    query = f"kind={arguments.kind}&seconds={seconds}"
+    print(admin(f"/profile?{query}", timeout=seconds + 30))
+
+
+def traces(arguments: argparse.Namespace) -> None:
+    print(admin("/traces"))
+
+
+def jobs(arguments: argparse.Namespace) -> None:
+    if arguments.retry_failed:
+        print(f"{asyncio.run(Services.jobs.retry())} failed jobs queued again.")
+    print(json.dumps(asyncio.run(Services.jobs.stats()), indent=2))
+
+
+async def similar(arguments: argparse.Namespace) -> None:
+    await Services.similar.load()
+    if arguments.hash:
+        while await Services.similar.hashPending():
+            logger.info(f"{len(Services.similar.index)} pictures hashed so far.")
+    clusters = Services.similar.clusters(arguments.radius)
+    pictures = {
+        i.pid: i
+        for i in await Services.pictures.readMany([j for i in clusters for j in i])
+    }
+    print(
+        json.dumps(
+            [
+                [
+                    {"pid": j, "source": pictures[j].source, "md5": pictures[j].md5}
+                    for j in i
+                ]
+                for i in clusters
+            ],
+            indent=2,
+        )
+    )
+    if not arguments.collapse:
+        return
+    remove: bool = arguments.remove_files
+    for cluster in clusters:
+        await Services.similar.collapse(cluster)
+        for pid in cluster[1:] if remove else ():
+            locator = pictures[pid].locale_path
+            try:
+                storageFor(locator).remove(locator)
+            except NotImplementedException:
+                logger.warning(
+                    f"Pictures cannot be removed from the store of {locator!r}."
+                )
+                remove = False
+                break
+            except OSError as e:
+                logger.warning(f"Picture {locator!r} could not be removed: {e}")
+    logger.info(f"{len(clusters)} clusters of near-duplicates have been collapsed.")
+
+
+def select(expression: str) -> Selection:
+    try:
+        return Services.tagIndex.select(expression)
+    except DanbooruException as e:
+        logger.error(f"Query {expression!r} cannot be run: {e}")
+        exit(1)
+
+
+async def search(arguments: argparse.Namespace) -> None:
+    await Services.loadTagIndex(arguments.rebuild)
+    index = Services.tagIndex
+    if arguments.top:
+        print(json.dumps(dict(index.tagCounts(arguments.top)), indent=2))
+        return
+    beginTime = perf_counter()
+    selection = select(" ".join(arguments.query))
+    count = len(selection)
+    pids = selection.page(arguments.offset, arguments.limit, newest=True)
+    elapsed = perf_counter() - beginTime
+    pictures = {i.pid: i for i in await Services.pictures.readMany(pids)}
+    result = {
+        "count": count,
+        "milliseconds": round(elapsed * 1000, 3),
+        "facets": index.facetCounts(selection),
+        "pictures": [
+            pictures[i].dict(exclude={"create_time"}) for i in pids if i in pictures
+        ],
+    }
+    print(json.dumps(result, indent=2))
+
+
+async def export(arguments: argparse.Namespace) -> None:
+    await Services.loadTagIndex()
+    expression = " ".join(arguments.query)
+    selection = select(expression)
+    exporter = DatasetExport(
+        Path(arguments.folder),
+        expression,
+        prefix=arguments.prefix,
+        shardSize=arguments.shard_size,
+        workers=arguments.workers,
+    )
+    manifest = await exporter.run(selection)
+    print(json.dumps({i: j for i, j in manifest.items() if i != "shards"}, indent=2))
+
+
+COMMANDS: Dict[str, Callable[[argparse.Namespace], None]] = {
+    "run": lambda _: asyncio.run(main()),
+    "fleet": lambda arguments: asyncio.run(
+        fleet(arguments.workers or JobsConfig["workers"].as_number())
+    ),
+    "worker": lambda arguments: workerProcess(arguments.index, None),
+    "jobs": jobs,
+    "migrate-metadata": migrateMetadata,
+    "compact-metadata": compactMetadata,
+    "export": lambda arguments: asyncio.run(export(arguments)),
+    "search": lambda arguments: asyncio.run(search(arguments)),
+    "similar": lambda arguments: asyncio.run(similar(arguments)),
+    "profile": profile,
+    "traces": traces,
+}
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=banner, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="crawl the configured spiders (default)")
+    fleetParser = commands.add_parser(
+        "fleet", help="crawl the spiders with downloads spread over worker processes"
+    )
+    fleetParser.add_argument("--workers", type=int, help="number of worker processes")
+    worker = commands.add_parser(
+        "worker", help="run one more download worker next to a running fleet"
+    )
+    worker.add_argument(
+        "--index", type=int, help="serve metrics on the metrics port + 1 + index"
+    )
+    jobsParser = commands.add_parser("jobs", help="show jobs of the queue by state")
+    jobsParser.add_argument(
+        "--retry-failed", action="store_true", help="queue failed jobs again"
+    )
+    migrate = commands.add_parser(
+        "migrate-metadata", help="import metadata sidecar files into the packed store"
+    )
+    migrate.add_argument(
+        "--remove", action="store_true", help="delete sidecar files once imported"
+    )
+    commands.add_parser("compact-metadata", help="compact packed metadata segments")
+    searchParser = commands.add_parser(
+        "search", help="find stored pictures by tags, rating, source and extension"
+    )
+    searchParser.add_argument(
+        "query", nargs="*", help="filter expression such as '1girl -solo rating:s'"
+    )
+    searchParser.add_argument(
+        "--limit", type=int, default=20, help="number of pictures to list"
+    )
+    searchParser.add_argument("--offset", type=int, default=0)
+    searchParser.add_argument(
+        "--top", type=int, help="list the tags with the most pictures instead"
+    )
+    searchParser.add_argument(
+        "--rebuild", action="store_true", help="rebuild the index from the database"
+    )
+    exportParser = commands.add_parser(
+        "export", help="export matching pictures into tar shards for training"
+    )
+    exportParser.add_argument("folder", help="folder of the shards and manifest")
+    exportParser.add_argument(
+        "query", nargs="*", help="filter expression, all pictures if left out"
+    )
+    exportParser.add_argument(
+        "--prefix", default="shard", help="name prefix of the shard files"
+    )
+    exportParser.add_argument("--shard-size", type=int, help="bytes per shard")
+    exportParser.add_argument("--workers", type=int, help="threads reading pictures")
+    similarParser = commands.add_parser(
+        "similar", help="list clusters of near-duplicate pictures"
+    )
+    similarParser.add_argument(
+        "--hash", action="store_true", help="hash stored pictures not hashed yet first"
+    )
+    similarParser.add_argument(
+        "--radius", type=int, help="largest Hamming distance of similar pictures"
+    )
+    similarParser.add_argument(
+        "--collapse",
+        action="store_true",
+        help="merge each cluster into its largest picture",
+    )
+    similarParser.add_argument(
+        "--remove-files",
+        action="store_true",
+        help="delete the files of collapsed pictures",
+    )
+    profiler = commands.add_parser(
+        "profile", help="capture a profile of the running crawler"
+    )
+    profiler.add_argument("--kind", choices=Profiler.KINDS, default="cpu")
+    profiler.add_argument("--seconds", type=float, help="length of the window")
+    commands.add_parser(
+        "traces", help="show stage breakdown and slow traces of the running crawler"
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    arguments = parseArguments()
     try:
-        asyncio.run(main())
+        COMMANDS[arguments.command or "run"](arguments)
     except KeyboardInterrupt:
         exit()
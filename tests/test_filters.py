@@ -0,0 +1,33 @@
+from DanbooruSpider.spider.filters import PostFields, PostFilter
+
+
+def post(*tags: str, rating: str = "s") -> PostFields:
+    return PostFields.of({"rating": rating}, tags, "jpg", "danbooru")
+
+
+def test_qualified_tags_stay_whole():
+    postFilter = PostFilter("saber_(fate) rating:s", 3)
+    assert postFilter.query == ("rating:s", "saber_(fate)")
+    assert postFilter.accepts(post("saber_(fate)", "1girl"))
+    assert not postFilter.accepts(post("saber", "fate"))
+
+
+def test_qualified_tags_inside_groups():
+    postFilter = PostFilter("(touhou_(series) | saber_(fate)) -rating:e")
+    assert postFilter.accepts(post("touhou_(series)"))
+    assert postFilter.accepts(post("saber_(fate)", rating="q"))
+    assert not postFilter.accepts(post("touhou_(series)", rating="e"))
+    assert not postFilter.accepts(post("touhou", "series"))
+
+
+def test_grouping_at_word_edges():
+    postFilter = PostFilter("-(a b) ((c_(d)))")
+    assert postFilter.accepts(post("a", "c_(d)"))
+    assert not postFilter.accepts(post("a", "b", "c_(d)"))
+    assert not postFilter.accepts(post("c"))
+
+
+def test_comparisons_are_collected():
+    postFilter = PostFilter("1girl (width:>=1920 | -filesize:<1MB) -(score:5..10)")
+    assert postFilter.comparisons() == {"width", "filesize", "score"}
+    assert PostFilter("rating:s ext:png").comparisons() == frozenset()
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+
+from DanbooruSpider.persistence.database import Jobs, access, models
+from DanbooruSpider.persistence.jobs import JobQueue
+from DanbooruSpider.spider.models import DanbooruImage, Ratings
+
+
+def image(id: int) -> DanbooruImage:
+    return DanbooruImage(
+        id, "test", (), Ratings.SAFE, "", f"{id:032x}", "jpg", None, "{}"
+    )
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    getEngine = access.getEngine
+    uri = f"sqlite:///{tmp_path / 'database.sqlite3'}"
+    monkeypatch.setattr(access, "getEngine", lambda: getEngine(uri))
+    return Jobs()
+
+
+def test_expired_leases_are_claimed_again(database):
+    queue = JobQueue(database, lease=0.2)
+
+    async def main() -> None:
+        await queue.put("test", [image(1), image(2)])
+        jobs = await queue.claim("first", 10)
+        assert [i.attempts for i in jobs] == [1, 1]
+        assert await queue.claim("second", 10) == []
+        time.sleep(0.3)
+        again = await queue.claim("second", 10)
+        assert [i.jid for i in again] == [i.jid for i in jobs]
+        assert [i.attempts for i in again] == [2, 2]
+        assert await queue.complete("first", jobs) == 0
+        assert await queue.complete("second", again) == 2
+        assert await queue.drained()
+
+    asyncio.run(main())
+
+
+def test_renewed_leases_are_kept(database):
+    queue = JobQueue(database, lease=0.5)
+
+    async def main() -> None:
+        await queue.put("test", [image(1)])
+        jobs = await queue.claim("first", 10)
+        time.sleep(0.3)
+        assert await queue.renew("first", [i.jid for i in jobs]) == 1
+        time.sleep(0.3)
+        assert await queue.claim("second", 10) == []
+        assert await queue.release("first") == 1
+        assert [i.jid for i in await queue.claim("second", 10)] == [jobs[0].jid]
+
+    asyncio.run(main())
+
+
+def test_failed_jobs_are_retried_up_to_their_limit(database):
+    queue = JobQueue(database, lease=10, maxAttempts=2, retryDelay=0)
+
+    async def main() -> None:
+        await queue.put("test", [image(1)])
+        (job,) = await queue.claim("worker", 1)
+        assert await queue.fail("worker", job, OSError("lost")) == (
+            models.JobState.PENDING
+        )
+        (job,) = await queue.claim("worker", 1)
+        assert await queue.fail("worker", job, OSError("lost")) == (
+            models.JobState.FAILED
+        )
+        assert await queue.claim("worker", 1) == []
+        assert (await queue.stats())[models.JobState.FAILED.value] == 1
+
+    asyncio.run(main())
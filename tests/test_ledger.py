@@ -0,0 +1,78 @@
+import asyncio
+from typing import List
+
+from DanbooruSpider.persistence import Services
+from DanbooruSpider.persistence.database.models import CheckpointsCreate, CrawlDirection
+from DanbooruSpider.spider.list.worker import CheckpointLedger
+from DanbooruSpider.spider.models import DanbooruImage, Ratings
+
+
+def image(id: int) -> DanbooruImage:
+    return DanbooruImage(
+        id, "test", (), Ratings.SAFE, "", f"{id:032x}", "jpg", None, "{}"
+    )
+
+
+def checkpoint(lowest: int) -> CheckpointsCreate:
+    return CheckpointsCreate(
+        name="test",
+        highest_id=100,
+        lowest_id=lowest,
+        direction=CrawlDirection.BACKWARD,
+    )
+
+
+def run(monkeypatch, scenario) -> List[int]:
+    saved: List[int] = []
+
+    async def updateCheckpoint(checkpoint: CheckpointsCreate) -> None:
+        saved.append(checkpoint.lowest_id)
+
+    monkeypatch.setattr(Services, "updateCheckpoint", updateCheckpoint)
+
+    async def main() -> None:
+        ledger = CheckpointLedger("test", None)
+        scenario(ledger)
+        await asyncio.sleep(0)
+        await ledger.drain()
+
+    asyncio.run(main())
+    return saved
+
+
+def test_checkpoints_advance_in_page_order(monkeypatch):
+    def scenario(ledger: CheckpointLedger) -> None:
+        first, second = [image(90), image(80)], [image(70)]
+        ledger.track(first, checkpoint(80))
+        ledger.track(second, checkpoint(70))
+        second[0].finish()
+        assert ledger.head == checkpoint(70)
+        first[0].finish()
+        first[1].finish()
+
+    assert run(monkeypatch, scenario)[-1] == 70
+
+
+def test_failed_posts_hold_checkpoints_back(monkeypatch):
+    def scenario(ledger: CheckpointLedger) -> None:
+        first, second, third = [image(90)], [image(80)], [image(70)]
+        ledger.track(first, checkpoint(90))
+        ledger.track(second, checkpoint(80))
+        ledger.track(third, checkpoint(70))
+        first[0].finish()
+        second[0].finish(failed=True)
+        third[0].finish()
+
+    assert run(monkeypatch, scenario) == [90]
+
+
+def test_skipped_pages_hold_checkpoints_back(monkeypatch):
+    def scenario(ledger: CheckpointLedger) -> None:
+        first, third = [image(90)], [image(70)]
+        ledger.track(first, checkpoint(90))
+        ledger.skip()
+        ledger.track(third, checkpoint(70))
+        first[0].finish()
+        third[0].finish()
+
+    assert run(monkeypatch, scenario) == [90]
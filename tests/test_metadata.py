@@ -0,0 +1,73 @@
+import pytest
+
+from DanbooruSpider.exceptions import DanbooruException
+from DanbooruSpider.persistence.metadata import MetadataStore
+from DanbooruSpider.persistence.offsets import OffsetIndex
+
+
+def md5(number: int) -> str:
+    return f"{number:032x}"
+
+
+def test_offset_index_lookups_survive_merging(tmp_path):
+    index = OffsetIndex(tmp_path)
+    for i in range(10):
+        index.put(md5(i), 1, i * 100, 100)
+    index.merge()
+    index.put(md5(3), 2, 0, 50)
+    index.put(md5(20), 2, 50, 50)
+    assert index.get(md5(3)) == (2, 0, 50)
+    assert index.get(md5(5)) == (1, 500, 100)
+    assert md5(30) not in index
+    assert len(index) == 11
+    expected = dict(index.items())
+    index.close()
+
+    reopened = OffsetIndex(tmp_path)
+    assert dict(reopened.items()) == expected
+    reopened.close()
+
+
+def test_offset_index_drops_torn_journal_records(tmp_path):
+    index = OffsetIndex(tmp_path)
+    index.put(md5(1), 1, 0, 10)
+    index.close()
+    with (tmp_path / "index.journal").open("ab") as journal:
+        journal.write(b"\0" * 7)
+
+    reopened = OffsetIndex(tmp_path)
+    reopened.put(md5(2), 1, 10, 10)
+    assert dict(reopened.items()) == {md5(1): (1, 0, 10), md5(2): (1, 10, 10)}
+    reopened.close()
+
+
+def test_metadata_store_compacts_superseded_segments(tmp_path):
+    store = MetadataStore(tmp_path, segmentSize=500)
+    for version in range(3):
+        for i in range(10):
+            store.put(md5(i).upper(), {"id": i, "version": version})
+    assert len(store.segments()) > 2
+    assert store.compact(0.99) > 0
+    assert store.get(md5(4)) == {"id": 4, "version": 2}
+    assert sorted(data["id"] for _, data in store.scan()) == list(range(10))
+    assert all(data["version"] == 2 for _, data in store.scan())
+    store.close()
+
+    reopened = MetadataStore(tmp_path, segmentSize=500)
+    assert reopened.get(md5(9).upper()) == {"id": 9, "version": 2}
+    assert reopened.get(md5(10)) is None
+    reopened.close()
+
+
+def test_metadata_store_has_one_writer_and_spares_readers(tmp_path):
+    store = MetadataStore(tmp_path, segmentSize=60)
+    other = MetadataStore(tmp_path, segmentSize=60)
+    store.put(md5(1), {"id": 1})
+    store.put(md5(1), {"id": 1, "version": 2})
+    with pytest.raises(DanbooruException):
+        other.put(md5(2), {"id": 2})
+    assert other.get(md5(1)) == {"id": 1, "version": 2}
+    assert store.compact(0.99) == 0
+    other.close()
+    assert store.compact(0.99) == 1
+    store.close()
@@ -0,0 +1,26 @@
+import json
+
+from DanbooruSpider.spider.list.impl import _identifiers, _parsePosts
+
+
+def post(id, **fields):
+    return {
+        "id": id,
+        "file_url": f"https://example.com/{id}.jpg",
+        "tags": "1girl solo",
+        "rating": "s",
+        "md5": f"{id:032x}" if isinstance(id, int) else "0" * 32,
+        **fields,
+    }
+
+
+def test_malformed_posts_are_skipped():
+    posts = [post(1), post(2, rating=None), post(3, md5=None), post(4)]
+    posts[2].pop("tags")
+    result = _parsePosts("example.com", ((i, json.dumps(i)) for i in posts))
+    assert [i.id for i in result] == [1, 4]
+    assert result[1].tags == ("1girl", "solo")
+
+
+def test_identifiers_skip_missing_ids():
+    assert _identifiers([post(1), {"file_url": "x"}, post("2"), post(None)]) == [1, 2]
@@ -0,0 +1,61 @@
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from DanbooruSpider.exceptions import NotImplementedException
+from DanbooruSpider.persistence.storage import ShardStorage, TreeStorage
+
+
+def staged(folder: Path, number: int, size: int) -> Path:
+    path = folder / f"{number}.part"
+    path.write_bytes(bytes([number % 256]) * size)
+    return path
+
+
+def test_shards_round_trip(tmp_path):
+    storage = ShardStorage(tmp_path / "shards", shardSize=4096)
+    locators = {
+        i: storage.store(staged(tmp_path, i, 1000 + i), f"{i:032x}", "jpg")
+        for i in range(6)
+    }
+    assert len(storage.shards()) > 1
+    for number, locator in locators.items():
+        assert storage.read(locator) == bytes([number]) * (1000 + number)
+    storage.close()
+
+    reopened = ShardStorage(tmp_path / "shards", shardSize=4096)
+    locator = reopened.store(staged(tmp_path, 9, 10), f"{9:032x}", "png")
+    assert reopened.read(locators[0]) == bytes([0]) * 1000
+    assert reopened.read(locator) == bytes([9]) * 10
+    reopened.close()
+
+
+def test_shards_are_valid_tar_files(tmp_path):
+    storage = ShardStorage(tmp_path / "shards")
+    for i in range(3):
+        storage.store(staged(tmp_path, i, 700), f"{i:032x}", "jpg")
+    storage.close()
+    with tarfile.open(tmp_path / "shards" / "shard-000001.tar") as archive:
+        assert archive.getnames() == [f"{i:032x}.jpg" for i in range(3)]
+        assert archive.extractfile(f"{1:032x}.jpg").read() == bytes([1]) * 700
+
+
+def test_storing_twice_keeps_one_copy(tmp_path):
+    storage = ShardStorage(tmp_path / "shards")
+    first = storage.store(staged(tmp_path, 1, 100), f"{1:032x}", "jpg")
+    second = storage.store(staged(tmp_path, 1, 100), f"{1:032x}", "jpg")
+    assert first == second
+    assert not (tmp_path / "1.part").exists()
+    with pytest.raises(NotImplementedException):
+        storage.remove(first)
+    storage.close()
+
+
+def test_tree_round_trip(tmp_path):
+    storage = TreeStorage(tmp_path / "images", depth=2)
+    locator = storage.store(staged(tmp_path, 3, 50), "AB" + "0" * 30, "jpg")
+    assert storage.read(locator) == bytes([3]) * 50
+    storage.remove(locator)
+    with pytest.raises(OSError):
+        storage.read(locator)
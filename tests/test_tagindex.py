@@ -0,0 +1,78 @@
+from datetime import datetime
+from typing import Dict, List
+
+import pytest
+
+from DanbooruSpider.exceptions import NotImplementedException
+from DanbooruSpider.persistence.database.models import PicturesRead
+from DanbooruSpider.persistence.tagindex import TagIndex
+
+
+def picture(pid: int) -> PicturesRead:
+    return PicturesRead(
+        pid=pid,
+        md5=f"{pid:032x}",
+        locale_path=f"shard://000001/{pid:032x}.{'png' if pid % 10 else 'jpg'}",
+        rating="s" if pid % 2 else "e",
+        source="yande.re" if pid <= 50 else "danbooru",
+        source_id=pid,
+        source_url="",
+        create_time=datetime.now(),
+    )
+
+
+def tags(pid: int) -> List[str]:
+    names = ["common"]
+    if pid % 3 == 0:
+        names.append("triple")
+    if pid in (7, 77):
+        names.append("rare")
+    return names
+
+
+def build(tmp_path, pids: range) -> TagIndex:
+    index = TagIndex(tmp_path / "tagindex")
+    index.loaded = True
+    pictures = [picture(i) for i in pids]
+    mapping: Dict[str, List[str]] = {i.md5: tags(i.pid) for i in pictures}
+    index.add(pictures, mapping)
+    return index
+
+
+def test_queries_match_filter_expressions(tmp_path):
+    index = build(tmp_path, range(1, 101))
+    assert index.select("rare").page() == [7, 77]
+    assert len(index.select("triple")) == 33
+    assert index.select("triple rating:s source:yande.re").page(limit=3) == [3, 9, 15]
+    assert index.select("rare or ext:jpg").page(newest=True, limit=3) == [100, 90, 80]
+    assert len(index.select("common -triple")) == 67
+    assert index.tagCounts(2) == [("common", 100), ("triple", 33)]
+    assert index.facetCounts(index.select("rare"))["source"] == {
+        "danbooru": 1,
+        "yande.re": 1,
+    }
+    with pytest.raises(NotImplementedException):
+        index.select("score:>10")
+
+
+def test_hidden_and_known_pictures_are_left_out(tmp_path):
+    index = build(tmp_path, range(1, 51))
+    index.add([picture(7), picture(51)], {f"{51:032x}": ["rare"]})
+    index.hide([7])
+    assert index.select("rare").page() == [51]
+    assert len(index) == 51
+
+
+def test_snapshots_restore_the_index(tmp_path):
+    index = build(tmp_path, range(1, 101))
+    index.save()
+
+    restored = TagIndex(tmp_path / "tagindex")
+    assert restored._restore()
+    assert (restored.highest, len(restored)) == (100, 100)
+    assert (
+        restored.select("triple -rating:e").page()
+        == index.select("triple -rating:e").page()
+    )
+    assert restored.count("rare") == 2
+    assert not TagIndex(tmp_path / "missing")._restore()
@@ -0,0 +1,41 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from DanbooruSpider.exceptions import NetworkException, SpiderException
+from DanbooruSpider.spider.list.worker import CheckpointLedger, ListSpiderWorker, Page_T
+
+
+class FlakyWorker(ListSpiderWorker):
+    site = "flaky"
+
+    def __init__(self, failures: Dict[int, List[Exception]]) -> None:
+        super().__init__()
+        self.failures = failures
+        self.requested: List[int] = []
+        self.ledger = CheckpointLedger("flaky", None)
+
+    async def _fetchPage(self, page: int, size: int, before: Optional[int]) -> Page_T:
+        self.requested.append(page)
+        if self.failures.get(page):
+            raise self.failures[page].pop(0)
+        return [page], []
+
+
+def walk(worker: FlakyWorker, end: int) -> List[int]:
+    async def main() -> List[int]:
+        return [i[0] async for i, _ in worker._walk(1, end, 10) if i]
+
+    return asyncio.run(main())
+
+
+def test_network_errors_are_retried_within_the_page_limit():
+    worker = FlakyWorker({2: [NetworkException("down"), NetworkException("down")]})
+    assert walk(worker, 5) == [1, 2, 3, 4]
+    assert worker.requested.count(2) == 3
+
+
+def test_failing_pages_are_skipped():
+    worker = FlakyWorker({2: [SpiderException("bad")], 3: [NetworkException()] * 3})
+    assert walk(worker, 6) == [1, 4, 5]
+    assert worker.requested.count(2) == 1
+    assert worker.requested.count(3) == 3
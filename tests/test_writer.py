@@ -0,0 +1,68 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from DanbooruSpider.exceptions import DatabaseException
+from DanbooruSpider.persistence.database import models
+from DanbooruSpider.persistence.writer import DatabaseWriter
+
+
+class FakePictures:
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.batches: List[List[str]] = []
+
+    async def createMany(self, batch, tagsCache):
+        if self.failures:
+            self.failures -= 1
+            raise DatabaseException("locked")
+        self.batches.append([i.md5 for i in batch])
+        return []
+
+
+def ingest(number: int) -> models.PicturesIngest:
+    return models.PicturesIngest(
+        md5=f"{number:032x}",
+        locale_path=f"{number}.jpg",
+        rating="s",
+        source="test",
+        source_id=number,
+        source_url=f"https://example.com/{number}.jpg",
+        tags=("1girl",),
+    )
+
+
+def write(access: FakePictures, count: int) -> List[bool]:
+    async def main() -> List[bool]:
+        writer = DatabaseWriter(access, batchSize=4, interval=0.01)
+        futures = [await writer.put(ingest(i)) for i in range(count)]
+        try:
+            await writer.flush()
+        except DatabaseException:
+            assert all(i.done() for i in futures)
+            raise
+        finally:
+            await writer.stop()
+        return [i.result() for i in futures]
+
+    return asyncio.run(main())
+
+
+def test_pictures_are_committed_in_batches():
+    access = FakePictures()
+    assert write(access, 10) == [True] * 10
+    assert [len(i) for i in access.batches] == [4, 4, 2]
+
+
+def test_failed_batches_are_retried():
+    access = FakePictures(failures=2)
+    assert write(access, 3) == [True] * 3
+    assert len(access.batches) == 1
+
+
+def test_flush_raises_for_lost_pictures():
+    access = FakePictures(failures=100)
+    with pytest.raises(DatabaseException):
+        write(access, 3)
+    assert not access.batches